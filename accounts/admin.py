@@ -1,5 +1,5 @@
 from django.contrib import admin
-from .models import UserStorageSettings
+from .models import UserStorageSettings, UserStorageUsage
 
 
 @admin.register(UserStorageSettings)
@@ -9,3 +9,9 @@ class UserStorageSettingsAdmin(admin.ModelAdmin):
     autocomplete_fields = ("user",)
 
 
+@admin.register(UserStorageUsage)
+class UserStorageUsageAdmin(admin.ModelAdmin):
+    list_display = ("user", "total_bytes", "image_bytes", "video_bytes", "audio_bytes", "file_bytes", "mockup_bytes", "updated_at")
+    search_fields = ("user__username", "user__email")
+    readonly_fields = ("updated_at",)
+    autocomplete_fields = ("user",)
@@ -0,0 +1,30 @@
+# Generated by Django 5.2.7 on 2026-10-18 02:04
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('accounts', '0003_userstoragesettings'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='UserStorageUsage',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('image_bytes', models.BigIntegerField(default=0)),
+                ('video_bytes', models.BigIntegerField(default=0)),
+                ('audio_bytes', models.BigIntegerField(default=0)),
+                ('file_bytes', models.BigIntegerField(default=0)),
+                ('mockup_bytes', models.BigIntegerField(default=0)),
+                ('total_bytes', models.BigIntegerField(default=0)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('user', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='storage_usage', to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+    ]
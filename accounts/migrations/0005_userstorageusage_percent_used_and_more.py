@@ -0,0 +1,66 @@
+# Generated by Django 5.2.7 on 2026-10-18 02:05
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+def fill_quotas(apps, schema_editor):
+    UserStorageUsage = apps.get_model('accounts', 'UserStorageUsage')
+    UserStorageSettings = apps.get_model('accounts', 'UserStorageSettings')
+    default_mb = int(getattr(settings, 'USER_STORAGE_QUOTA_MB', 0) or 0)
+    overrides = dict(UserStorageSettings.objects.filter(quota_mb__gt=0).values_list('user_id', 'quota_mb'))
+    for usage in UserStorageUsage.objects.all().iterator():
+        quota = int(overrides.get(usage.user_id) or default_mb) * 1024 * 1024
+        usage.quota_bytes = quota
+        usage.percent_used = int(usage.total_bytes * 100 // quota) if quota > 0 else 0
+        usage.save(update_fields=['quota_bytes', 'percent_used'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('accounts', '0004_userstorageusage'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='userstorageusage',
+            name='percent_used',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='userstorageusage',
+            name='quota_bytes',
+            field=models.BigIntegerField(default=0),
+        ),
+        migrations.AddIndex(
+            model_name='userstorageusage',
+            index=models.Index(fields=['total_bytes'], name='accounts_us_total_b_c437d3_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='userstorageusage',
+            index=models.Index(fields=['percent_used'], name='accounts_us_percent_e46388_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='userstorageusage',
+            index=models.Index(fields=['image_bytes'], name='accounts_us_image_b_98736a_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='userstorageusage',
+            index=models.Index(fields=['video_bytes'], name='accounts_us_video_b_c885c3_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='userstorageusage',
+            index=models.Index(fields=['audio_bytes'], name='accounts_us_audio_b_4bf7bb_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='userstorageusage',
+            index=models.Index(fields=['file_bytes'], name='accounts_us_file_by_20f633_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='userstorageusage',
+            index=models.Index(fields=['mockup_bytes'], name='accounts_us_mockup__ecf59c_idx'),
+        ),
+        migrations.RunPython(fill_quotas, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,72 @@
+# Generated by Django 5.2.7 on 2026-10-18 03:20
+
+from django.conf import settings
+from django.db import migrations
+
+# Ledger column per tracked file field, as of this migration (projects.usage)
+MEDIA_FIELDS = {
+    'Project': ('owner', {'cover_image': 'image_bytes', 'video_file': 'video_bytes', 'audio_file': 'audio_bytes'}),
+    'ProjectImage': ('project__owner', {'image': 'image_bytes'}),
+    'ProjectFile': ('project__owner', {'file': 'file_bytes'}),
+    'PackageMockup': ('owner', {
+        'container_image': 'mockup_bytes',
+        'design_image': 'mockup_bytes',
+        'generated_image': 'mockup_bytes',
+        'mask_image': 'mockup_bytes',
+    }),
+}
+
+
+def _size(field_file):
+    try:
+        if field_file and field_file.storage.exists(field_file.name):
+            return int(field_file.storage.size(field_file.name) or 0)
+    except Exception:
+        pass
+    return 0
+
+
+def backfill_usage(apps, schema_editor):
+    # Users created before the ledger existed have no row; walk their media once
+    User = apps.get_model(*settings.AUTH_USER_MODEL.split('.'))
+    UserStorageUsage = apps.get_model('accounts', 'UserStorageUsage')
+    UserStorageSettings = apps.get_model('accounts', 'UserStorageSettings')
+    default_mb = int(getattr(settings, 'USER_STORAGE_QUOTA_MB', 0) or 0)
+    overrides = dict(UserStorageSettings.objects.filter(quota_mb__gt=0).values_list('user_id', 'quota_mb'))
+    missing = User.objects.exclude(pk__in=UserStorageUsage.objects.values('user_id')).order_by('pk')
+    rows = []
+    for user_id in missing.values_list('pk', flat=True).iterator():
+        usage = UserStorageUsage(user_id=user_id)
+        seen = set()
+        for model_name, (owner_field, fields) in MEDIA_FIELDS.items():
+            model = apps.get_model('projects', model_name)
+            for obj in model.objects.filter(**{owner_field: user_id}).only('pk', *fields).iterator():
+                for field_name, column in fields.items():
+                    field_file = getattr(obj, field_name)
+                    if not field_file or field_file.name in seen:
+                        # Shared content-addressed blobs count once per user
+                        continue
+                    seen.add(field_file.name)
+                    setattr(usage, column, getattr(usage, column) + _size(field_file))
+        usage.total_bytes = sum(getattr(usage, column) for column in
+                                ('image_bytes', 'video_bytes', 'audio_bytes', 'file_bytes', 'mockup_bytes'))
+        usage.quota_bytes = int(overrides.get(user_id) or default_mb) * 1024 * 1024
+        usage.percent_used = int(usage.total_bytes * 100 // usage.quota_bytes) if usage.quota_bytes > 0 else 0
+        rows.append(usage)
+        if len(rows) >= 500:
+            UserStorageUsage.objects.bulk_create(rows)
+            rows = []
+    UserStorageUsage.objects.bulk_create(rows)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('accounts', '0006_storagereservation'),
+        ('projects', '0011_packagemockup_render_queued_at'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.RunPython(backfill_usage, migrations.RunPython.noop),
+    ]
@@ -41,3 +41,53 @@ class UserStorageSettings(models.Model):
 
     def __str__(self):
         return f"StorageSettings({self.user.username}: {self.quota_mb or 'default'} MB)"
+
+
+class UserStorageUsage(models.Model):
+    """Running per-user byte totals, one column per media kind.
+
+    Kept current by the save/delete hooks in ``projects.signals`` so quota
+    checks never have to walk the user's media. ``quota_bytes`` and
+    ``percent_used`` are denormalized so the storage console can sort and
+    filter every user in one indexed query.
+    """
+    user = models.OneToOneField(User, on_delete=models.CASCADE, related_name='storage_usage')
+    image_bytes = models.BigIntegerField(default=0)
+    video_bytes = models.BigIntegerField(default=0)
+    audio_bytes = models.BigIntegerField(default=0)
+    file_bytes = models.BigIntegerField(default=0)
+    mockup_bytes = models.BigIntegerField(default=0)
+    total_bytes = models.BigIntegerField(default=0)
+    quota_bytes = models.BigIntegerField(default=0)
+    percent_used = models.IntegerField(default=0)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=["total_bytes"]),
+            models.Index(fields=["percent_used"]),
+            models.Index(fields=["image_bytes"]),
+            models.Index(fields=["video_bytes"]),
+            models.Index(fields=["audio_bytes"]),
+            models.Index(fields=["file_bytes"]),
+            models.Index(fields=["mockup_bytes"]),
+        ]
+
+    def __str__(self):
+        return f"StorageUsage({self.user.username}: {self.total_bytes} bytes)"
+
+
+class StorageReservation(models.Model):
+    """Bytes held against a user's quota while an upload is being processed."""
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='storage_reservations')
+    bytes = models.BigIntegerField()
+    created_at = models.DateTimeField(auto_now_add=True)
+    expires_at = models.DateTimeField()
+
+    class Meta:
+        indexes = [
+            models.Index(fields=["user", "expires_at"]),
+        ]
+
+    def __str__(self):
+        return f"StorageReservation({self.user.username}: {self.bytes} bytes until {self.expires_at:%H:%M:%S})"
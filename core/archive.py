@@ -0,0 +1,491 @@
+"""
+Cold archive of old request logs and device locations.
+
+``archive_telemetry()`` moves rows older than a cutoff out of the database
+into one segment file per kind per UTC day under ``TELEMETRY_ARCHIVE_DIR``
+(``<dir>/<kind>/<YYYY>/<YYYY-MM-DD>.seg``). Segments are column-oriented:
+numbers are packed ``array`` buffers and strings (path, route, user agent,
+country, IP, ...) are dictionary-encoded as integer codes plus a list of
+distinct values; every column is zlib-compressed separately, so a scan only
+inflates the columns it needs. Rows are written before they are deleted and
+segments remember row ids, so re-running after a failure does not duplicate
+anything. ``manage.py archive_telemetry`` and
+``core.tasks.archive_telemetry_task`` run it.
+
+``archive_summary()`` answers analytics questions for archived periods with
+whole-column (vectorised) scans: NumPy when it is installed, plain
+``array`` loops otherwise.
+
+File layout: ``MAGIC``, a 4-byte header length, a JSON header describing the
+columns, then the compressed column blobs.
+"""
+import datetime
+import json
+import logging
+import math
+import os
+import struct
+import sys
+import tempfile
+import zlib
+from array import array
+from collections import Counter
+
+from django.conf import settings
+from django.db import transaction
+
+from .models import DeviceLocation, RequestLog
+
+try:
+    import numpy as np
+except Exception:  # pragma: no cover - optional
+    np = None
+
+logger = logging.getLogger('security')
+
+MAGIC = b'TSEG1\n'
+_EPOCH = datetime.datetime(1970, 1, 1, tzinfo=datetime.timezone.utc)
+
+# (column, source field, type). 'ts' is microseconds since the epoch,
+# 'dict' a dictionary-encoded string, anything else an array typecode.
+# Nullable ints are stored as -1, nullable floats as NaN.
+COLUMNS = {
+    'requests': (
+        ('id', 'id', 'q'),
+        ('created_at', 'created_at', 'ts'),
+        ('method', 'method', 'dict'),
+        ('path', 'path', 'dict'),
+        ('route', 'route', 'dict'),
+        ('status', 'status', 'i'),
+        ('duration_ms', 'duration_ms', 'i'),
+        ('sample_weight', 'sample_weight', 'i'),
+        ('user_id', 'user_id', 'q'),
+        ('is_staff', 'user__is_staff', 'B'),
+        ('ip', 'ip', 'dict'),
+        ('country', 'country', 'dict'),
+        ('region', 'region', 'dict'),
+        ('city', 'city', 'dict'),
+        ('user_agent', 'user_agent', 'dict'),
+        ('sql_count', 'sql_count', 'i'),
+        ('sql_ms', 'sql_ms', 'd'),
+        ('cache_hits', 'cache_hits', 'i'),
+        ('cache_misses', 'cache_misses', 'i'),
+        ('cache_ms', 'cache_ms', 'd'),
+        ('template_ms', 'template_ms', 'd'),
+        ('media_ms', 'media_ms', 'd'),
+    ),
+    'locations': (
+        ('id', 'id', 'q'),
+        ('created_at', 'created_at', 'ts'),
+        ('user_id', 'user_id', 'q'),
+        ('latitude', 'latitude', 'd'),
+        ('longitude', 'longitude', 'd'),
+        ('accuracy_m', 'accuracy_m', 'd'),
+        ('ip', 'ip', 'dict'),
+        ('user_agent', 'user_agent', 'dict'),
+        ('geohash', 'geohash', 'dict'),
+        ('country', 'country', 'dict'),
+        ('region', 'region', 'dict'),
+        ('city', 'city', 'dict'),
+    ),
+}
+MODELS = {'requests': RequestLog, 'locations': DeviceLocation}
+
+_NUMPY_TYPES = {'q': '<i8', 'ts': '<i8', 'i': '<i4', 'B': 'u1', 'd': '<f8', 'dict': '<u4'}
+
+
+def archive_dir():
+    return str(getattr(settings, 'TELEMETRY_ARCHIVE_DIR', '') or os.path.join(settings.BASE_DIR, 'archive'))
+
+
+def floor_day(dt):
+    return dt.astimezone(datetime.timezone.utc).replace(hour=0, minute=0, second=0, microsecond=0)
+
+
+def to_micros(dt):
+    delta = dt - _EPOCH
+    return (delta.days * 86400 + delta.seconds) * 1000000 + delta.microseconds
+
+
+def segment_path(kind, day, root=None):
+    return os.path.join(root or archive_dir(), kind, f'{day:%Y}', f'{day:%Y-%m-%d}.seg')
+
+
+def _le_bytes(arr):
+    """Little-endian bytes of an ``array`` (segments are portable across hosts)."""
+    if sys.byteorder == 'big':
+        arr = array(arr.typecode, arr)
+        arr.byteswap()
+    return arr.tobytes()
+
+
+def _from_le_bytes(typecode, data):
+    arr = array(typecode)
+    arr.frombytes(data)
+    if sys.byteorder == 'big':
+        arr.byteswap()
+    return arr
+
+
+class _ColumnBuilder:
+    def __init__(self, ctype):
+        self.ctype = ctype
+        self.values = array('I' if ctype == 'dict' else 'q' if ctype == 'ts' else ctype)
+        self.dictionary = []
+        self.codes = {}
+
+    def append(self, value):
+        if self.ctype == 'dict':
+            value = '' if value is None else str(value)
+            code = self.codes.get(value)
+            if code is None:
+                code = self.codes[value] = len(self.dictionary)
+                self.dictionary.append(value)
+            self.values.append(code)
+        elif self.ctype == 'ts':
+            self.values.append(to_micros(value))
+        elif self.ctype == 'd':
+            self.values.append(math.nan if value is None else float(value))
+        elif self.ctype == 'B':
+            self.values.append(1 if value else 0)
+        else:
+            self.values.append(-1 if value is None else int(value))
+
+    def extend_from(self, segment, name):
+        if self.ctype == 'dict' and name not in segment.header['columns']:
+            # Segment written before the column was archived
+            for _ in range(segment.rows):
+                self.append('')
+        elif self.ctype == 'dict':
+            codes, dictionary = segment.dict_column(name)
+            for code in codes:
+                self.append(dictionary[code])
+        else:
+            self.values.extend(segment.raw_column(name))
+
+
+class Segment:
+    """Read access to one segment file; columns are inflated on demand."""
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as f:
+            if f.read(len(MAGIC)) != MAGIC:
+                raise ValueError(f'Not a telemetry segment: {path}')
+            (length,) = struct.unpack('>I', f.read(4))
+            self.header = json.loads(f.read(length).decode('utf-8'))
+            self._data_start = f.tell()
+        self.rows = self.header['rows']
+        self.kind = self.header['kind']
+        self.day = datetime.datetime.fromisoformat(self.header['day'])
+
+    def _blob(self, offset, length):
+        with open(self.path, 'rb') as f:
+            f.seek(self._data_start + offset)
+            return zlib.decompress(f.read(length))
+
+    def _meta(self, name):
+        try:
+            return self.header['columns'][name]
+        except KeyError:
+            raise KeyError(f'Segment has no column {name!r}')
+
+    def raw_column(self, name):
+        """The column as an ``array`` (dictionary codes for string columns)."""
+        meta = self._meta(name)
+        return _from_le_bytes(meta['typecode'], self._blob(meta['offset'], meta['length']))
+
+    def dict_column(self, name):
+        """``(codes, dictionary)`` of a dictionary-encoded string column."""
+        meta = self._meta(name)
+        dictionary = json.loads(self._blob(*meta['dict']).decode('utf-8'))
+        return self.raw_column(name), dictionary
+
+    def column(self, name):
+        """The column as a NumPy array when available, else the ``array``."""
+        meta = self._meta(name)
+        if np is None:
+            return self.raw_column(name)
+        return np.frombuffer(self._blob(meta['offset'], meta['length']), dtype=_NUMPY_TYPES[meta['ctype']])
+
+
+def write_segment(path, kind, day, builders):
+    """Write ``builders`` (column name -> _ColumnBuilder) atomically to ``path``."""
+    blobs, columns, offset = [], {}, 0
+    rows = 0
+    for name, builder in builders.items():
+        rows = len(builder.values)
+        data = zlib.compress(_le_bytes(builder.values), 6)
+        meta = {'ctype': builder.ctype, 'typecode': builder.values.typecode, 'offset': offset, 'length': len(data)}
+        blobs.append(data)
+        offset += len(data)
+        if builder.ctype == 'dict':
+            words = zlib.compress(json.dumps(builder.dictionary, separators=(',', ':')).encode('utf-8'), 6)
+            meta['dict'] = [offset, len(words)]
+            blobs.append(words)
+            offset += len(words)
+        columns[name] = meta
+    header = json.dumps({'kind': kind, 'day': day.isoformat(), 'rows': rows, 'columns': columns}).encode('utf-8')
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(MAGIC)
+            f.write(struct.pack('>I', len(header)))
+            f.write(header)
+            for blob in blobs:
+                f.write(blob)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, path)
+    except Exception:
+        try:
+            os.remove(tmp)
+        except OSError:
+            pass
+        raise
+    return rows
+
+
+def archive_day(kind, day, chunk_size=5000, root=None):
+    """Append the rows of ``kind`` created on ``day`` to its segment; returns rows added."""
+    model = MODELS[kind]
+    spec = COLUMNS[kind]
+    path = segment_path(kind, day, root)
+    builders = {name: _ColumnBuilder(ctype) for name, _, ctype in spec}
+    seen = set()
+    if os.path.exists(path):
+        existing = Segment(path)
+        for name, builder in builders.items():
+            builder.extend_from(existing, name)
+        seen = set(existing.raw_column('id'))
+    qs = (model.objects.filter(created_at__gte=day, created_at__lt=day + datetime.timedelta(days=1))
+          .order_by('created_at', 'pk').values_list(*[field for _, field, _ in spec]))
+    added = 0
+    for row in qs.iterator(chunk_size=chunk_size):
+        if row[0] in seen:
+            continue
+        for (name, _, _), value in zip(spec, row):
+            builders[name].append(value)
+        added += 1
+    if added:
+        write_segment(path, kind, day, builders)
+    return added
+
+
+def _delete_before(model, cutoff, chunk_size):
+    deleted = 0
+    qs = model.objects.filter(created_at__lt=cutoff)
+    while True:
+        ids = list(qs.values_list('pk', flat=True)[:chunk_size])
+        if not ids:
+            return deleted
+        with transaction.atomic():
+            n, _ = model.objects.filter(pk__in=ids).delete()
+        deleted += n
+
+
+def archive_telemetry(kind, cutoff, chunk_size=5000, root=None, delete=True):
+    """
+    Move rows of ``kind`` created before the UTC day containing ``cutoff``
+    into segment files, then delete them from the database. Request logs
+    are only archived up to the rollup watermark (and before any hour still
+    waiting for a re-roll), so the hourly rollups never miss rows; nothing is
+    archived before the first rollup has run.
+    Returns ``{'days': n, 'archived': n, 'deleted': n}``.
+    """
+    model = MODELS[kind]
+    cutoff = floor_day(cutoff)
+    if kind == 'requests':
+        from .rollups import ROLLUP_NAME
+        from .models import RollupDirtyHour, RollupState
+        watermark = RollupState.objects.filter(name=ROLLUP_NAME).values_list('watermark', flat=True).first()
+        if watermark is None:
+            logger.warning("Not archiving request logs: they have not been rolled up yet (run build_rollups)")
+            return {'days': 0, 'archived': 0, 'deleted': 0}
+        dirty = RollupDirtyHour.objects.order_by('bucket').values_list('bucket', flat=True).first()
+        cutoff = min(cutoff, floor_day(watermark), floor_day(dirty) if dirty else cutoff)
+    days = archived = 0
+    pending = model.objects.filter(created_at__lt=cutoff)
+    first = pending.order_by('created_at').values_list('created_at', flat=True).first()
+    while first is not None:
+        day = floor_day(first)
+        archived += archive_day(kind, day, chunk_size=chunk_size, root=root)
+        days += 1
+        first = (pending.filter(created_at__gte=day + datetime.timedelta(days=1))
+                 .order_by('created_at').values_list('created_at', flat=True).first())
+    deleted = 0
+    if delete and days:
+        if kind == 'requests':
+            from .retention import purge_request_logs
+            deleted = purge_request_logs(cutoff, chunk_size=chunk_size)['deleted_rows']
+        else:
+            deleted = _delete_before(model, cutoff, chunk_size)
+        logger.info(f"Archived {archived} {kind} rows over {days} days before {cutoff:%Y-%m-%d}")
+    return {'days': days, 'archived': archived, 'deleted': deleted}
+
+
+def segments(kind, since=None, until=None, root=None):
+    """Segments of ``kind`` whose day overlaps ``[since, until)``, oldest first."""
+    base = os.path.join(root or archive_dir(), kind)
+    if not os.path.isdir(base):
+        return []
+    lo = floor_day(since) if since else None
+    found = []
+    for year in sorted(os.listdir(base)):
+        ydir = os.path.join(base, year)
+        if not os.path.isdir(ydir):
+            continue
+        for name in sorted(os.listdir(ydir)):
+            if not name.endswith('.seg'):
+                continue
+            try:
+                day = datetime.datetime.strptime(name[:-4], '%Y-%m-%d').replace(tzinfo=datetime.timezone.utc)
+            except ValueError:
+                continue
+            if (lo and day < lo) or (until and day >= until):
+                continue
+            found.append(os.path.join(ydir, name))
+    return found
+
+
+def _is_i18n(path):
+    from .rollups import _LANG_PREFIX
+    return path.startswith('/i18n/') or bool(_LANG_PREFIX.match(path))
+
+
+def _scan_numpy(seg, lo, hi, exclude_staff, hide_i18n):
+    ts = seg.column('created_at')
+    mask = (ts >= lo) & (ts < hi)
+    if exclude_staff:
+        mask &= seg.column('is_staff') == 0
+    if hide_i18n:
+        codes, words = seg.dict_column('path')
+        lut = np.fromiter((_is_i18n(p) for p in words), dtype=bool, count=len(words))
+        mask &= ~lut[np.frombuffer(codes, dtype=np.uint32)]
+    if not mask.any():
+        return None
+    weight = seg.column('sample_weight')[mask].astype('i8')
+    err = seg.column('status')[mask] >= 400
+    out = {'total': int(weight.sum()), 'errors': int(weight[err].sum())}
+    for name in ('route', 'country'):
+        codes, words = seg.dict_column(name)
+        codes = np.frombuffer(codes, dtype=np.uint32)[mask]
+        counts = np.bincount(codes, weights=weight, minlength=len(words))
+        errors = np.bincount(codes[err], weights=weight[err], minlength=len(words))
+        out[name] = {words[i]: (int(counts[i]), int(errors[i])) for i in np.nonzero(counts)[0]}
+    codes, words = seg.dict_column('ip')
+    out['ips'] = {words[i] for i in np.unique(np.frombuffer(codes, dtype=np.uint32)[mask])}
+    users = seg.column('user_id')[mask]
+    out['users'] = set(np.unique(users[users >= 0]).tolist())
+    out['day'] = seg.day
+    return out
+
+
+def _scan_python(seg, lo, hi, exclude_staff, hide_i18n):
+    ts = seg.raw_column('created_at')
+    keep = [lo <= t < hi for t in ts]
+    if exclude_staff:
+        keep = [k and not s for k, s in zip(keep, seg.raw_column('is_staff'))]
+    if hide_i18n:
+        codes, words = seg.dict_column('path')
+        lut = [_is_i18n(p) for p in words]
+        keep = [k and not lut[c] for k, c in zip(keep, codes)]
+    if not any(keep):
+        return None
+    weight = seg.raw_column('sample_weight')
+    status = seg.raw_column('status')
+    rows = [(i, weight[i], status[i] >= 400) for i, k in enumerate(keep) if k]
+    out = {'total': sum(w for _, w, _ in rows), 'errors': sum(w for _, w, e in rows if e)}
+    for name in ('route', 'country'):
+        codes, words = seg.dict_column(name)
+        counts = Counter()
+        errors = Counter()
+        for i, w, e in rows:
+            counts[codes[i]] += w
+            if e:
+                errors[codes[i]] += w
+        out[name] = {words[c]: (n, errors[c]) for c, n in counts.items()}
+    codes, words = seg.dict_column('ip')
+    out['ips'] = {words[codes[i]] for i, _, _ in rows}
+    users = seg.raw_column('user_id')
+    out['users'] = {users[i] for i, _, _ in rows if users[i] >= 0}
+    out['day'] = seg.day
+    return out
+
+
+def archive_summary(since, until, exclude_staff=False, hide_i18n=False, limit=10, root=None):
+    """
+    Request totals for ``[since, until)`` from archived segments, in the
+    shape the analytics page uses. Distinct counts are exact. Returns None
+    when nothing is archived for the period.
+    """
+    scan = _scan_numpy if np is not None else _scan_python
+    lo, hi = to_micros(since), to_micros(until)
+    total = errors = 0
+    routes, countries = {}, Counter()
+    ips, users, per_day = set(), set(), []
+    found = False
+    for path in segments('requests', since, until, root):
+        part = scan(Segment(path), lo, hi, exclude_staff, hide_i18n)
+        if part is None:
+            continue
+        found = True
+        total += part['total']
+        errors += part['errors']
+        for route, (n, e) in part['route'].items():
+            r = routes.setdefault(route, [0, 0])
+            r[0] += n
+            r[1] += e
+        for country, (n, _) in part['country'].items():
+            countries[country] += n
+        ips |= part['ips']
+        users |= part['users']
+        per_day.append({'d': part['day'], 'count': part['total']})
+    if not found:
+        return None
+    top = sorted(routes.items(), key=lambda kv: -kv[1][0])[:limit]
+    return {
+        'total_requests': total,
+        'errors': errors,
+        'error_rate': round(errors * 100.0 / total, 2) if total else 0.0,
+        'unique_ips': len(ips - {''}),
+        'unique_users': len(users),
+        'top_paths': [
+            {'path': route or '-', 'count': n, 'errors': e, 'error_rate': round(e * 100.0 / n, 1) if n else 0.0}
+            for route, (n, e) in top
+        ],
+        'by_country': [{'country': c, 'count': n} for c, n in countries.most_common(limit)],
+        'per_day': per_day,
+    }
+
+
+def iter_rows(kind, since=None, until=None, columns=None, root=None):
+    """Archived rows of ``kind`` in ``[since, until)`` as dicts (for exports and one-off reports)."""
+    names = columns or [name for name, _, _ in COLUMNS[kind]]
+    types = {name: ctype for name, _, ctype in COLUMNS[kind]}
+    lo = to_micros(since) if since else None
+    hi = to_micros(until) if until else None
+    for path in segments(kind, since, until, root):
+        seg = Segment(path)
+        ts = seg.raw_column('created_at')
+        cols = {}
+        for name in names:
+            if types[name] == 'dict' and name not in seg.header['columns']:
+                # Segment written before the column was archived
+                cols[name] = [''] * seg.rows
+            elif types[name] == 'dict':
+                codes, words = seg.dict_column(name)
+                cols[name] = [words[c] for c in codes]
+            else:
+                cols[name] = seg.raw_column(name)
+        for i, t in enumerate(ts):
+            if (lo is not None and t < lo) or (hi is not None and t >= hi):
+                continue
+            row = {}
+            for name in names:
+                value = cols[name][i]
+                if types[name] == 'ts':
+                    value = _EPOCH + datetime.timedelta(microseconds=value)
+                row[name] = value
+            yield row
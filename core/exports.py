@@ -0,0 +1,133 @@
+"""
+Streaming exports of raw request logs and device locations.
+
+Rows are read with ``.values_list(...).iterator(chunk_size=...)`` and turned
+into CSV or NDJSON lines one at a time, optionally gzip-compressed as they
+go, so an export of any size runs in constant memory. The staff view
+(``core.views.admin_export``) wraps the generator in a
+``StreamingHttpResponse``; ``manage.py export_analytics`` writes it to a file.
+Filters mirror the analytics page: ``period`` in days, ``exclude_staff`` and
+``hide_i18n``. CSV text cells that a spreadsheet would run as a formula
+(user agents, paths, place names) are prefixed with ``'``.
+"""
+import csv
+import datetime
+import decimal
+import json
+import zlib
+
+from .models import DeviceLocation, RequestLog
+from .rollups import I18N_Q
+
+CHUNK_SIZE = 2000
+FORMATS = ('csv', 'ndjson')
+# Leading characters that make spreadsheet apps evaluate a cell
+FORMULA_PREFIXES = ('=', '+', '-', '@', '\t', '\r')
+
+EXPORTS = {
+    'requests': (RequestLog, (
+        'id', 'created_at', 'method', 'path', 'route', 'status', 'duration_ms',
+        'sample_weight', 'user_id', 'user__username', 'ip', 'country', 'region',
+        'city', 'user_agent', 'sql_count', 'sql_ms', 'cache_hits', 'cache_misses',
+        'cache_ms', 'template_ms', 'media_ms',
+    )),
+    'locations': (DeviceLocation, (
+        'id', 'created_at', 'user_id', 'user__username', 'latitude', 'longitude',
+        'accuracy_m', 'geohash', 'country', 'region', 'city', 'ip', 'user_agent',
+    )),
+}
+
+
+def export_queryset(kind, since=None, exclude_staff=False, hide_i18n=False):
+    """The filtered ``values_list`` queryset and column names for ``kind``."""
+    model, fields = EXPORTS[kind]
+    qs = model.objects.all()
+    if since is not None:
+        qs = qs.filter(created_at__gte=since)
+    if exclude_staff:
+        qs = qs.exclude(user__is_staff=True)
+    if hide_i18n and model is RequestLog:
+        qs = qs.exclude(I18N_Q)
+    columns = [f.replace('user__', '') for f in fields]
+    return qs.order_by('created_at', 'pk').values_list(*fields), columns
+
+
+def _plain(value):
+    if isinstance(value, datetime.datetime):
+        return value.isoformat()
+    if isinstance(value, decimal.Decimal):
+        return float(value)
+    return value
+
+
+class _Echo:
+    """File-like object for ``csv.writer`` that hands back each line."""
+    def write(self, value):
+        return value
+
+
+def _csv_cell(value):
+    if value is None:
+        return ''
+    if isinstance(value, str) and value.startswith(FORMULA_PREFIXES):
+        return "'" + value
+    return _plain(value)
+
+
+def csv_lines(rows, fields):
+    writer = csv.writer(_Echo())
+    yield writer.writerow(fields)
+    for row in rows:
+        yield writer.writerow([_csv_cell(v) for v in row])
+
+
+def ndjson_lines(rows, fields):
+    for row in rows:
+        yield json.dumps({f: _plain(v) for f, v in zip(fields, row)}, separators=(',', ':')) + '\n'
+
+
+def gzip_stream(chunks, level=6, flush_bytes=64 * 1024):
+    """Gzip ``chunks`` (str) on the fly, emitting compressed blocks of about ``flush_bytes``."""
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 31)
+    pending = []
+    size = 0
+    for chunk in chunks:
+        data = compressor.compress(chunk.encode('utf-8'))
+        if data:
+            pending.append(data)
+            size += len(data)
+        if size >= flush_bytes:
+            yield b''.join(pending)
+            pending, size = [], 0
+    pending.append(compressor.flush())
+    yield b''.join(pending)
+
+
+def _batched(chunks, batch_bytes=64 * 1024):
+    """Join small lines into larger blocks so the response isn't written line by line."""
+    pending = []
+    size = 0
+    for chunk in chunks:
+        pending.append(chunk)
+        size += len(chunk)
+        if size >= batch_bytes:
+            yield ''.join(pending).encode('utf-8')
+            pending, size = [], 0
+    if pending:
+        yield ''.join(pending).encode('utf-8')
+
+
+def stream_export(kind, fmt='csv', compress=False, since=None, exclude_staff=False,
+                  hide_i18n=False, chunk_size=CHUNK_SIZE):
+    """A generator of ``bytes`` for the export; nothing is read until it is iterated."""
+    if fmt not in FORMATS:
+        raise ValueError(f'Unknown export format: {fmt}')
+    qs, fields = export_queryset(kind, since, exclude_staff, hide_i18n)
+    rows = qs.iterator(chunk_size=chunk_size)
+    lines = csv_lines(rows, fields) if fmt == 'csv' else ndjson_lines(rows, fields)
+    return gzip_stream(lines) if compress else _batched(lines)
+
+
+def export_filename(kind, fmt, compress=False, now=None):
+    now = now or datetime.datetime.now(datetime.timezone.utc)
+    return f"{kind}-{now:%Y%m%d-%H%M}.{fmt}" + ('.gz' if compress else '')
@@ -0,0 +1,102 @@
+"""
+Offline GeoIP enrichment for request logs.
+
+One ``GeoIP2`` reader is opened per process and reused; results are kept in an
+LRU cache keyed by IP, so a busy client costs one mmdb lookup rather than one
+per request. Lookups run in the request-log flusher (``core.logsink``) and in
+``manage.py enrich_request_logs``, never on the request path.
+"""
+import logging
+import threading
+from collections import OrderedDict
+
+from django.conf import settings
+
+logger = logging.getLogger('security')
+
+EMPTY = ('', '', '')
+
+
+class GeoResolver:
+    """Resolve IPs to ``(country, region, city)`` through a long-lived reader."""
+
+    def __init__(self, cache_size=50000):
+        self.cache_size = max(0, int(cache_size))
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+        self._reader = None
+        self._unavailable = False
+        self.hits = 0
+        self.misses = 0
+
+    def _get_reader(self):
+        if self._reader is None and not self._unavailable:
+            try:
+                from django.contrib.gis.geoip2 import GeoIP2
+                self._reader = GeoIP2()
+            except Exception as e:
+                # No geoip2 package or no database: enrichment becomes a no-op
+                self._unavailable = True
+                logger.info(f"GeoIP enrichment disabled: {e}")
+        return self._reader
+
+    def _lookup(self, ip):
+        reader = self._get_reader()
+        if reader is None:
+            return EMPTY
+        try:
+            info = reader.city(ip)
+        except Exception:
+            return EMPTY
+        return (
+            (info.get('country_name') or '')[:64],
+            (info.get('region') or '')[:128],
+            (info.get('city') or '')[:128],
+        )
+
+    def resolve(self, ip):
+        if not ip:
+            return EMPTY
+        with self._lock:
+            hit = self._cache.get(ip)
+            if hit is not None:
+                self._cache.move_to_end(ip)
+                self.hits += 1
+                return hit
+        value = self._lookup(ip)
+        with self._lock:
+            self.misses += 1
+            if self.cache_size:
+                self._cache[ip] = value
+                self._cache.move_to_end(ip)
+                while len(self._cache) > self.cache_size:
+                    self._cache.popitem(last=False)
+        return value
+
+    def resolve_many(self, ips):
+        """``{ip: (country, region, city)}`` for the distinct IPs given."""
+        return {ip: self.resolve(ip) for ip in set(ips) if ip}
+
+
+_resolver = None
+_resolver_lock = threading.Lock()
+
+
+def get_resolver():
+    global _resolver
+    if _resolver is None:
+        with _resolver_lock:
+            if _resolver is None:
+                _resolver = GeoResolver(getattr(settings, 'GEOIP_CACHE_SIZE', 50000))
+    return _resolver
+
+
+def enrich_entries(entries):
+    """Fill country/region/city on RequestLog entry dicts that have an IP but no geo."""
+    pending = [e for e in entries if e.get('ip') and not e.get('country')]
+    if not pending:
+        return entries
+    geo = get_resolver().resolve_many(e['ip'] for e in pending)
+    for entry in pending:
+        entry['country'], entry['region'], entry['city'] = geo.get(entry['ip'], EMPTY)
+    return entries
@@ -0,0 +1,75 @@
+"""
+Geohash encoding for device locations.
+
+A geohash interleaves longitude and latitude bits into a base-32 string;
+every character narrows the cell, and all points in a cell share the prefix.
+``DeviceLocation.geohash`` stores ``PRECISION`` characters (about 4.8 m x
+4.8 m), so grouping by the first ``p`` characters aggregates fixes into a
+grid at any coarser precision with a plain GROUP BY.
+"""
+PRECISION = 9
+_BASE32 = '0123456789bcdefghjkmnpqrstuvwxyz'
+_DECODE = {c: i for i, c in enumerate(_BASE32)}
+
+
+def encode(latitude, longitude, precision=PRECISION):
+    lat_lo, lat_hi = -90.0, 90.0
+    lon_lo, lon_hi = -180.0, 180.0
+    chars = []
+    bits = 0
+    value = 0
+    even = True
+    while len(chars) < precision:
+        if even:
+            mid = (lon_lo + lon_hi) / 2
+            if longitude >= mid:
+                value = (value << 1) | 1
+                lon_lo = mid
+            else:
+                value <<= 1
+                lon_hi = mid
+        else:
+            mid = (lat_lo + lat_hi) / 2
+            if latitude >= mid:
+                value = (value << 1) | 1
+                lat_lo = mid
+            else:
+                value <<= 1
+                lat_hi = mid
+        even = not even
+        bits += 1
+        if bits == 5:
+            chars.append(_BASE32[value])
+            bits = value = 0
+    return ''.join(chars)
+
+
+def bounds(geohash):
+    """``(south, west, north, east)`` of the cell."""
+    lat_lo, lat_hi = -90.0, 90.0
+    lon_lo, lon_hi = -180.0, 180.0
+    even = True
+    for c in geohash:
+        value = _DECODE[c]
+        for shift in range(4, -1, -1):
+            bit = (value >> shift) & 1
+            if even:
+                mid = (lon_lo + lon_hi) / 2
+                if bit:
+                    lon_lo = mid
+                else:
+                    lon_hi = mid
+            else:
+                mid = (lat_lo + lat_hi) / 2
+                if bit:
+                    lat_lo = mid
+                else:
+                    lat_hi = mid
+            even = not even
+    return lat_lo, lon_lo, lat_hi, lon_hi
+
+
+def decode(geohash):
+    """Centre ``(latitude, longitude)`` of the cell."""
+    south, west, north, east = bounds(geohash)
+    return (south + north) / 2, (west + east) / 2
@@ -0,0 +1,145 @@
+"""
+Per-route latency histograms.
+
+Durations are counted into fixed, log-scaled buckets (each about 10% wider
+than the last, HDR-style), one sparse histogram per route per hour in
+``LatencyHistogram``. The request-log flusher feeds them as it writes each
+batch. Percentiles for any period come from summing bucket counts and walking
+the cumulative distribution; no raw rows are read or sorted. Reported values
+are bucket upper bounds, so they overstate the true percentile by at most
+about 10%.
+"""
+import datetime
+import math
+
+from django.db import transaction
+from django.utils import timezone
+
+from .models import LatencyHistogram
+
+GROWTH = 1.1
+MAX_MS = 120000
+BUCKETS = int(math.ceil(math.log(MAX_MS) / math.log(GROWTH))) + 2
+_LOG_GROWTH = math.log(GROWTH)
+
+# A route is flagged when its recent p95 is this much above its baseline
+REGRESSION_RATIO = 1.25
+REGRESSION_MIN_COUNT = 20
+
+
+def bucket_index(ms):
+    """Bucket 0 holds ``[0, 1)`` ms; bucket ``i`` holds ``[1.1**(i-1), 1.1**i)``."""
+    if ms < 1:
+        return 0
+    return min(BUCKETS - 1, int(math.log(ms) / _LOG_GROWTH) + 1)
+
+
+def bucket_upper_ms(index):
+    return GROWTH ** index if index else 1.0
+
+
+def percentile(counts, q, total=None):
+    """The ``q`` (0-100) percentile of a ``{bucket: count}`` histogram, in ms."""
+    if total is None:
+        total = sum(counts.values())
+    if not total:
+        return None
+    rank = max(1, int(math.ceil(total * q / 100.0)))
+    seen = 0
+    for index in sorted(counts):
+        seen += counts[index]
+        if seen >= rank:
+            return round(bucket_upper_ms(index), 1)
+    return round(bucket_upper_ms(max(counts)), 1)
+
+
+def merge_counts(target, counts):
+    for index, n in counts.items():
+        index = int(index)
+        target[index] = target.get(index, 0) + n
+    return target
+
+
+def record_latencies(entries):
+    """Add the durations of RequestLog entry dicts to their hourly route histograms."""
+    from .rollups import floor_hour
+    groups = {}
+    for entry in entries:
+        created = entry.get('created_at') or timezone.now()
+        key = (floor_hour(created), entry.get('route') or '')
+        g = groups.setdefault(key, {'counts': {}, 'count': 0, 'sum': 0, 'max': 0})
+        ms = max(0, int(entry.get('duration_ms') or 0))
+        weight = int(entry.get('sample_weight') or 1)
+        index = bucket_index(ms)
+        g['counts'][index] = g['counts'].get(index, 0) + weight
+        g['count'] += weight
+        g['sum'] += ms * weight
+        g['max'] = max(g['max'], ms)
+    # Create missing rows up front (ON CONFLICT DO NOTHING), so concurrent
+    # flushers only ever lock and update existing rows
+    LatencyHistogram.objects.bulk_create(
+        [LatencyHistogram(bucket=hour, route=route) for hour, route in groups], ignore_conflicts=True,
+    )
+    for (hour, route), g in sorted(groups.items(), key=lambda kv: kv[0]):
+        with transaction.atomic():
+            row = LatencyHistogram.objects.select_for_update().get(bucket=hour, route=route)
+            counts = merge_counts({int(k): v for k, v in (row.counts or {}).items()}, g['counts'])
+            row.counts = {str(k): v for k, v in counts.items()}
+            row.count += g['count']
+            row.sum_ms += g['sum']
+            row.max_ms = max(row.max_ms, g['max'])
+            row.save(update_fields=['counts', 'count', 'sum_ms', 'max_ms'])
+
+
+def _route_histograms(qs):
+    merged = {}
+    for route, counts, count, sum_ms, max_ms in qs.values_list('route', 'counts', 'count', 'sum_ms', 'max_ms').iterator():
+        m = merged.setdefault(route, {'counts': {}, 'count': 0, 'sum': 0, 'max': 0})
+        merge_counts(m['counts'], counts or {})
+        m['count'] += count
+        m['sum'] += sum_ms
+        m['max'] = max(m['max'], max_ms)
+    return merged
+
+
+def latency_summary(since, limit=20, recent_hours=24):
+    """
+    p50/p95/p99 per route over ``[since, now)``, busiest routes first, with
+    the last ``recent_hours`` compared against the rest of the period to
+    spot regressions.
+    """
+    from .rollups import floor_hour
+    now = timezone.now()
+    split = floor_hour(now - datetime.timedelta(hours=recent_hours))
+    qs = LatencyHistogram.objects.filter(bucket__gte=floor_hour(since))
+    overall = _route_histograms(qs)
+    recent = _route_histograms(qs.filter(bucket__gte=split))
+    baseline = _route_histograms(qs.filter(bucket__lt=split)) if floor_hour(since) < split else {}
+
+    rows = []
+    for route, h in sorted(overall.items(), key=lambda kv: -kv[1]['count'])[:limit]:
+        row = {
+            'route': route or '-',
+            'count': h['count'],
+            'avg': round(h['sum'] / h['count'], 1) if h['count'] else None,
+            'p50': percentile(h['counts'], 50, h['count']),
+            'p95': percentile(h['counts'], 95, h['count']),
+            'p99': percentile(h['counts'], 99, h['count']),
+            'max': h['max'],
+            'recent_p95': None,
+            'baseline_p95': None,
+            'change_pct': None,
+            'regressed': False,
+        }
+        r, b = recent.get(route), baseline.get(route)
+        if r and b:
+            row['recent_p95'] = percentile(r['counts'], 95, r['count'])
+            row['baseline_p95'] = percentile(b['counts'], 95, b['count'])
+            if row['baseline_p95']:
+                row['change_pct'] = round((row['recent_p95'] / row['baseline_p95'] - 1) * 100, 1)
+            row['regressed'] = (
+                r['count'] >= REGRESSION_MIN_COUNT and b['count'] >= REGRESSION_MIN_COUNT
+                and row['recent_p95'] >= row['baseline_p95'] * REGRESSION_RATIO
+            )
+        rows.append(row)
+    return rows
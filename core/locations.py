@@ -0,0 +1,191 @@
+"""
+Device location ingest.
+
+Browsers report fixes in batches (``core.views.api_device_locations``). A fix
+is stored only if the device has moved since the last stored point, or if
+enough time has passed to be worth a heartbeat. Moving means being further
+than ``DEVICE_LOCATION_MIN_DISTANCE_M`` away, and further than the two
+fixes' combined accuracy radius (scaled by ``DEVICE_LOCATION_ACCURACY_FACTOR``),
+so GPS jitter around a stationary device is not recorded as movement.
+Kept fixes are written with one ``bulk_create``, each with its geohash and
+nearest place (``core.places``, once its index is loaded).
+
+``heatmap_cells()`` aggregates fixes into geohash grid cells with a GROUP BY
+on a prefix of the stored geohash, so map payloads grow with the number of
+cells, not points.
+"""
+import datetime
+import math
+
+from django.conf import settings
+from django.db.models import Count
+from django.db.models.functions import Left
+from django.utils import timezone
+
+from . import geohash
+from .models import DeviceLocation
+
+EARTH_RADIUS_M = 6371008.8
+
+
+def haversine_m(lat1, lon1, lat2, lon2):
+    """Great-circle distance in metres."""
+    p1, p2 = math.radians(lat1), math.radians(lat2)
+    dp = p2 - p1
+    dl = math.radians(lon2 - lon1)
+    a = math.sin(dp / 2) ** 2 + math.cos(p1) * math.cos(p2) * math.sin(dl / 2) ** 2
+    return 2 * EARTH_RADIUS_M * math.asin(min(1.0, math.sqrt(a)))
+
+
+def _setting(name, default):
+    return getattr(settings, name, default)
+
+
+def parse_fix(data, now=None):
+    """
+    ``(latitude, longitude, accuracy_m, timestamp)`` from a client fix dict,
+    or None if it is unusable. ``ts`` may be epoch milliseconds (as in
+    ``GeolocationPosition.timestamp``), epoch seconds or ISO 8601; fixes in
+    the future are clamped to now.
+    """
+    now = now or timezone.now()
+    try:
+        lat = float(data.get('latitude', data.get('lat')))
+        lng = float(data.get('longitude', data.get('lon', data.get('lng'))))
+    except (TypeError, ValueError, AttributeError):
+        return None
+    if not (-90 <= lat <= 90 and -180 <= lng <= 180) or math.isnan(lat) or math.isnan(lng):
+        return None
+    acc = data.get('accuracy', data.get('accuracy_m'))
+    try:
+        acc = float(acc) if acc not in (None, '') else None
+    except (TypeError, ValueError):
+        acc = None
+    if acc is not None and (math.isnan(acc) or acc < 0):
+        acc = None
+    ts = data.get('ts', data.get('timestamp'))
+    when = now
+    if isinstance(ts, (int, float)) and not isinstance(ts, bool):
+        seconds = ts / 1000.0 if ts > 1e11 else float(ts)
+        try:
+            when = datetime.datetime.fromtimestamp(seconds, tz=datetime.timezone.utc)
+        except (OverflowError, OSError, ValueError):
+            return None
+    elif isinstance(ts, str) and ts:
+        try:
+            when = datetime.datetime.fromisoformat(ts.replace('Z', '+00:00'))
+        except ValueError:
+            return None
+        if timezone.is_naive(when):
+            when = timezone.make_aware(when, datetime.timezone.utc)
+    return lat, lng, acc, min(when, now)
+
+
+def is_new_point(prev, lat, lng, acc, when):
+    """Whether a fix is worth storing after ``prev`` ``(lat, lng, acc, when)``."""
+    if prev is None:
+        return True
+    p_lat, p_lng, p_acc, p_when = prev
+    if abs((when - p_when).total_seconds()) >= _setting('DEVICE_LOCATION_MIN_INTERVAL_SECONDS', 1800):
+        return True
+    threshold = max(
+        _setting('DEVICE_LOCATION_MIN_DISTANCE_M', 50),
+        _setting('DEVICE_LOCATION_ACCURACY_FACTOR', 1.0) * math.hypot(p_acc or 0.0, acc or 0.0),
+    )
+    return haversine_m(p_lat, p_lng, lat, lng) > threshold
+
+
+def ingest_fixes(user, fixes, ip=None, user_agent='', now=None):
+    """
+    Store the fixes (dicts from the client) that differ enough from the
+    previous stored point. Fixes no newer than that point are dropped, so a
+    batch re-sent after a lost response is not stored twice. Returns
+    ``(stored, dropped)``.
+    """
+    now = now or timezone.now()
+    max_age = datetime.timedelta(seconds=_setting('DEVICE_LOCATION_MAX_AGE_SECONDS', 86400))
+    parsed = []
+    for data in list(fixes)[:_setting('DEVICE_LOCATION_BATCH_MAX', 100)]:
+        fix = parse_fix(data, now) if isinstance(data, dict) else None
+        if fix is not None and now - fix[3] <= max_age:
+            parsed.append(fix)
+    parsed.sort(key=lambda f: f[3])
+    dropped = len(fixes) - len(parsed)
+
+    last = (DeviceLocation.objects.filter(user=user)
+            .order_by('-created_at').values_list('latitude', 'longitude', 'accuracy_m', 'created_at').first())
+    prev = (float(last[0]), float(last[1]), last[2], last[3]) if last else None
+    rows = []
+    for lat, lng, acc, when in parsed:
+        if (prev is not None and when <= prev[3]) or not is_new_point(prev, lat, lng, acc, when):
+            dropped += 1
+            continue
+        rows.append(DeviceLocation(
+            user=user,
+            latitude=round(lat, 6),
+            longitude=round(lng, 6),
+            accuracy_m=acc,
+            ip=ip,
+            user_agent=(user_agent or '')[:256],
+            geohash=geohash.encode(lat, lng),
+            created_at=when,
+        ))
+        prev = (lat, lng, acc, when)
+    if rows and getattr(settings, 'PLACES_RESOLVE_ON_INGEST', True):
+        from .places import get_geocoder
+        geocoder = get_geocoder()
+        # Building the index is startup work; without it places are back-filled later
+        if geocoder.loaded:
+            labels = geocoder.resolve_many([(float(r.latitude), float(r.longitude)) for r in rows])
+            for row, (country, region, city) in zip(rows, labels):
+                row.country, row.region, row.city = country, region, city
+    if rows:
+        DeviceLocation.objects.bulk_create(rows)
+    return len(rows), dropped
+
+
+def precision_for_zoom(zoom):
+    """Geohash length giving cells of a few screen pixels at a web-map zoom level."""
+    try:
+        zoom = int(zoom)
+    except (TypeError, ValueError):
+        return 5
+    return max(1, min(geohash.PRECISION - 1, (zoom + 3) // 2 if zoom > 2 else 1))
+
+
+def heatmap_cells(since, until=None, precision=5, bbox=None, exclude_staff=False, limit=5000):
+    """
+    Fix counts per geohash cell of ``precision`` characters over
+    ``[since, until)``, busiest first, optionally inside ``bbox``
+    ``(south, west, north, east)``. Returns ``{'cells': [(hash, south, west,
+    north, east, count)], 'total': n, 'truncated': bool}``.
+    """
+    precision = max(1, min(geohash.PRECISION, int(precision)))
+    qs = DeviceLocation.objects.filter(created_at__gte=since).exclude(geohash='')
+    if until is not None:
+        qs = qs.filter(created_at__lt=until)
+    if exclude_staff:
+        qs = qs.exclude(user__is_staff=True)
+    if bbox is not None:
+        south, west, north, east = bbox
+        qs = qs.filter(latitude__gte=south, latitude__lte=north)
+        if east - west < 360:
+            # Map views may report longitudes past +/-180
+            west = (west + 180) % 360 - 180
+            east = (east + 180) % 360 - 180
+            if west <= east:
+                qs = qs.filter(longitude__gte=west, longitude__lte=east)
+            else:
+                # Box crosses the antimeridian
+                qs = qs.exclude(longitude__gt=east, longitude__lt=west)
+    rows = list(
+        qs.annotate(cell=Left('geohash', precision)).values('cell')
+        .annotate(n=Count('id')).order_by('-n')[:limit + 1]
+    )
+    truncated = len(rows) > limit
+    cells = []
+    total = 0
+    for row in rows[:limit]:
+        total += row['n']
+        cells.append((row['cell'], *(round(v, 6) for v in geohash.bounds(row['cell'])), row['n']))
+    return {'cells': cells, 'total': total, 'truncated': truncated}
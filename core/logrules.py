@@ -0,0 +1,71 @@
+"""
+Sampling and exclusion rules for request logging.
+
+``ActivityLoggingMiddleware`` asks ``RequestLogRules.weight()`` whether to log
+a finished request. The answer is 0 (skip it) or the sample weight to store on
+the ``RequestLog`` row: a request kept at a 1-in-10 sample rate is stored with
+weight 10, and rollups, latency histograms and the analytics tail sum weights
+instead of counting rows, so totals stay unbiased.
+
+Configured by ``REQUEST_LOG_RULES``::
+
+    REQUEST_LOG_RULES = {
+        'exclude_prefixes': ['/static/', '/media/'],   # never logged
+        'sample_rates': {'/i18n/': 0.1},               # route prefix -> keep rate
+        'default_rate': 1.0,
+        'always_log_status': 400,                      # errors always kept...
+        'always_log_slow_ms': 1000,                    # ...and so are slow requests
+    }
+"""
+import random
+
+from django.conf import settings
+
+
+class RequestLogRules:
+    def __init__(self, exclude_prefixes=(), sample_rates=None, default_rate=1.0,
+                 always_log_status=400, always_log_slow_ms=1000):
+        self.exclude_prefixes = tuple(exclude_prefixes or ())
+        # Longest prefix wins
+        self.sample_rates = sorted(
+            ((prefix, self._weight_for(rate)) for prefix, rate in (sample_rates or {}).items()),
+            key=lambda item: -len(item[0]),
+        )
+        self.default_weight = self._weight_for(default_rate)
+        self.always_log_status = always_log_status
+        self.always_log_slow_ms = always_log_slow_ms
+        self._random = random.Random()
+
+    @staticmethod
+    def _weight_for(rate):
+        """Keep 1 request in ``weight``; 0 drops everything."""
+        rate = float(rate)
+        if rate <= 0:
+            return 0
+        return max(1, int(round(1.0 / min(rate, 1.0))))
+
+    @classmethod
+    def from_settings(cls):
+        return cls(**getattr(settings, 'REQUEST_LOG_RULES', {}) or {})
+
+    def excluded(self, path, route=''):
+        return bool(self.exclude_prefixes) and (
+            path.startswith(self.exclude_prefixes) or route.startswith(self.exclude_prefixes)
+        )
+
+    def weight(self, path, route, status, duration_ms):
+        """Sample weight to log this request with, or 0 to skip it."""
+        if self.excluded(path, route):
+            return 0
+        if self.always_log_status and status >= self.always_log_status:
+            return 1
+        if self.always_log_slow_ms and duration_ms >= self.always_log_slow_ms:
+            return 1
+        weight = self.default_weight
+        for prefix, prefix_weight in self.sample_rates:
+            if route.startswith(prefix) or path.startswith(prefix):
+                weight = prefix_weight
+                break
+        if weight <= 1:
+            return weight
+        return weight if self._random.randrange(weight) == 0 else 0
@@ -0,0 +1,301 @@
+"""
+Batched, non-blocking writer for ``RequestLog`` rows.
+
+``ActivityLoggingMiddleware`` hands each entry to ``submit()``, which only
+appends to a bounded in-process queue. A daemon thread per worker process
+drains the queue and writes rows with ``bulk_create`` once a batch is full or
+the flush interval elapses, so request latency never includes a telemetry
+INSERT.
+
+When the queue is full entries are dropped (and counted) rather than
+blocking the request. If a batch write fails, its rows are retried one by
+one: rows the database rejects (a user deleted since the request, a value
+that does not fit) go to a dead-letter file (``REQUEST_LOG_DEAD_LETTER_PATH``)
+and are never retried; if the database itself is unavailable, the remaining
+rows are appended to an NDJSON spool file (``REQUEST_LOG_SPOOL_PATH``) and
+replayed on a later flush. The spool is capped at
+``REQUEST_LOG_SPOOL_MAX_BYTES`` and rows older than
+``REQUEST_LOG_SPOOL_MAX_AGE_SECONDS`` are dropped on replay.
+
+Geo columns are resolved here per batch (``core.geo``), one lookup per
+distinct IP, and each written batch is added to the per-route latency
+histograms (``core.latency``). Rows written for hours the rollups have
+already closed are flagged for a re-roll (``core.rollups.mark_late_rows``).
+"""
+import atexit
+import datetime
+import json
+import logging
+import os
+import queue
+import threading
+
+from django.conf import settings
+from django.db import DataError, IntegrityError, close_old_connections, transaction
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+logger = logging.getLogger('security')
+
+
+class RequestLogSink:
+    def __init__(self, batch_size=200, flush_seconds=2.0, max_queue=10000, spool_path=None,
+                 dead_letter_path=None, spool_max_bytes=0, spool_max_age_seconds=0):
+        self.batch_size = max(1, int(batch_size))
+        self.flush_seconds = max(0.05, float(flush_seconds))
+        self.max_queue = max(self.batch_size, int(max_queue))
+        self.spool_path = str(spool_path) if spool_path else None
+        self.dead_letter_path = str(dead_letter_path) if dead_letter_path else None
+        self.spool_max_bytes = max(0, int(spool_max_bytes or 0))
+        self.spool_max_age_seconds = max(0, int(spool_max_age_seconds or 0))
+        self._queue = queue.Queue(maxsize=self.max_queue)
+        self._wake = threading.Event()
+        self._lock = threading.Lock()
+        self._write_lock = threading.Lock()
+        # Counters are bumped from request threads and the flusher thread
+        self._counter_lock = threading.Lock()
+        self._thread = None
+        self._pid = None
+        self.counters = {
+            'enqueued': 0,
+            'written': 0,
+            'dropped': 0,
+            'backpressure': 0,
+            'spooled': 0,
+            'replayed': 0,
+            'rejected': 0,
+            'expired': 0,
+            'flush_errors': 0,
+        }
+
+    def _count(self, name, n=1):
+        with self._counter_lock:
+            self.counters[name] += n
+
+    # Producer side (request thread)
+
+    def submit(self, entry):
+        """Queue one log entry (a dict of RequestLog field values). Never blocks."""
+        self._ensure_started()
+        try:
+            self._queue.put_nowait(entry)
+            self._count('enqueued')
+        except queue.Full:
+            self._count('dropped')
+            return False
+        if self._queue.qsize() >= self.batch_size:
+            if self._queue.qsize() >= self.max_queue * 0.8:
+                # Falling behind: flush now instead of waiting out the interval
+                self._count('backpressure')
+            self._wake.set()
+        return True
+
+    def stats(self):
+        with self._counter_lock:
+            counters = dict(self.counters)
+        return {**counters, 'queued': self._queue.qsize()}
+
+    # Consumer side (flusher thread)
+
+    def _ensure_started(self):
+        pid = os.getpid()
+        if self._thread is not None and self._pid == pid and self._thread.is_alive():
+            return
+        with self._lock:
+            if self._thread is not None and self._pid == pid and self._thread.is_alive():
+                return
+            if self._pid != pid:
+                # Forked worker: the parent's queue contents and thread are not ours
+                self._queue = queue.Queue(maxsize=self.max_queue)
+            self._pid = pid
+            self._thread = threading.Thread(target=self._run, name='request-log-sink', daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while True:
+            self._wake.wait(self.flush_seconds)
+            self._wake.clear()
+            try:
+                self.flush()
+            except Exception as e:
+                logger.error(f"Request log flusher error: {e}")
+
+    def _drain(self, limit):
+        batch = []
+        while len(batch) < limit:
+            try:
+                batch.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def flush(self):
+        """Write everything currently queued. Safe to call from any thread."""
+        with self._write_lock:
+            close_old_connections()
+            try:
+                self._replay_spool()
+                while True:
+                    batch = self._drain(self.batch_size)
+                    if not batch:
+                        break
+                    self._write(batch)
+            finally:
+                close_old_connections()
+
+    def _write(self, batch):
+        from .geo import enrich_entries
+        try:
+            enrich_entries(batch)
+        except Exception as e:
+            logger.error(f"Request log geo enrichment failed: {e}")
+        written = self._insert(batch)
+        self._count('written', len(written))
+        self._after_write(written)
+
+    def _insert(self, entries):
+        """
+        Write ``entries`` and return the ones stored. A failed batch is retried
+        row by row: rejected rows are dead-lettered, and once a row fails for
+        any other reason the rest are spooled for a later attempt.
+        """
+        from .models import RequestLog
+        try:
+            with transaction.atomic():
+                RequestLog.objects.bulk_create([RequestLog(**entry) for entry in entries], batch_size=self.batch_size)
+            return entries
+        except Exception as e:
+            self._count('flush_errors')
+            logger.error(f"Request log batch write failed ({len(entries)} rows), retrying per row: {e}")
+        written, rejected = [], []
+        for i, entry in enumerate(entries):
+            try:
+                with transaction.atomic():
+                    RequestLog.objects.create(**entry)
+            except (IntegrityError, DataError, TypeError, ValueError) as e:
+                rejected.append({**entry, 'error': str(e)})
+            except Exception as e:
+                logger.error(f"Request log write failed, spooling {len(entries) - i} rows: {e}")
+                self._spool(entries[i:])
+                break
+            else:
+                written.append(entry)
+        if rejected:
+            self._dead_letter(rejected)
+        return written
+    def _after_write(self, entries):
+        from .latency import record_latencies
+        from .rollups import mark_late_rows
+        if not entries:
+            return
+        try:
+            record_latencies(entries)
+        except Exception as e:
+            logger.error(f"Request latency histogram update failed: {e}")
+        try:
+            # Spooled or delayed rows may belong to hours already rolled up
+            mark_late_rows([entry.get('created_at') for entry in entries])
+        except Exception as e:
+            logger.error(f"Request rollup dirty-hour update failed: {e}")
+
+    # Durable overflow for failed writes
+
+    def _append(self, path, entries):
+        with open(path, 'a', encoding='utf-8') as fh:
+            for entry in entries:
+                fh.write(json.dumps(entry, default=str) + '\n')
+
+    def _spool(self, batch):
+        if not self.spool_path:
+            self._count('dropped', len(batch))
+            return
+        try:
+            if self.spool_max_bytes and os.path.exists(self.spool_path) \
+                    and os.path.getsize(self.spool_path) >= self.spool_max_bytes:
+                self._count('dropped', len(batch))
+                logger.error(f"Request log spool is full, dropped {len(batch)} rows")
+                return
+            self._append(self.spool_path, batch)
+            self._count('spooled', len(batch))
+        except Exception as e:
+            self._count('dropped', len(batch))
+            logger.error(f"Request log spool write failed: {e}")
+
+    def _dead_letter(self, entries):
+        self._count('rejected', len(entries))
+        logger.error(f"Request log rejected {len(entries)} rows: {entries[0]['error']}")
+        if not self.dead_letter_path:
+            return
+        try:
+            if self.spool_max_bytes and os.path.exists(self.dead_letter_path) \
+                    and os.path.getsize(self.dead_letter_path) >= self.spool_max_bytes:
+                return
+            self._append(self.dead_letter_path, entries)
+        except Exception as e:
+            logger.error(f"Request log dead-letter write failed: {e}")
+
+    def _replay_spool(self):
+        if not self.spool_path or not os.path.exists(self.spool_path):
+            return
+        replaying = f"{self.spool_path}.{os.getpid()}.replay"
+        try:
+            os.replace(self.spool_path, replaying)
+        except OSError:
+            return
+        cutoff = None
+        if self.spool_max_age_seconds:
+            cutoff = timezone.now() - datetime.timedelta(seconds=self.spool_max_age_seconds)
+        entries = []
+        expired = 0
+        with open(replaying, encoding='utf-8') as fh:
+            for line in fh:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    continue
+                if entry.get('created_at'):
+                    entry['created_at'] = parse_datetime(entry['created_at'])
+                if cutoff is not None and entry.get('created_at') and entry['created_at'] < cutoff:
+                    expired += 1
+                    continue
+                entries.append(entry)
+        os.remove(replaying)
+        if expired:
+            self._count('expired', expired)
+            logger.error(f"Request log spool dropped {expired} rows older than {self.spool_max_age_seconds}s")
+        if not entries:
+            return
+        # Rows that fail again are dead-lettered or re-spooled by _insert
+        written = self._insert(entries)
+        self._count('replayed', len(written))
+        self._after_write(written)
+
+
+_sink = None
+_sink_lock = threading.Lock()
+
+
+def get_sink():
+    global _sink
+    if _sink is None:
+        with _sink_lock:
+            if _sink is None:
+                _sink = RequestLogSink(
+                    batch_size=getattr(settings, 'REQUEST_LOG_BATCH_SIZE', 200),
+                    flush_seconds=getattr(settings, 'REQUEST_LOG_FLUSH_SECONDS', 2.0),
+                    max_queue=getattr(settings, 'REQUEST_LOG_QUEUE_MAX', 10000),
+                    spool_path=getattr(settings, 'REQUEST_LOG_SPOOL_PATH', None),
+                    dead_letter_path=getattr(settings, 'REQUEST_LOG_DEAD_LETTER_PATH', None),
+                    spool_max_bytes=getattr(settings, 'REQUEST_LOG_SPOOL_MAX_BYTES', 0),
+                    spool_max_age_seconds=getattr(settings, 'REQUEST_LOG_SPOOL_MAX_AGE_SECONDS', 0),
+                )
+                atexit.register(_flush_at_exit)
+    return _sink
+
+
+def _flush_at_exit():
+    try:
+        if _sink is not None:
+            _sink.flush()
+    except Exception:
+        pass
@@ -0,0 +1,40 @@
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+
+from core.archive import MODELS, archive_dir, archive_telemetry, segments
+
+
+class Command(BaseCommand):
+    help = 'Move request logs and device locations older than N days into compressed columnar archive files'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days', type=int, default=getattr(settings, 'TELEMETRY_ARCHIVE_AFTER_DAYS', 0),
+                            help='Archive rows older than N days')
+        parser.add_argument('--kind', choices=sorted(MODELS), action='append',
+                            help='Only this kind (repeatable; default: all)')
+        parser.add_argument('--keep', action='store_true',
+                            help='Write segments but do not delete the rows from the database')
+        parser.add_argument('--batch-size', type=int, default=5000)
+        parser.add_argument('--list', action='store_true', help='Only list archived segments')
+
+    def handle(self, *args, **options):
+        kinds = options['kind'] or sorted(MODELS)
+        if options['list']:
+            for kind in kinds:
+                for path in segments(kind):
+                    self.stdout.write(path)
+            return
+        if options['days'] <= 0:
+            raise CommandError('Pass --days N (or set TELEMETRY_ARCHIVE_AFTER_DAYS)')
+        cutoff = timezone.now() - timedelta(days=options['days'])
+        for kind in kinds:
+            result = archive_telemetry(kind, cutoff, chunk_size=max(1, options['batch_size']),
+                                       delete=not options['keep'])
+            self.stdout.write(
+                f"{kind}: archived {result['archived']} rows over {result['days']} days, "
+                f"removed about {result['deleted']} from the database"
+            )
+        self.stdout.write(self.style.SUCCESS(f'Archive at {archive_dir()} up to date'))
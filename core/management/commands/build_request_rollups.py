@@ -0,0 +1,21 @@
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from core.rollups import build_rollups
+
+
+class Command(BaseCommand):
+    help = 'Fold request logs for closed hours into the hourly analytics rollups'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rebuild-days', type=int, default=0,
+                            help='Recompute the last N days instead of continuing from the watermark')
+
+    def handle(self, *args, **options):
+        since = None
+        if options['rebuild_days'] > 0:
+            since = timezone.now() - timedelta(days=options['rebuild_days'])
+        written = build_rollups(since=since)
+        self.stdout.write(self.style.SUCCESS(f'Wrote {written} rollup rows'))
@@ -0,0 +1,45 @@
+from datetime import datetime, timedelta, timezone as dt_timezone
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+
+from core.trajectory import compact_locations
+
+
+class Command(BaseCommand):
+    help = 'Simplify device-location history older than N days to within a distance tolerance'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days', type=int, default=getattr(settings, 'DEVICE_LOCATION_COMPACT_AFTER_DAYS', 0),
+                            help='Compact fixes older than N days')
+        parser.add_argument('--tolerance', type=float,
+                            default=getattr(settings, 'DEVICE_LOCATION_COMPACT_TOLERANCE_M', 25),
+                            help='Maximum distance in metres between the compacted and original track')
+        parser.add_argument('--max-gap-minutes', type=int,
+                            default=getattr(settings, 'DEVICE_LOCATION_COMPACT_MAX_GAP_MINUTES', 360),
+                            help='Gaps longer than this split a track; both ends are kept')
+        parser.add_argument('--user', type=int, action='append', dest='users',
+                            help='Only this user id (repeatable; does not advance the watermark)')
+        parser.add_argument('--all-history', action='store_true',
+                            help='Ignore the watermark and re-examine all history before the cutoff')
+        parser.add_argument('--batch-size', type=int, default=5000)
+        parser.add_argument('--dry-run', action='store_true')
+
+    def handle(self, *args, **options):
+        if options['days'] <= 0:
+            raise CommandError('Pass --days N (or set DEVICE_LOCATION_COMPACT_AFTER_DAYS)')
+        cutoff = timezone.now() - timedelta(days=options['days'])
+        result = compact_locations(
+            cutoff,
+            tolerance_m=options['tolerance'],
+            max_gap=timedelta(minutes=options['max_gap_minutes']),
+            chunk_size=max(3, options['batch_size']),
+            dry_run=options['dry_run'],
+            user_ids=options['users'],
+            since=datetime(1970, 1, 1, tzinfo=dt_timezone.utc) if options['all_history'] else None,
+        )
+        verb = 'Would remove' if options['dry_run'] else 'Removed'
+        self.stdout.write(self.style.SUCCESS(
+            f"{verb} {result['removed']} of {result['examined']} fixes for {result['users']} users"
+        ))
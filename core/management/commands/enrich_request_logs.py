@@ -0,0 +1,43 @@
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from core.geo import get_resolver
+from core.models import RequestLog
+
+
+class Command(BaseCommand):
+    help = 'Back-fill country/region/city on request logs that have an IP but no geo data'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days', type=int, default=0,
+                            help='Only rows from the last N days (default: all)')
+        parser.add_argument('--batch-size', type=int, default=5000)
+
+    def handle(self, *args, **options):
+        qs = RequestLog.objects.filter(country='').exclude(ip__isnull=True)
+        if options['days'] > 0:
+            qs = qs.filter(created_at__gte=timezone.now() - timedelta(days=options['days']))
+        resolver = get_resolver()
+        batch_size = max(1, options['batch_size'])
+        updated = 0
+        last_pk = 0
+        while True:
+            rows = list(qs.filter(pk__gt=last_pk).order_by('pk').values_list('pk', 'ip')[:batch_size])
+            if not rows:
+                break
+            last_pk = rows[-1][0]
+            # One update per distinct IP rather than per row
+            by_ip = {}
+            for pk, ip in rows:
+                by_ip.setdefault(ip, []).append(pk)
+            for ip, (country, region, city) in resolver.resolve_many(by_ip).items():
+                if not country:
+                    continue
+                updated += RequestLog.objects.filter(pk__in=by_ip[ip]).update(
+                    country=country, region=region, city=city,
+                )
+        self.stdout.write(self.style.SUCCESS(
+            f'Enriched {updated} request logs ({resolver.hits} cache hits, {resolver.misses} lookups)'
+        ))
@@ -0,0 +1,49 @@
+import sys
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+
+from core.exports import EXPORTS, FORMATS, stream_export
+
+
+class Command(BaseCommand):
+    help = 'Stream request logs or device locations to a CSV/NDJSON file (optionally gzipped)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('kind', choices=sorted(EXPORTS))
+        parser.add_argument('--days', type=int, default=0,
+                            help='Only rows from the last N days (default: all)')
+        parser.add_argument('--exclude-staff', action='store_true')
+        parser.add_argument('--hide-i18n', action='store_true')
+        parser.add_argument('--format', choices=FORMATS, default='csv')
+        parser.add_argument('--gzip', action='store_true')
+        parser.add_argument('--chunk-size', type=int, default=2000)
+        parser.add_argument('--output', '-o', default='-',
+                            help='File to write (default: stdout)')
+
+    def handle(self, *args, **options):
+        since = None
+        if options['days'] > 0:
+            since = timezone.now() - timedelta(days=options['days'])
+        stream = stream_export(
+            options['kind'], fmt=options['format'], compress=options['gzip'], since=since,
+            exclude_staff=options['exclude_staff'], hide_i18n=options['hide_i18n'],
+            chunk_size=max(1, options['chunk_size']),
+        )
+        written = 0
+        try:
+            out = sys.stdout.buffer if options['output'] == '-' else open(options['output'], 'wb')
+        except OSError as e:
+            raise CommandError(f"Cannot open {options['output']}: {e}")
+        try:
+            for block in stream:
+                out.write(block)
+                written += len(block)
+        finally:
+            if out is not sys.stdout.buffer:
+                out.close()
+            else:
+                out.flush()
+        if options['output'] != '-':
+            self.stderr.write(self.style.SUCCESS(f"Wrote {written} bytes to {options['output']}"))
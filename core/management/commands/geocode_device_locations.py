@@ -0,0 +1,48 @@
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from core.models import DeviceLocation
+from core.places import get_geocoder
+
+
+class Command(BaseCommand):
+    help = 'Back-fill country/region/city on device locations from the offline places dataset'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days', type=int, default=0,
+                            help='Only rows from the last N days (default: all)')
+        parser.add_argument('--all', action='store_true',
+                            help='Re-resolve rows that already have a place')
+        parser.add_argument('--batch-size', type=int, default=5000)
+
+    def handle(self, *args, **options):
+        geocoder = get_geocoder()
+        if not geocoder.available:
+            self.stderr.write(self.style.ERROR(f'No places dataset could be loaded from {geocoder.path!r}'))
+            return
+        qs = DeviceLocation.objects.all()
+        if not options['all']:
+            qs = qs.filter(country='', city='')
+        if options['days'] > 0:
+            qs = qs.filter(created_at__gte=timezone.now() - timedelta(days=options['days']))
+        batch_size = max(1, options['batch_size'])
+        updated = 0
+        last_pk = 0
+        while True:
+            rows = list(qs.filter(pk__gt=last_pk).order_by('pk').values_list('pk', 'latitude', 'longitude')[:batch_size])
+            if not rows:
+                break
+            last_pk = rows[-1][0]
+            labels = geocoder.resolve_many([(float(lat), float(lng)) for _, lat, lng in rows])
+            # One update per distinct place rather than per row
+            by_place = {}
+            for (pk, _, _), label in zip(rows, labels):
+                if label[0] or label[2]:
+                    by_place.setdefault(label, []).append(pk)
+            for (country, region, city), pks in by_place.items():
+                updated += DeviceLocation.objects.filter(pk__in=pks).update(country=country, region=region, city=city)
+        self.stdout.write(self.style.SUCCESS(
+            f'Geocoded {updated} device locations ({geocoder.hits} cell cache hits, {geocoder.misses} lookups)'
+        ))
@@ -0,0 +1,40 @@
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from core.retention import ensure_partitions, is_partitioned, list_partitions, move_legacy_rows, purge_request_logs
+
+
+class Command(BaseCommand):
+    help = ('Create upcoming RequestLog partitions, move rows logged before partitioning into them '
+            'and drop partitions past the retention window')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--ahead', type=int, default=getattr(settings, 'REQUEST_LOG_PARTITIONS_AHEAD', 2),
+                            help='Months of partitions to keep created ahead of time')
+        parser.add_argument('--retain-days', type=int, default=getattr(settings, 'REQUEST_LOG_RETENTION_DAYS', 0),
+                            help='Drop logs older than N days (0 keeps everything)')
+        parser.add_argument('--list', action='store_true', help='Only list partitions')
+
+    def handle(self, *args, **options):
+        if not is_partitioned():
+            self.stdout.write('RequestLog is not partitioned on this database; retention uses chunked deletes.')
+        if options['list']:
+            for name, start, end in list_partitions():
+                self.stdout.write(f'{name}: {start:%Y-%m-%d} .. {end:%Y-%m-%d}')
+            return
+        created = ensure_partitions(months_ahead=options['ahead'])
+        for name in created:
+            self.stdout.write(f'Created {name}')
+        moved = move_legacy_rows()
+        if moved:
+            self.stdout.write(f'Moved {moved} request logs from before partitioning')
+        if options['retain_days'] > 0:
+            cutoff = timezone.now() - timedelta(days=options['retain_days'])
+            result = purge_request_logs(cutoff)
+            for name in result['dropped_partitions']:
+                self.stdout.write(f'Dropped {name}')
+            self.stdout.write(f"Removed about {result['deleted_rows']} request logs older than {options['retain_days']} days")
+        self.stdout.write(self.style.SUCCESS('Request log partitions up to date'))
@@ -4,6 +4,12 @@ from django.http import HttpResponseForbidden
 from django.utils import timezone
 from django.conf import settings
 import time
+from contextlib import ExitStack
+
+from django.db import connections
+
+from . import timing
+from .logrules import RequestLogRules
 
 logger = logging.getLogger('security')
 
@@ -37,69 +43,116 @@ class AdminIPAllowlistMiddleware:
 
 
 class ActivityLoggingMiddleware:
-    """Logs basic request/response info to the 'activity' logger."""
+    """
+    Logs basic request/response info to the 'activity' logger and records a
+    RequestLog row. Rows go through the batched writer in ``core.logsink``
+    unless REQUEST_LOG_ASYNC is off, in which case they are inserted inline.
+    REQUEST_LOG_RULES (``core.logrules``) decides which requests are skipped
+    or sampled.
+    """
     def __init__(self, get_response):
         self.get_response = get_response
         self.log = logging.getLogger('activity')
+        self.sink = None
+        self.rules = RequestLogRules.from_settings()
+        if getattr(settings, 'REQUEST_LOG_ASYNC', True):
+            from .logsink import get_sink
+            self.sink = get_sink()
 
     def __call__(self, request):
         start = time.time()
+        created_at = timezone.now()
+        response = None
+        try:
+            response = self.get_response(request)
+            return response
+        finally:
+            self._record(request, response, start, created_at)
+
+    def _record(self, request, response, start, created_at):
+        # request.user is only set once the auth middleware further down has
+        # run, so read it after the response.
         user = getattr(request, 'user', None)
         ip = request.META.get('REMOTE_ADDR') or request.META.get('HTTP_X_FORWARDED_FOR', '').split(',')[0].strip() or ''
         ua = request.META.get('HTTP_USER_AGENT', '')[:200]
         method = request.method
         path = request.get_full_path()
-        response = None
+        status = getattr(response, 'status_code', 0) if response is not None else 0
+        duration_ms = int((time.time() - start) * 1000)
+        uid = None
+        uname = None
+        if user and getattr(user, 'is_authenticated', False):
+            uid = user.id
+            uname = user.username
         try:
-            response = self.get_response(request)
-            return response
-        finally:
-            status = getattr(response, 'status_code', 0) if response is not None else 0
-            duration_ms = int((time.time() - start) * 1000)
-            uid = None
-            uname = None
-            if user and getattr(user, 'is_authenticated', False):
-                uid = user.id
-                uname = user.username
-            msg = f"{timezone.now().isoformat()} method={method} path='{path}' status={status} ms={duration_ms} ip={ip} user_id={uid} user='{uname}' ua='{ua}'"
-            try:
-                self.log.info(msg)
-            except Exception:
-                pass
-            # Persist to DB (best effort)
-            try:
+            from .rollups import request_route
+            route = request_route(request, path)
+            weight = self.rules.weight(path, route, int(status or 0), duration_ms)
+        except Exception:
+            route, weight = '', 1
+        if not weight:
+            # Excluded or not sampled: no log line, no row
+            return
+        msg = f"{timezone.now().isoformat()} method={method} path='{path}' status={status} ms={duration_ms} ip={ip} user_id={uid} user='{uname}' ua='{ua}'"
+        if weight > 1:
+            msg += f" weight={weight}"
+        try:
+            self.log.info(msg)
+        except Exception:
+            pass
+        # Persist to DB (best effort) via the batched writer. Geo columns
+        # are filled in by the flusher (core.geo), not on the request path.
+        try:
+            entry = dict(
+                user_id=uid,
+                method=method[:10],
+                path=path[:500],
+                route=route,
+                status=int(status or 0),
+                duration_ms=int(duration_ms or 0),
+                ip=ip if ip else None,
+                user_agent=ua or '',
+                created_at=created_at,
+                sample_weight=weight,
+            )
+            timer = getattr(request, '_timings', None)
+            if timer is not None:
+                entry.update(timer.as_fields())
+            if self.sink is not None:
+                self.sink.submit(entry)
+            else:
+                from .geo import enrich_entries
+                from .latency import record_latencies
                 from .models import RequestLog
-                country = ''
-                region = ''
-                city = ''
-                if ip:
-                    c, r, ci = self._geo_lookup(ip)
-                    country, region, city = c or '', r or '', ci or ''
-                RequestLog.objects.create(
-                    user=user if (user and getattr(user, 'is_authenticated', False)) else None,
-                    method=method[:10],
-                    path=path[:500],
-                    status=int(status or 0),
-                    duration_ms=int(duration_ms or 0),
-                    ip=ip if ip else None,
-                    user_agent=ua or '',
-                    country=country[:64],
-                    region=region[:128],
-                    city=city[:128],
-                )
-            except Exception:
-                # Never break request due to logging
-                pass
+                enrich_entries([entry])
+                RequestLog.objects.create(**entry)
+                record_latencies([entry])
+        except Exception:
+            # Never break request due to logging
+            pass
+
+
+class RequestTimingMiddleware:
+    """
+    Measures SQL, cache, template and media time for each request
+    (``core.timing``). The totals are saved with the RequestLog row and, for
+    staff users, returned in a ``Server-Timing`` header. Sits just below
+    ActivityLoggingMiddleware so everything it wraps is measured.
+    """
+    def __init__(self, get_response):
+        self.get_response = get_response
 
-    def _geo_lookup(self, ip: str):
-        """Return (country, region, city) using GeoIP2 if configured; otherwise empty strings."""
+    def __call__(self, request):
+        timer, token = timing.start()
+        request._timings = timer
         try:
-            from django.contrib.gis.geoip2 import GeoIP2
-            g = GeoIP2()
-            city = g.city(ip)
-            country_name = city.get('country_name') or ''
-            region = city.get('region') or city.get('subdivisions', [{}])[0].get('names', {}).get('en', '') if isinstance(city.get('subdivisions'), list) else (city.get('region') or '')
-            city_name = city.get('city') or ''
-            return country_name, region, city_name
-        except Exception:
-            return '', '', ''
+            with ExitStack() as stack:
+                for conn in connections.all():
+                    stack.enter_context(conn.execute_wrapper(timing.sql_wrapper))
+                response = self.get_response(request)
+        finally:
+            timing.stop(token)
+        user = getattr(request, 'user', None)
+        if user is not None and getattr(user, 'is_staff', False):
+            response['Server-Timing'] = timer.server_timing()
+        return response
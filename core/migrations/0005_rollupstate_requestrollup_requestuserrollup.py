@@ -0,0 +1,60 @@
+# Generated by Django 5.2.7 on 2026-10-18 02:14
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0004_alter_requestlog_created_at'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RollupState',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=64, unique=True)),
+                ('watermark', models.DateTimeField(blank=True, null=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='RequestRollup',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('bucket', models.DateTimeField()),
+                ('route', models.CharField(max_length=255)),
+                ('status_class', models.PositiveSmallIntegerField()),
+                ('country', models.CharField(blank=True, max_length=64)),
+                ('region', models.CharField(blank=True, max_length=128)),
+                ('is_authenticated', models.BooleanField(default=False)),
+                ('is_staff', models.BooleanField(default=False)),
+                ('is_i18n', models.BooleanField(default=False)),
+                ('count', models.BigIntegerField(default=0)),
+                ('duration_ms_sum', models.BigIntegerField(default=0)),
+            ],
+            options={
+                'indexes': [models.Index(fields=['bucket'], name='core_reques_bucket_e00baf_idx'), models.Index(fields=['bucket', 'country'], name='core_reques_bucket_18f67a_idx'), models.Index(fields=['bucket', 'route'], name='core_reques_bucket_f31aca_idx')],
+                'constraints': [models.UniqueConstraint(fields=('bucket', 'route', 'status_class', 'country', 'region', 'is_authenticated', 'is_staff', 'is_i18n'), name='core_requestrollup_dims')],
+            },
+        ),
+        migrations.CreateModel(
+            name='RequestUserRollup',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('bucket', models.DateTimeField()),
+                ('is_staff', models.BooleanField(default=False)),
+                ('is_i18n', models.BooleanField(default=False)),
+                ('count', models.BigIntegerField(default=0)),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'indexes': [models.Index(fields=['bucket'], name='core_reques_bucket_3995fd_idx')],
+                'constraints': [models.UniqueConstraint(fields=('bucket', 'user', 'is_staff', 'is_i18n'), name='core_requestuserrollup_dims')],
+            },
+        ),
+    ]
@@ -0,0 +1,46 @@
+# Generated by Django 5.2.7 on 2026-10-18 02:15
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+def fill_routes(apps, schema_editor):
+    # Historical rows have no resolver match; use the cleaned path. Walk the
+    # table in primary-key order so each batch is an index range scan.
+    RequestLog = apps.get_model('core', 'RequestLog')
+    RollupState = apps.get_model('core', 'RollupState')
+    last_pk = 0
+    while True:
+        batch = list(RequestLog.objects.filter(pk__gt=last_pk).order_by('pk').only('pk', 'path')[:2000])
+        if not batch:
+            break
+        for log in batch:
+            base = (log.path or '').split('?', 1)[0]
+            parts = base.split('/')
+            if len(parts) > 2 and len(parts[1]) == 2:
+                base = '/' + '/'.join(parts[2:])
+            log.route = base[:255]
+        RequestLog.objects.bulk_update(batch, ['route'], batch_size=500)
+        last_pk = batch[-1].pk
+    # Rollups were keyed by cleaned path; rebuild them from the route column
+    RollupState.objects.filter(name='requests').delete()
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0005_rollupstate_requestrollup_requestuserrollup'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='requestlog',
+            name='route',
+            field=models.CharField(blank=True, default='', max_length=255),
+        ),
+        migrations.AddIndex(
+            model_name='requestlog',
+            index=models.Index(fields=['route', 'created_at'], name='core_reques_route_29dd7d_idx'),
+        ),
+        migrations.RunPython(fill_routes, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,167 @@
+# Generated by Django 5.2.7 on 2026-10-18 02:40
+
+import datetime
+
+from django.db import migrations
+
+from core.retention import LEGACY_TABLE, month_start, next_month
+
+
+def _index_defs(cursor, table):
+    cursor.execute(
+        "SELECT indexname, indexdef FROM pg_indexes WHERE tablename = %s "
+        "AND indexname NOT IN (SELECT conname FROM pg_constraint "
+        "WHERE conrelid = %s::regclass AND contype = 'p')",
+        [table, table],
+    )
+    return cursor.fetchall()
+
+
+def _foreign_keys(cursor, table):
+    cursor.execute(
+        "SELECT conname, pg_get_constraintdef(oid) FROM pg_constraint "
+        "WHERE conrelid = %s::regclass AND contype = 'f'",
+        [table],
+    )
+    return cursor.fetchall()
+
+
+def _take_over_sequence(cursor, old_table, new_table):
+    # A serial id keeps using the old table's sequence (the copied column
+    # default points at it), so hand the sequence over before the old table
+    # is dropped. An identity column got a fresh sequence from LIKE; start it
+    # past the old table's ids.
+    cursor.execute(
+        "SELECT attidentity FROM pg_attribute WHERE attrelid = %s::regclass AND attname = 'id'", [old_table]
+    )
+    if cursor.fetchone()[0]:
+        cursor.execute(
+            f"SELECT setval(pg_get_serial_sequence(%s, 'id'), "
+            f"COALESCE((SELECT max(id) FROM {old_table}), 0) + 1, false)",
+            [new_table],
+        )
+        return
+    cursor.execute("SELECT pg_get_serial_sequence(%s, 'id')", [old_table])
+    sequence = cursor.fetchone()[0]
+    if sequence:
+        cursor.execute(f"ALTER SEQUENCE {sequence} OWNED BY {new_table}.id")
+
+
+def partition_requestlog(apps, schema_editor):
+    # Range-partition core_requestlog by month on PostgreSQL so retention can
+    # drop whole months (see core.retention). Other backends keep a plain table.
+    # Needs PostgreSQL 11+ (DEFAULT partitions, primary keys on partitioned
+    # tables), below Django 5.2's own minimum of PostgreSQL 14.
+    #
+    # Only the empty partitioned table is created here, so the table is locked
+    # for moments, not for a copy of every row. Existing rows stay in
+    # core_requestlog_legacy, with its indexes renamed and foreign keys
+    # dropped, and are moved over in batches after the deploy by
+    # `manage.py requestlog_partitions` (also run daily by
+    # core.tasks.maintain_request_logs_task), which then drops it. Until then
+    # analytics and exports do not see those rows.
+    connection = schema_editor.connection
+    if connection.vendor != 'postgresql':
+        return
+    with connection.cursor() as cursor:
+        cursor.execute("SELECT relkind FROM pg_class WHERE relname = 'core_requestlog'")
+        if cursor.fetchone()[0] == 'p':
+            return
+        index_defs = _index_defs(cursor, 'core_requestlog')
+        foreign_keys = _foreign_keys(cursor, 'core_requestlog')
+        cursor.execute("SELECT min(created_at) FROM core_requestlog")
+        oldest = cursor.fetchone()[0]
+
+        cursor.execute(f"ALTER TABLE core_requestlog RENAME TO {LEGACY_TABLE}")
+        # Free the index names for the new table
+        cursor.execute("SELECT indexname FROM pg_indexes WHERE tablename = %s", [LEGACY_TABLE])
+        for (name,) in cursor.fetchall():
+            cursor.execute(f'ALTER INDEX "{name}" RENAME TO "{name[:55]}_legacy"')
+        # Rows waiting to be moved must not block deleting a user
+        for name, _ in foreign_keys:
+            cursor.execute(f'ALTER TABLE {LEGACY_TABLE} DROP CONSTRAINT "{name}"')
+
+        cursor.execute(
+            f"CREATE TABLE core_requestlog (LIKE {LEGACY_TABLE} "
+            f"INCLUDING DEFAULTS INCLUDING IDENTITY) PARTITION BY RANGE (created_at)"
+        )
+        # The partition key has to be part of the primary key
+        cursor.execute("ALTER TABLE core_requestlog ADD CONSTRAINT core_requestlog_pkey PRIMARY KEY (id, created_at)")
+        _take_over_sequence(cursor, LEGACY_TABLE, 'core_requestlog')
+
+        now = datetime.datetime.now(datetime.timezone.utc)
+        start = month_start(oldest or now)
+        last = month_start(now)
+        for _ in range(2):
+            last = next_month(last)
+        while start <= last:
+            end = next_month(start)
+            cursor.execute(
+                f"CREATE TABLE core_requestlog_p{start:%Y%m} PARTITION OF core_requestlog "
+                f"FOR VALUES FROM (%s) TO (%s)",
+                [start, end],
+            )
+            start = end
+        cursor.execute("CREATE TABLE core_requestlog_pdefault PARTITION OF core_requestlog DEFAULT")
+
+        for _, index_def in index_defs:
+            cursor.execute(index_def)
+        for name, definition in foreign_keys:
+            cursor.execute(f'ALTER TABLE core_requestlog ADD CONSTRAINT "{name}" {definition}')
+        cursor.execute(f"SELECT EXISTS (SELECT 1 FROM {LEGACY_TABLE})")
+        if not cursor.fetchone()[0]:
+            cursor.execute(f"DROP TABLE {LEGACY_TABLE}")
+
+
+def unpartition_requestlog(apps, schema_editor):
+    # Back to one plain table, keeping every row (the DEFAULT partition's and
+    # any not yet moved out of core_requestlog_legacy). This copies the whole
+    # table inside the migration, so run it with the site offline.
+    connection = schema_editor.connection
+    if connection.vendor != 'postgresql':
+        return
+    with connection.cursor() as cursor:
+        cursor.execute("SELECT relkind FROM pg_class WHERE relname = 'core_requestlog'")
+        if cursor.fetchone()[0] != 'p':
+            return
+        index_defs = [d.replace(' ON ONLY ', ' ON ') for _, d in _index_defs(cursor, 'core_requestlog')]
+        foreign_keys = _foreign_keys(cursor, 'core_requestlog')
+
+        cursor.execute("ALTER TABLE core_requestlog RENAME TO core_requestlog_partitioned")
+        cursor.execute("ALTER INDEX core_requestlog_pkey RENAME TO core_requestlog_partitioned_pkey")
+        cursor.execute(
+            "CREATE TABLE core_requestlog (LIKE core_requestlog_partitioned "
+            "INCLUDING DEFAULTS INCLUDING IDENTITY)"
+        )
+        _take_over_sequence(cursor, 'core_requestlog_partitioned', 'core_requestlog')
+        cursor.execute("INSERT INTO core_requestlog SELECT * FROM core_requestlog_partitioned")
+        cursor.execute("SELECT 1 FROM pg_class WHERE relname = %s", [LEGACY_TABLE])
+        if cursor.fetchone():
+            users = apps.get_model('core', 'RequestLog')._meta.get_field('user').related_model._meta.db_table
+            cursor.execute(
+                f"UPDATE {LEGACY_TABLE} SET user_id = NULL "
+                f"WHERE user_id IS NOT NULL AND user_id NOT IN (SELECT id FROM {users})"
+            )
+            columns = ', '.join(
+                f'"{c.name}"' for c in connection.introspection.get_table_description(cursor, LEGACY_TABLE)
+            )
+            cursor.execute(f"INSERT INTO core_requestlog ({columns}) SELECT {columns} FROM {LEGACY_TABLE}")
+            cursor.execute(f"DROP TABLE {LEGACY_TABLE}")
+        # Drops the partitions with it
+        cursor.execute("DROP TABLE core_requestlog_partitioned")
+        cursor.execute("ALTER TABLE core_requestlog ADD CONSTRAINT core_requestlog_pkey PRIMARY KEY (id)")
+        for index_def in index_defs:
+            cursor.execute(index_def)
+        for name, definition in foreign_keys:
+            cursor.execute(f'ALTER TABLE core_requestlog ADD CONSTRAINT "{name}" {definition}')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0006_requestlog_route'),
+    ]
+
+    operations = [
+        migrations.RunPython(partition_requestlog, unpartition_requestlog),
+    ]
@@ -0,0 +1,29 @@
+# Generated by Django 5.2.7 on 2026-10-18 02:19
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0007_partition_requestlog'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RequestSketch',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('bucket', models.DateTimeField()),
+                ('is_staff', models.BooleanField(default=False)),
+                ('is_i18n', models.BooleanField(default=False)),
+                ('users', models.BinaryField()),
+                ('ips', models.BinaryField()),
+                ('countries', models.BinaryField()),
+            ],
+            options={
+                'indexes': [models.Index(fields=['bucket'], name='core_reques_bucket_4624c0_idx')],
+                'constraints': [models.UniqueConstraint(fields=('bucket', 'is_staff', 'is_i18n'), name='core_requestsketch_dims')],
+            },
+        ),
+    ]
@@ -0,0 +1,29 @@
+# Generated by Django 5.2.7 on 2026-10-18 02:20
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0008_requestsketch'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='LatencyHistogram',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('bucket', models.DateTimeField()),
+                ('route', models.CharField(blank=True, max_length=255)),
+                ('counts', models.JSONField(default=dict)),
+                ('count', models.BigIntegerField(default=0)),
+                ('sum_ms', models.BigIntegerField(default=0)),
+                ('max_ms', models.IntegerField(default=0)),
+            ],
+            options={
+                'indexes': [models.Index(fields=['bucket'], name='core_latenc_bucket_6f1abe_idx')],
+                'constraints': [models.UniqueConstraint(fields=('bucket', 'route'), name='core_latencyhistogram_route')],
+            },
+        ),
+    ]
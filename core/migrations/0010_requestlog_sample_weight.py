@@ -0,0 +1,18 @@
+# Generated by Django 5.2.7 on 2026-10-18 02:22
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0009_latencyhistogram'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='requestlog',
+            name='sample_weight',
+            field=models.PositiveIntegerField(default=1),
+        ),
+    ]
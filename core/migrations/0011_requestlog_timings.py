@@ -0,0 +1,48 @@
+# Generated by Django 5.2.7 on 2026-10-18 02:24
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0010_requestlog_sample_weight'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='requestlog',
+            name='cache_hits',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='requestlog',
+            name='cache_misses',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='requestlog',
+            name='cache_ms',
+            field=models.FloatField(default=0),
+        ),
+        migrations.AddField(
+            model_name='requestlog',
+            name='media_ms',
+            field=models.FloatField(default=0),
+        ),
+        migrations.AddField(
+            model_name='requestlog',
+            name='sql_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='requestlog',
+            name='sql_ms',
+            field=models.FloatField(default=0),
+        ),
+        migrations.AddField(
+            model_name='requestlog',
+            name='template_ms',
+            field=models.FloatField(default=0),
+        ),
+    ]
@@ -0,0 +1,19 @@
+# Generated by Django 5.2.7 on 2026-10-18 02:29
+
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0011_requestlog_timings'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='devicelocation',
+            name='created_at',
+            field=models.DateTimeField(default=django.utils.timezone.now),
+        ),
+    ]
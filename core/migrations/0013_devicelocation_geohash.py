@@ -0,0 +1,39 @@
+# Generated by Django 5.2.7 on 2026-10-18 02:30
+
+from django.conf import settings
+from django.db import migrations, models
+
+from core.geohash import encode
+
+
+def fill_geohashes(apps, schema_editor):
+    DeviceLocation = apps.get_model('core', 'DeviceLocation')
+    last_pk = 0
+    while True:
+        rows = list(DeviceLocation.objects.filter(geohash='', pk__gt=last_pk).order_by('pk')[:2000])
+        if not rows:
+            break
+        last_pk = rows[-1].pk
+        for row in rows:
+            row.geohash = encode(float(row.latitude), float(row.longitude))
+        DeviceLocation.objects.bulk_update(rows, ['geohash'])
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0012_devicelocation_fix_time'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='devicelocation',
+            name='geohash',
+            field=models.CharField(blank=True, default='', max_length=12),
+        ),
+        migrations.AddIndex(
+            model_name='devicelocation',
+            index=models.Index(fields=['created_at', 'geohash'], name='core_device_created_f3240d_idx'),
+        ),
+        migrations.RunPython(fill_geohashes, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,34 @@
+# Generated by Django 5.2.7 on 2026-10-18 02:33
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0013_devicelocation_geohash'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='devicelocation',
+            name='city',
+            field=models.CharField(blank=True, default='', max_length=128),
+        ),
+        migrations.AddField(
+            model_name='devicelocation',
+            name='country',
+            field=models.CharField(blank=True, default='', max_length=64),
+        ),
+        migrations.AddField(
+            model_name='devicelocation',
+            name='region',
+            field=models.CharField(blank=True, default='', max_length=128),
+        ),
+        migrations.AddIndex(
+            model_name='devicelocation',
+            index=models.Index(fields=['country', 'created_at'], name='core_device_country_7ca309_idx'),
+        ),
+    ]
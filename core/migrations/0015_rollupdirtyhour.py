@@ -0,0 +1,21 @@
+# Generated by Django 5.2.7 on 2026-10-18 09:12
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0014_devicelocation_place'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RollupDirtyHour',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('bucket', models.DateTimeField(unique=True)),
+                ('marked_at', models.DateTimeField()),
+            ],
+        ),
+    ]
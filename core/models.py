@@ -1,5 +1,6 @@
 from django.db import models
 from django.contrib.auth.models import User
+from django.utils import timezone
 
 # Create your models here.
 
@@ -20,6 +21,9 @@ class RequestLog(models.Model):
     user = models.ForeignKey(User, null=True, blank=True, on_delete=models.SET_NULL)
     method = models.CharField(max_length=10)
     path = models.CharField(max_length=500)
+    # URL pattern the request resolved to, without language prefix or query
+    # string (see core.rollups.request_route)
+    route = models.CharField(max_length=255, blank=True, default='')
     status = models.IntegerField()
     duration_ms = models.IntegerField()
     ip = models.GenericIPAddressField(null=True, blank=True)
@@ -27,7 +31,18 @@ class RequestLog(models.Model):
     country = models.CharField(max_length=64, blank=True)
     region = models.CharField(max_length=128, blank=True)
     city = models.CharField(max_length=128, blank=True)
-    created_at = models.DateTimeField(auto_now_add=True)
+    # Requests this row stands for when sampled (core.logrules); 1 = not sampled
+    sample_weight = models.PositiveIntegerField(default=1)
+    # Time breakdown from core.timing (0 when not measured)
+    sql_count = models.PositiveIntegerField(default=0)
+    sql_ms = models.FloatField(default=0)
+    cache_hits = models.PositiveIntegerField(default=0)
+    cache_misses = models.PositiveIntegerField(default=0)
+    cache_ms = models.FloatField(default=0)
+    template_ms = models.FloatField(default=0)
+    media_ms = models.FloatField(default=0)
+    # Set by the request, not the INSERT: rows are written in delayed batches
+    created_at = models.DateTimeField(default=timezone.now)
 
     class Meta:
         indexes = [
@@ -35,6 +50,7 @@ class RequestLog(models.Model):
             models.Index(fields=["country"]),
             models.Index(fields=["region"]),
             models.Index(fields=["user"]),
+            models.Index(fields=["route", "created_at"]),
         ]
 
     def __str__(self):
@@ -48,12 +64,127 @@ class DeviceLocation(models.Model):
     accuracy_m = models.FloatField(null=True, blank=True)
     ip = models.GenericIPAddressField(null=True, blank=True)
     user_agent = models.CharField(max_length=256, blank=True)
-    created_at = models.DateTimeField(auto_now_add=True)
+    # Full-precision geohash of the fix (core.geohash); prefixes are grid cells
+    geohash = models.CharField(max_length=12, blank=True, default='')
+    # Nearest known place (core.places); blank until resolved
+    country = models.CharField(max_length=64, blank=True, default='')
+    region = models.CharField(max_length=128, blank=True, default='')
+    city = models.CharField(max_length=128, blank=True, default='')
+    # Time of the fix as reported by the device (core.locations)
+    created_at = models.DateTimeField(default=timezone.now)
 
     class Meta:
         indexes = [
             models.Index(fields=["user", "created_at"]),
+            models.Index(fields=["created_at", "geohash"]),
+            models.Index(fields=["country", "created_at"]),
         ]
 
     def __str__(self):
         return f"{self.user.username} @ {self.latitude},{self.longitude}"
+
+
+class RequestRollup(models.Model):
+    """Request counts per hour and dimension combination, maintained by core.rollups."""
+    bucket = models.DateTimeField()
+    route = models.CharField(max_length=255)
+    status_class = models.PositiveSmallIntegerField()  # 2 for 2xx ... 5 for 5xx, 0 otherwise
+    country = models.CharField(max_length=64, blank=True)
+    region = models.CharField(max_length=128, blank=True)
+    is_authenticated = models.BooleanField(default=False)
+    is_staff = models.BooleanField(default=False)
+    is_i18n = models.BooleanField(default=False)
+    count = models.BigIntegerField(default=0)
+    duration_ms_sum = models.BigIntegerField(default=0)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=["bucket"]),
+            models.Index(fields=["bucket", "country"]),
+            models.Index(fields=["bucket", "route"]),
+        ]
+        constraints = [
+            models.UniqueConstraint(
+                fields=["bucket", "route", "status_class", "country", "region",
+                        "is_authenticated", "is_staff", "is_i18n"],
+                name="core_requestrollup_dims",
+            ),
+        ]
+
+    def __str__(self):
+        return f"{self.bucket:%Y-%m-%d %H}:00 {self.route} {self.status_class}xx {self.count}"
+
+
+class RequestUserRollup(models.Model):
+    """Requests per hour per signed-in user, for unique-user and top-user figures."""
+    bucket = models.DateTimeField()
+    user = models.ForeignKey(User, on_delete=models.CASCADE)
+    is_staff = models.BooleanField(default=False)
+    is_i18n = models.BooleanField(default=False)
+    count = models.BigIntegerField(default=0)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=["bucket"]),
+        ]
+        constraints = [
+            models.UniqueConstraint(fields=["bucket", "user", "is_staff", "is_i18n"], name="core_requestuserrollup_dims"),
+        ]
+
+
+class RequestSketch(models.Model):
+    """HyperLogLog sketches (core.hll) of distinct users, IPs and countries per hour."""
+    bucket = models.DateTimeField()
+    is_staff = models.BooleanField(default=False)
+    is_i18n = models.BooleanField(default=False)
+    users = models.BinaryField()
+    ips = models.BinaryField()
+    countries = models.BinaryField()
+
+    class Meta:
+        indexes = [
+            models.Index(fields=["bucket"]),
+        ]
+        constraints = [
+            models.UniqueConstraint(fields=["bucket", "is_staff", "is_i18n"], name="core_requestsketch_dims"),
+        ]
+
+
+class LatencyHistogram(models.Model):
+    """Response-time histogram for one route and hour (see core.latency)."""
+    bucket = models.DateTimeField()
+    route = models.CharField(max_length=255, blank=True)
+    counts = models.JSONField(default=dict)  # {bucket index: requests}, sparse
+    count = models.BigIntegerField(default=0)
+    sum_ms = models.BigIntegerField(default=0)
+    max_ms = models.IntegerField(default=0)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=["bucket"]),
+        ]
+        constraints = [
+            models.UniqueConstraint(fields=["bucket", "route"], name="core_latencyhistogram_route"),
+        ]
+
+    def __str__(self):
+        return f"{self.bucket:%Y-%m-%d %H}:00 {self.route} n={self.count}"
+
+
+class RollupState(models.Model):
+    """High-water mark of a rollup job: every bucket before ``watermark`` is final."""
+    name = models.CharField(max_length=64, unique=True)
+    watermark = models.DateTimeField(null=True, blank=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"{self.name} @ {self.watermark}"
+
+
+class RollupDirtyHour(models.Model):
+    """An hour that received request logs after it may have been rolled up (see core.rollups)."""
+    bucket = models.DateTimeField(unique=True)
+    marked_at = models.DateTimeField()
+
+    def __str__(self):
+        return f"{self.bucket:%Y-%m-%d %H}:00 dirty since {self.marked_at}"
@@ -0,0 +1,261 @@
+"""
+Offline reverse geocoding of device fixes.
+
+Places come from ``PLACES_DATASET_PATH``: a GeoNames ``cities*.txt`` dump
+(with ``admin1CodesASCII.txt`` and ``countryInfo.txt`` beside it for region
+and country names, when present) or a CSV with ``latitude``, ``longitude``,
+``city``, ``region`` and ``country`` columns. They are loaded once per
+process into a KD-tree over unit vectors on the sphere, where straight-line
+(chord) distance orders points the same way as great-circle distance, so
+the nearest node is the nearest place. The tree is scipy's ``cKDTree`` when
+scipy is installed, with batches queried in one vectorised call; otherwise
+a flat pure-Python KD-tree. Web processes build the index at startup
+(``warm_geocoder()``, called from ``wsgi.py`` and ``asgi.py``); ingest
+never builds it inside a request and leaves fixes for ``manage.py
+geocode_device_locations`` when it is not loaded.
+
+Nearby fixes share an answer: results are cached by geohash cell
+(``CELL_PRECISION`` characters, about 150 m), so a batch only queries the
+tree once per distinct cell. Fixes further than ``PLACES_MAX_DISTANCE_KM``
+from any place resolve to nothing.
+"""
+import csv
+import logging
+import math
+import os
+import threading
+from array import array
+from collections import OrderedDict
+
+from django.conf import settings
+
+from . import geohash
+
+try:
+    from scipy.spatial import cKDTree
+except Exception:  # pragma: no cover - optional
+    cKDTree = None
+
+logger = logging.getLogger('security')
+
+EMPTY = ('', '', '')
+CELL_PRECISION = 7
+EARTH_RADIUS_KM = 6371.0088
+
+
+def _unit_vector(lat, lng):
+    phi, lam = math.radians(lat), math.radians(lng)
+    c = math.cos(phi)
+    return c * math.cos(lam), c * math.sin(lam), math.sin(phi)
+
+
+def _chord_to_km(chord):
+    return 2 * EARTH_RADIUS_KM * math.asin(min(1.0, chord / 2))
+
+
+class KDTree:
+    """Static 3-d KD-tree stored as a permutation of point indexes (median of each range is its node)."""
+
+    def __init__(self, xs, ys, zs):
+        self.coords = (array('d', xs), array('d', ys), array('d', zs))
+        self.order = array('l', range(len(self.coords[0])))
+        stack = [(0, len(self.order), 0)]
+        while stack:
+            lo, hi, depth = stack.pop()
+            if hi - lo < 2:
+                continue
+            axis = self.coords[depth % 3]
+            self.order[lo:hi] = array('l', sorted(self.order[lo:hi], key=axis.__getitem__))
+            mid = (lo + hi) // 2
+            stack.append((lo, mid, depth + 1))
+            stack.append((mid + 1, hi, depth + 1))
+
+    def nearest(self, x, y, z):
+        """``(index, squared distance)`` of the closest point."""
+        xs, ys, zs = self.coords
+        order = self.order
+        best, best_d = -1, float('inf')
+        stack = [(0, len(order), 0, 0.0)]
+        while stack:
+            lo, hi, depth, bound = stack.pop()
+            if lo >= hi or bound >= best_d:
+                continue
+            mid = (lo + hi) // 2
+            i = order[mid]
+            dx, dy, dz = xs[i] - x, ys[i] - y, zs[i] - z
+            d = dx * dx + dy * dy + dz * dz
+            if d < best_d:
+                best, best_d = i, d
+            diff = (x, y, z)[depth % 3] - self.coords[depth % 3][i]
+            near, far = ((lo, mid), (mid + 1, hi)) if diff < 0 else ((mid + 1, hi), (lo, mid))
+            # Far side first so the near side is searched first
+            stack.append((far[0], far[1], depth + 1, diff * diff))
+            stack.append((near[0], near[1], depth + 1, 0.0))
+        return best, best_d
+
+
+def _read_lookup(path, key_col, value_col, min_cols):
+    table = {}
+    if not os.path.exists(path):
+        return table
+    with open(path, encoding='utf-8') as f:
+        for line in f:
+            if line.startswith('#'):
+                continue
+            cols = line.rstrip('\n').split('\t')
+            if len(cols) >= min_cols:
+                table[cols[key_col]] = cols[value_col]
+    return table
+
+
+def load_places(path):
+    """``(lats, lngs, labels)`` where labels are ``(country, region, city)``."""
+    lats, lngs, labels = array('d'), array('d'), []
+    if path.lower().endswith('.csv'):
+        with open(path, newline='', encoding='utf-8') as f:
+            for row in csv.DictReader(f):
+                try:
+                    lat, lng = float(row['latitude']), float(row['longitude'])
+                except (KeyError, TypeError, ValueError):
+                    continue
+                lats.append(lat)
+                lngs.append(lng)
+                labels.append(((row.get('country') or '')[:64], (row.get('region') or '')[:128],
+                               (row.get('city') or row.get('name') or '')[:128]))
+        return lats, lngs, labels
+    base = os.path.dirname(path)
+    regions = _read_lookup(os.path.join(base, 'admin1CodesASCII.txt'), 0, 1, 2)
+    countries = _read_lookup(os.path.join(base, 'countryInfo.txt'), 0, 4, 5)
+    with open(path, encoding='utf-8') as f:
+        for line in f:
+            cols = line.rstrip('\n').split('\t')
+            if len(cols) < 11:
+                continue
+            try:
+                lat, lng = float(cols[4]), float(cols[5])
+            except ValueError:
+                continue
+            cc = cols[8]
+            lats.append(lat)
+            lngs.append(lng)
+            labels.append((countries.get(cc, cc)[:64], regions.get(f'{cc}.{cols[10]}', '')[:128], cols[1][:128]))
+    return lats, lngs, labels
+
+
+class ReverseGeocoder:
+    """Resolve ``(lat, lng)`` to ``(country, region, city)`` through a per-process place index."""
+
+    def __init__(self, path, max_distance_km=100, cache_size=100000):
+        self.path = path
+        self.max_distance_km = float(max_distance_km)
+        self.cache_size = max(0, int(cache_size))
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+        self._tree = None
+        self._labels = None
+        self._unavailable = False
+        self.hits = 0
+        self.misses = 0
+
+    def load(self):
+        """Build the place index now, if that has not been tried yet."""
+        with self._lock:
+            if self._tree is not None or self._unavailable:
+                return
+            try:
+                lats, lngs, labels = load_places(self.path)
+                if not labels:
+                    raise ValueError('no places found')
+                xs, ys, zs = array('d'), array('d'), array('d')
+                for lat, lng in zip(lats, lngs):
+                    x, y, z = _unit_vector(lat, lng)
+                    xs.append(x)
+                    ys.append(y)
+                    zs.append(z)
+                if cKDTree is not None:
+                    import numpy as np
+                    self._tree = cKDTree(np.column_stack([xs, ys, zs]))
+                else:
+                    self._tree = KDTree(xs, ys, zs)
+                self._labels = labels
+                logger.info(f"Loaded {len(labels)} places for reverse geocoding from {self.path}")
+            except Exception as e:
+                self._unavailable = True
+                logger.info(f"Reverse geocoding disabled: {e}")
+
+    @property
+    def available(self):
+        self.load()
+        return self._tree is not None
+
+    @property
+    def loaded(self):
+        """Whether the index is built, without building it."""
+        return self._tree is not None
+
+    def _query(self, points):
+        """Labels for ``[(lat, lng)]`` straight from the tree."""
+        vectors = [_unit_vector(lat, lng) for lat, lng in points]
+        if cKDTree is not None:
+            chords, idx = self._tree.query(vectors)
+            pairs = zip(idx.tolist(), chords.tolist())
+        else:
+            pairs = ((i, math.sqrt(d2)) for i, d2 in (self._tree.nearest(*v) for v in vectors))
+        return [
+            self._labels[i] if i >= 0 and _chord_to_km(chord) <= self.max_distance_km else EMPTY
+            for i, chord in pairs
+        ]
+
+    def resolve_many(self, points):
+        """Labels for ``[(lat, lng)]``, in order; one tree query per distinct cell."""
+        if not self.available:
+            return [EMPTY] * len(points)
+        cells = [geohash.encode(lat, lng, CELL_PRECISION) for lat, lng in points]
+        found, missing = {}, []
+        with self._lock:
+            for cell in set(cells):
+                hit = self._cache.get(cell)
+                if hit is None:
+                    missing.append(cell)
+                else:
+                    self._cache.move_to_end(cell)
+                    found[cell] = hit
+                    self.hits += 1
+        if missing:
+            values = self._query([geohash.decode(cell) for cell in missing])
+            with self._lock:
+                self.misses += len(missing)
+                for cell, value in zip(missing, values):
+                    found[cell] = value
+                    if self.cache_size:
+                        self._cache[cell] = value
+                while len(self._cache) > self.cache_size:
+                    self._cache.popitem(last=False)
+        return [found[cell] for cell in cells]
+
+    def resolve(self, lat, lng):
+        return self.resolve_many([(lat, lng)])[0]
+
+
+_geocoder = None
+_geocoder_lock = threading.Lock()
+
+
+def get_geocoder():
+    """The process-wide ReverseGeocoder (built on first use)."""
+    global _geocoder
+    if _geocoder is None:
+        with _geocoder_lock:
+            if _geocoder is None:
+                _geocoder = ReverseGeocoder(
+                    str(getattr(settings, 'PLACES_DATASET_PATH', '') or ''),
+                    max_distance_km=getattr(settings, 'PLACES_MAX_DISTANCE_KM', 100),
+                    cache_size=getattr(settings, 'PLACES_CACHE_SIZE', 100000),
+                )
+    return _geocoder
+
+
+def warm_geocoder():
+    """Build the place index up front when fixes are resolved on ingest."""
+    if getattr(settings, 'PLACES_RESOLVE_ON_INGEST', True):
+        get_geocoder().load()
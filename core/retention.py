@@ -0,0 +1,253 @@
+"""
+RequestLog retention.
+
+On PostgreSQL ``core_requestlog`` is range-partitioned by month on
+``created_at`` (migration 0007), so dropping old logs is a ``DROP TABLE`` per
+month instead of a row-by-row DELETE. ``ensure_partitions()`` keeps the next
+few months' partitions created ahead of time; ``manage.py
+requestlog_partitions`` and ``core.tasks.maintain_request_logs_task`` call it.
+Rows for a month without a partition land in the DEFAULT partition; creating
+that month's partition moves them out of it first, since PostgreSQL refuses
+to add a partition whose range the DEFAULT partition already holds rows for.
+
+Migration 0007 leaves the rows logged before partitioning in
+``core_requestlog_legacy``; ``move_legacy_rows()`` moves them into the
+partitions in short batches and drops that table once it is empty.
+
+On other backends (SQLite in development and tests) the same functions fall
+back to deleting in bounded chunks.
+"""
+import datetime
+import logging
+import re
+
+from django.db import connection, transaction
+
+from .models import RequestLog
+
+logger = logging.getLogger('security')
+
+TABLE = RequestLog._meta.db_table
+DEFAULT_PARTITION = f'{TABLE}_pdefault'
+LEGACY_TABLE = f'{TABLE}_legacy'
+_PARTITION_NAME = re.compile(rf'^{TABLE}_p(\d{{4}})(\d{{2}})$')
+
+
+def month_start(dt):
+    return datetime.datetime(dt.year, dt.month, 1, tzinfo=datetime.timezone.utc)
+
+
+def next_month(start):
+    return start.replace(year=start.year + 1, month=1) if start.month == 12 else start.replace(month=start.month + 1)
+
+
+def partition_name(month_start):
+    return f'{TABLE}_p{month_start:%Y%m}'
+
+
+def is_partitioned():
+    if connection.vendor != 'postgresql':
+        return False
+    with connection.cursor() as cursor:
+        cursor.execute("SELECT relkind FROM pg_class WHERE relname = %s", [TABLE])
+        row = cursor.fetchone()
+    return bool(row) and row[0] == 'p'
+
+
+def list_partitions():
+    """``[(name, month_start, month_end)]`` of the monthly partitions, oldest first."""
+    if not is_partitioned():
+        return []
+    with connection.cursor() as cursor:
+        cursor.execute(
+            "SELECT c.relname FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid "
+            "JOIN pg_class p ON p.oid = i.inhparent WHERE p.relname = %s",
+            [TABLE],
+        )
+        names = [r[0] for r in cursor.fetchall()]
+    parts = []
+    for name in names:
+        m = _PARTITION_NAME.match(name)
+        if m:
+            start = datetime.datetime(int(m.group(1)), int(m.group(2)), 1, tzinfo=datetime.timezone.utc)
+            parts.append((name, start, next_month(start)))
+    return sorted(parts, key=lambda p: p[1])
+
+
+def _has_default_partition(cursor):
+    cursor.execute("SELECT 1 FROM pg_class WHERE relname = %s", [DEFAULT_PARTITION])
+    return cursor.fetchone() is not None
+
+
+def default_partition_months():
+    """Starts of the months with rows in the DEFAULT partition."""
+    if not is_partitioned():
+        return []
+    with connection.cursor() as cursor:
+        if not _has_default_partition(cursor):
+            return []
+        cursor.execute(
+            f"SELECT DISTINCT date_trunc('month', created_at AT TIME ZONE 'UTC') "
+            f"FROM {connection.ops.quote_name(DEFAULT_PARTITION)}"
+        )
+        return sorted(month_start(row[0]) for row in cursor.fetchall())
+
+
+def create_partition(month):
+    """
+    Create the partition for the month containing ``month`` if it is
+    missing, moving that month's rows out of the DEFAULT partition into it.
+    Inserts wait on the table lock while rows are moved.
+    """
+    start = month_start(month)
+    end = next_month(start)
+    name = partition_name(start)
+    qn = connection.ops.quote_name
+    with transaction.atomic(), connection.cursor() as cursor:
+        cursor.execute("SELECT 1 FROM pg_class WHERE relname = %s", [name])
+        if cursor.fetchone():
+            return
+        stray = 0
+        if _has_default_partition(cursor):
+            cursor.execute(
+                f"SELECT count(*) FROM {qn(DEFAULT_PARTITION)} WHERE created_at >= %s AND created_at < %s",
+                [start, end],
+            )
+            stray = cursor.fetchone()[0]
+        if stray:
+            cursor.execute(f"ALTER TABLE {qn(TABLE)} DETACH PARTITION {qn(DEFAULT_PARTITION)}")
+        cursor.execute(
+            f"CREATE TABLE {qn(name)} PARTITION OF {qn(TABLE)} FOR VALUES FROM (%s) TO (%s)",
+            [start, end],
+        )
+        if stray:
+            cursor.execute(
+                f"WITH moved AS (DELETE FROM {qn(DEFAULT_PARTITION)} WHERE created_at >= %s AND created_at < %s "
+                f"RETURNING *) INSERT INTO {qn(TABLE)} SELECT * FROM moved",
+                [start, end],
+            )
+            cursor.execute(f"ALTER TABLE {qn(TABLE)} ATTACH PARTITION {qn(DEFAULT_PARTITION)} DEFAULT")
+            logger.warning(f"Moved {stray} request logs from {DEFAULT_PARTITION} into {name}")
+
+
+def ensure_partitions(months_ahead=2, now=None):
+    """
+    Create partitions for the current month and ``months_ahead`` after it,
+    and for any month with rows left in the DEFAULT partition.
+    """
+    if not is_partitioned():
+        return []
+    start = month_start(now or datetime.datetime.now(datetime.timezone.utc))
+    months = set(default_partition_months())
+    for _ in range(max(0, int(months_ahead)) + 1):
+        months.add(start)
+        start = next_month(start)
+    existing = {name for name, _, _ in list_partitions()}
+    created = []
+    for month in sorted(months):
+        if partition_name(month) not in existing:
+            create_partition(month)
+            created.append(partition_name(month))
+    return created
+
+
+def move_legacy_rows(batch_size=5000, max_batches=None):
+    """
+    Move rows left in ``core_requestlog_legacy`` by migration 0007 into the
+    partitioned table, ``batch_size`` ids per transaction, and drop the legacy
+    table once it is empty. Rows whose user has since been deleted lose the
+    user, as ``on_delete=SET_NULL`` would have done. Their hours are marked for
+    a rollup rebuild. Returns the number of rows moved.
+    """
+    from .rollups import mark_late_rows
+    if not is_partitioned():
+        return 0
+    qn = connection.ops.quote_name
+    legacy, table = qn(LEGACY_TABLE), qn(TABLE)
+    users = qn(RequestLog._meta.get_field('user').related_model._meta.db_table)
+    with connection.cursor() as cursor:
+        cursor.execute("SELECT 1 FROM pg_class WHERE relname = %s", [LEGACY_TABLE])
+        if not cursor.fetchone():
+            return 0
+        legacy_columns = {c.name for c in connection.introspection.get_table_description(cursor, LEGACY_TABLE)}
+    # Columns added since the migration are filled with their defaults
+    columns, values, defaults = [], [], []
+    for field in RequestLog._meta.concrete_fields:
+        columns.append(qn(field.column))
+        if field.column in legacy_columns:
+            values.append(qn(field.column))
+        else:
+            values.append('%s')
+            defaults.append(field.get_db_prep_save(field.get_default(), connection))
+    columns, values = ', '.join(columns), ', '.join(values)
+    moved = batches = 0
+    while max_batches is None or batches < max_batches:
+        with transaction.atomic(), connection.cursor() as cursor:
+            cursor.execute(f"SELECT min(id) FROM {legacy}")
+            low = cursor.fetchone()[0]
+            if low is None:
+                cursor.execute(f"DROP TABLE {legacy}")
+                logger.info(f"Moved every legacy request log; dropped {LEGACY_TABLE}")
+                break
+            high = low + batch_size
+            cursor.execute(
+                f"UPDATE {legacy} SET user_id = NULL WHERE id >= %s AND id < %s "
+                f"AND user_id IS NOT NULL AND user_id NOT IN (SELECT id FROM {users})",
+                [low, high],
+            )
+            cursor.execute(
+                f"WITH rows AS (DELETE FROM {legacy} WHERE id >= %s AND id < %s RETURNING *) "
+                f"INSERT INTO {table} ({columns}) SELECT {values} FROM rows RETURNING created_at",
+                [low, high, *defaults],
+            )
+            created = [row[0] for row in cursor.fetchall()]
+        moved += len(created)
+        batches += 1
+        mark_late_rows(created)
+    return moved
+
+
+def _chunked_delete(qs, chunk_size):
+    deleted = 0
+    while True:
+        ids = list(qs.values_list('pk', flat=True)[:chunk_size])
+        if not ids:
+            return deleted
+        with transaction.atomic():
+            n, _ = RequestLog.objects.filter(pk__in=ids).delete()
+        deleted += n
+
+
+def purge_request_logs(cutoff, chunk_size=5000):
+    """
+    Remove request logs created before ``cutoff``. Whole months are dropped
+    as partitions; the remainder of the month containing ``cutoff`` (or
+    everything, when not partitioned) is deleted in chunks. Returns
+    ``{'dropped_partitions': [...], 'deleted_rows': n}``; rows in dropped
+    partitions are counted from the planner's estimate.
+    """
+    dropped, estimated = [], 0
+    if is_partitioned():
+        qn = connection.ops.quote_name
+        for name, _, end in list_partitions():
+            if end > cutoff:
+                break
+            with connection.cursor() as cursor:
+                cursor.execute("SELECT GREATEST(reltuples, 0)::bigint FROM pg_class WHERE relname = %s", [name])
+                row = cursor.fetchone()
+                estimated += int(row[0]) if row else 0
+                cursor.execute(f"DROP TABLE {qn(name)}")
+            dropped.append(name)
+            logger.info(f"Dropped request log partition {name}")
+    deleted = _chunked_delete(RequestLog.objects.filter(created_at__lt=cutoff), chunk_size)
+    return {'dropped_partitions': dropped, 'deleted_rows': estimated + deleted}
+
+
+def truncate_request_logs(chunk_size=5000):
+    """Remove every request log; ``TRUNCATE`` on PostgreSQL, chunked delete elsewhere."""
+    if connection.vendor == 'postgresql':
+        count = RequestLog.objects.count()
+        with connection.cursor() as cursor:
+            cursor.execute(f"TRUNCATE {connection.ops.quote_name(TABLE)}")
+        return count
+    return _chunked_delete(RequestLog.objects.all(), chunk_size)
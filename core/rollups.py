@@ -0,0 +1,362 @@
+"""
+Hourly request rollups behind the analytics console.
+
+``build_rollups()`` folds raw ``RequestLog`` rows into ``RequestRollup``
+(hour × route × status class × country/region × authenticated/staff/i18n
+flags) and ``RequestUserRollup`` (hour × user), one closed hour at a time,
+and advances a watermark in ``RollupState``. Only hours past the watermark
+are read, so the periodic job (``manage.py build_request_rollups`` or
+``core.tasks.build_request_rollups_task``) stays cheap however much history
+there is.
+
+Rows can still arrive for hours that are already rolled up: a replayed spool
+or a batch the log writer could not flush in time (``core.logsink``). The
+writer marks those hours with ``mark_late_rows()`` (``RollupDirtyHour``) and
+the next ``build_rollups()`` rebuilds them.
+
+Distinct users, IPs and countries are kept as mergeable HyperLogLog sketches
+per hour (``RequestSketch``), so distinct counts for any period come from
+merging a few thousand small registers rather than a COUNT(DISTINCT) scan.
+
+``request_summary()`` answers the analytics page from the rollups and reads
+raw rows only for the part of the period after the watermark (the current,
+still-open hour).
+"""
+import datetime
+import re
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import BooleanField, Case, F, Q, Sum, Value, When
+from django.db.models.functions import TruncDay, TruncHour
+from django.utils import timezone
+
+from .hll import HyperLogLog
+from .models import (
+    LatencyHistogram, RequestLog, RequestRollup, RequestSketch, RequestUserRollup, RollupDirtyHour, RollupState,
+)
+
+ROLLUP_NAME = 'requests'
+
+_LANG_PREFIX = re.compile(r'^/([a-z]{2})(/|$)')
+# Requests for /i18n/ or under a language prefix
+I18N_Q = Q(path__startswith='/i18n/') | Q(path__regex=_LANG_PREFIX.pattern)
+
+
+def floor_hour(dt):
+    return dt.astimezone(datetime.timezone.utc).replace(minute=0, second=0, microsecond=0)
+
+
+def normalize_path(path):
+    """Path without query string or language prefix (``/en/projects/`` -> ``/projects/``)."""
+    base = (path or '').split('?', 1)[0]
+    parts = base.split('/')
+    if len(parts) > 2 and len(parts[1]) == 2:
+        base = '/' + '/'.join(parts[2:])
+    return base[:255]
+
+
+def request_route(request, path=None):
+    """
+    Route a request is counted under: the resolved URL pattern
+    (``/projects/<int:pk>/``), or the cleaned path when nothing matched.
+    """
+    match = getattr(request, 'resolver_match', None)
+    if match is not None and match.route:
+        return normalize_path('/' + match.route.lstrip('^').rstrip('$'))
+    return normalize_path(path if path is not None else request.get_full_path())
+
+
+def status_class(status):
+    status = int(status or 0)
+    return status // 100 if 200 <= status < 600 else 0
+
+
+def _rollup_window(start, end):
+    """(Re)build the rollups for hours in ``[start, end)``."""
+    logs = RequestLog.objects.filter(created_at__gte=start, created_at__lt=end).annotate(
+        hour=TruncHour('created_at', tzinfo=datetime.timezone.utc),
+        authed=Case(When(user__isnull=False, then=Value(True)), default=Value(False), output_field=BooleanField()),
+        i18n=Case(When(I18N_Q, then=Value(True)), default=Value(False), output_field=BooleanField()),
+    )
+    rows = {}
+    for r in (
+        logs.values('hour', 'route', 'status', 'country', 'region', 'authed', 'user__is_staff', 'i18n')
+        .annotate(n=Sum('sample_weight'), ms=Sum(F('duration_ms') * F('sample_weight')))
+        .iterator()
+    ):
+        key = (
+            r['hour'], r['route'], status_class(r['status']),
+            r['country'] or '', r['region'] or '', r['authed'], bool(r['user__is_staff']), r['i18n'],
+        )
+        acc = rows.setdefault(key, [0, 0])
+        acc[0] += r['n']
+        acc[1] += r['ms'] or 0
+
+    users = {}
+    for r in (
+        logs.filter(user__isnull=False)
+        .values('hour', 'user_id', 'user__is_staff', 'i18n')
+        .annotate(n=Sum('sample_weight'))
+        .iterator()
+    ):
+        key = (r['hour'], r['user_id'], bool(r['user__is_staff']), r['i18n'])
+        users[key] = users.get(key, 0) + r['n']
+
+    sketches = {}
+    for r in (
+        logs.values('hour', 'user__is_staff', 'i18n', 'user_id', 'ip', 'country')
+        .distinct()
+        .iterator()
+    ):
+        key = (r['hour'], bool(r['user__is_staff']), r['i18n'])
+        if key not in sketches:
+            sketches[key] = (HyperLogLog(), HyperLogLog(), HyperLogLog())
+        hll_users, hll_ips, hll_countries = sketches[key]
+        if r['user_id']:
+            hll_users.add(r['user_id'])
+        if r['ip']:
+            hll_ips.add(r['ip'])
+        if r['country']:
+            hll_countries.add(r['country'])
+
+    with transaction.atomic():
+        RequestRollup.objects.filter(bucket__gte=start, bucket__lt=end).delete()
+        RequestUserRollup.objects.filter(bucket__gte=start, bucket__lt=end).delete()
+        RequestSketch.objects.filter(bucket__gte=start, bucket__lt=end).delete()
+        RequestRollup.objects.bulk_create([
+            RequestRollup(
+                bucket=hour, route=route, status_class=sc, country=country, region=region,
+                is_authenticated=authed, is_staff=staff, is_i18n=i18n, count=n, duration_ms_sum=ms,
+            )
+            for (hour, route, sc, country, region, authed, staff, i18n), (n, ms) in rows.items()
+        ], batch_size=1000)
+        RequestUserRollup.objects.bulk_create([
+            RequestUserRollup(bucket=hour, user_id=uid, is_staff=staff, is_i18n=i18n, count=n)
+            for (hour, uid, staff, i18n), n in users.items()
+        ], batch_size=1000)
+        RequestSketch.objects.bulk_create([
+            RequestSketch(
+                bucket=hour, is_staff=staff, is_i18n=i18n,
+                users=u.to_bytes(), ips=ip.to_bytes(), countries=c.to_bytes(),
+            )
+            for (hour, staff, i18n), (u, ip, c) in sketches.items()
+        ], batch_size=200)
+    return len(rows)
+
+
+def _closed_until(now=None):
+    lag = getattr(settings, 'REQUEST_ROLLUP_LAG_SECONDS', 300)
+    return floor_hour((now or timezone.now()) - datetime.timedelta(seconds=lag))
+
+
+def mark_late_rows(timestamps):
+    """
+    Record the hours of just-written rows that ``build_rollups()`` may
+    already have closed, so they are rolled up again. Call after the rows are
+    committed. Returns the number of hours marked.
+    """
+    now = timezone.now()
+    closed = _closed_until(now)
+    hours = {floor_hour(ts) for ts in timestamps if ts is not None}
+    hours = sorted(hour for hour in hours if hour < closed)
+    if hours:
+        RollupDirtyHour.objects.bulk_create(
+            [RollupDirtyHour(bucket=hour, marked_at=now) for hour in hours],
+            update_conflicts=True, unique_fields=['bucket'], update_fields=['marked_at'],
+        )
+    return len(hours)
+
+
+def build_rollups(until=None, since=None, chunk_hours=24):
+    """
+    Roll up every closed hour after the watermark (or from ``since``, to
+    rebuild) up to ``until``. An hour is closed once
+    ``REQUEST_ROLLUP_LAG_SECONDS`` have passed since its end, so rows still
+    sitting in the log writer's queue are not missed; hours marked by
+    ``mark_late_rows()`` behind the watermark are rebuilt afterwards.
+    Returns the number of rollup rows written.
+    """
+    until = _closed_until() if until is None else floor_hour(until)
+    state, _ = RollupState.objects.get_or_create(name=ROLLUP_NAME)
+    start = floor_hour(since) if since else state.watermark
+    if start is None:
+        first = RequestLog.objects.order_by('created_at').values_list('created_at', flat=True).first()
+        start = floor_hour(first) if first else until
+    written = 0
+    step = datetime.timedelta(hours=max(1, int(chunk_hours)))
+    while start < until:
+        end = min(start + step, until)
+        written += _rollup_window(start, end)
+        state.watermark = end
+        state.save(update_fields=['watermark', 'updated_at'])
+        start = end
+    if state.watermark is None or state.watermark < until:
+        state.watermark = until
+        state.save(update_fields=['watermark', 'updated_at'])
+    hour = datetime.timedelta(hours=1)
+    for dirty in RollupDirtyHour.objects.filter(bucket__lt=state.watermark).order_by('bucket'):
+        written += _rollup_window(dirty.bucket, dirty.bucket + hour)
+        # A row that landed during the rebuild re-marked the hour; keep that mark
+        RollupDirtyHour.objects.filter(pk=dirty.pk, marked_at__lte=dirty.marked_at).delete()
+    return written
+
+
+def reset_rollups():
+    """Drop all rollups, latency histograms and the watermark (after purging every raw log)."""
+    RequestRollup.objects.all().delete()
+    RequestUserRollup.objects.all().delete()
+    RequestSketch.objects.all().delete()
+    LatencyHistogram.objects.all().delete()
+    RollupDirtyHour.objects.all().delete()
+    RollupState.objects.filter(name=ROLLUP_NAME).delete()
+
+
+def _merge(key_fields, *sources, limit=None):
+    """Sum the value columns of row sources sharing ``key_fields``; biggest ``count`` first."""
+    totals = {}
+    for rows in sources:
+        for r in rows:
+            key = tuple(r[f] for f in key_fields)
+            acc = totals.setdefault(key, {})
+            for name, value in r.items():
+                if name not in key_fields:
+                    acc[name] = acc.get(name, 0) + (value or 0)
+    merged = [dict(zip(key_fields, key), **values) for key, values in totals.items()]
+    merged.sort(key=lambda r: -r['count'])
+    return merged[:limit] if limit else merged
+
+
+def _estimate_distinct(sketches, raw):
+    """Merge the hourly sketches and fold in the raw tail's values."""
+    users, ips, countries = HyperLogLog(), HyperLogLog(), HyperLogLog()
+    for u, ip, c in sketches.values_list('users', 'ips', 'countries').iterator():
+        users.merge(HyperLogLog.from_bytes(u))
+        ips.merge(HyperLogLog.from_bytes(ip))
+        countries.merge(HyperLogLog.from_bytes(c))
+    for uid, ip, country in raw.values_list('user_id', 'ip', 'country').distinct().iterator():
+        if uid:
+            users.add(uid)
+        if ip:
+            ips.add(ip)
+        if country:
+            countries.add(country)
+    return {'users': users.count(), 'ips': ips.count(), 'countries': countries.count()}
+
+
+def request_summary(since, exclude_staff=False, hide_i18n=False, exact=False):
+    """
+    Figures for the analytics page over ``[since, now)``. Distinct counts are
+    HyperLogLog estimates unless ``exact`` is set, which recounts them from
+    raw rows (slow on long periods).
+    """
+    watermark = RollupState.objects.filter(name=ROLLUP_NAME).values_list('watermark', flat=True).first()
+    since_hour = floor_hour(since)
+    if watermark and watermark > since_hour:
+        roll = RequestRollup.objects.filter(bucket__gte=since_hour, bucket__lt=watermark)
+        roll_users = RequestUserRollup.objects.filter(bucket__gte=since_hour, bucket__lt=watermark)
+        roll_sketches = RequestSketch.objects.filter(bucket__gte=since_hour, bucket__lt=watermark)
+        raw = RequestLog.objects.filter(created_at__gte=watermark)
+    else:
+        roll = RequestRollup.objects.none()
+        roll_users = RequestUserRollup.objects.none()
+        roll_sketches = RequestSketch.objects.none()
+        raw = RequestLog.objects.filter(created_at__gte=since)
+    full = RequestLog.objects.filter(created_at__gte=since)
+    if exclude_staff:
+        roll = roll.filter(is_staff=False)
+        roll_users = roll_users.filter(is_staff=False)
+        roll_sketches = roll_sketches.filter(is_staff=False)
+        raw = raw.exclude(user__is_staff=True)
+        full = full.exclude(user__is_staff=True)
+    if hide_i18n:
+        roll = roll.filter(is_i18n=False)
+        roll_users = roll_users.filter(is_i18n=False)
+        roll_sketches = roll_sketches.filter(is_i18n=False)
+        raw = raw.exclude(I18N_Q)
+        full = full.exclude(I18N_Q)
+
+    # Raw rows count by sample weight (core.logrules), like the rollups do
+    weighted = Sum('sample_weight')
+    total = (roll.aggregate(n=Sum('count'))['n'] or 0) + (raw.aggregate(n=weighted)['n'] or 0)
+    errors = (
+        (roll.filter(status_class__gte=4).aggregate(n=Sum('count'))['n'] or 0)
+        + (raw.filter(status__gte=400).aggregate(n=weighted)['n'] or 0)
+    )
+
+    countries = _merge(
+        ('country',),
+        roll.values('country').annotate(count=Sum('count')),
+        raw.values('country').annotate(count=weighted),
+    )
+    regions = _merge(
+        ('country', 'region'),
+        roll.values('country', 'region').annotate(count=Sum('count')),
+        raw.values('country', 'region').annotate(count=weighted),
+        limit=20,
+    )
+    anonymous = (roll.filter(is_authenticated=False).aggregate(n=Sum('count'))['n'] or 0)
+    by_user = _merge(
+        ('user__username',),
+        roll_users.values('user__username').annotate(count=Sum('count')),
+        [{'user__username': None, 'count': anonymous}] if anonymous else [],
+        raw.values('user__username').annotate(count=weighted),
+        limit=20,
+    )
+    if exact:
+        distinct = {
+            'users': full.exclude(user__isnull=True).values('user').distinct().count(),
+            'ips': full.exclude(ip__isnull=True).values('ip').distinct().count(),
+            'countries': full.exclude(country='').values('country').distinct().count(),
+        }
+    else:
+        distinct = _estimate_distinct(roll_sketches, raw)
+
+    # errors first: once annotated, 'count' names the Sum, not the column
+    roll_errors = Sum('count', filter=Q(status_class__gte=4))
+    raw_errors = Sum('sample_weight', filter=Q(status__gte=400))
+    top_routes = _merge(
+        ('route',),
+        roll.values('route').annotate(errors=roll_errors, count=Sum('count')),
+        raw.values('route').annotate(count=weighted, errors=raw_errors),
+        limit=20,
+    )
+
+    buckets = {'2xx': 0, '3xx': 0, '4xx': 0, '5xx': 0}
+    for r in roll.values('status_class').annotate(count=Sum('count')):
+        if r['status_class']:
+            buckets[f"{r['status_class']}xx"] += r['count']
+    for r in raw.values('status').annotate(count=weighted):
+        sc = status_class(r['status'])
+        if sc:
+            buckets[f'{sc}xx'] += r['count']
+
+    per_day = _merge(
+        ('d',),
+        roll.annotate(d=TruncDay('bucket')).values('d').annotate(count=Sum('count')),
+        raw.annotate(d=TruncDay('created_at')).values('d').annotate(count=weighted),
+    )
+    per_day.sort(key=lambda r: r['d'])
+
+    return {
+        'total_requests': total,
+        'errors': errors,
+        'unique_users': distinct['users'],
+        'unique_ips': distinct['ips'],
+        'unique_countries': distinct['countries'],
+        'distinct_exact': exact,
+        'distinct_error_pct': 0.0 if exact else round(HyperLogLog().relative_error * 100, 1),
+        'by_country': countries[:20],
+        'by_region': regions,
+        'by_user': by_user,
+        'top_paths': [
+            {
+                'path': r['route'], 'count': r['count'], 'errors': r['errors'],
+                'error_rate': round(r['errors'] * 100.0 / r['count'], 1) if r['count'] else 0.0,
+            }
+            for r in top_routes
+        ],
+        'status_buckets': buckets,
+        'per_day': per_day,
+        'rolled_up_to': watermark,
+    }
@@ -0,0 +1,80 @@
+from celery import shared_task
+import logging
+
+logger = logging.getLogger('security')
+
+
+@shared_task
+def build_request_rollups_task() -> dict:
+    """
+    Periodic analytics rollup: fold request logs for newly closed hours into
+    the hourly rollup tables. See ``core.rollups``.
+    """
+    from .rollups import build_rollups
+    try:
+        written = build_rollups()
+        return { 'ok': True, 'rows': written }
+    except Exception as e:
+        logger.error(f"Request rollup failed: {e}")
+        return { 'ok': False, 'error': str(e) }
+
+
+@shared_task
+def maintain_request_logs_task() -> dict:
+    """
+    Periodic RequestLog upkeep: create upcoming partitions, move rows logged
+    before partitioning into them and apply REQUEST_LOG_RETENTION_DAYS. See
+    ``core.retention``.
+    """
+    from django.conf import settings
+    from django.utils import timezone
+    from .retention import ensure_partitions, move_legacy_rows, purge_request_logs
+    try:
+        created = ensure_partitions(months_ahead=getattr(settings, 'REQUEST_LOG_PARTITIONS_AHEAD', 2))
+        moved = move_legacy_rows()
+        result = {'dropped_partitions': [], 'deleted_rows': 0}
+        days = getattr(settings, 'REQUEST_LOG_RETENTION_DAYS', 0)
+        if days:
+            result = purge_request_logs(timezone.now() - timezone.timedelta(days=days))
+        return { 'ok': True, 'created_partitions': created, 'moved_legacy_rows': moved, **result }
+    except Exception as e:
+        logger.error(f"Request log maintenance failed: {e}")
+        return { 'ok': False, 'error': str(e) }
+
+
+@shared_task
+def archive_telemetry_task() -> dict:
+    """Move request logs and device locations past TELEMETRY_ARCHIVE_AFTER_DAYS into the cold archive."""
+    from django.conf import settings
+    from django.utils import timezone
+    from .archive import MODELS, archive_telemetry
+    days = getattr(settings, 'TELEMETRY_ARCHIVE_AFTER_DAYS', 0)
+    if not days:
+        return { 'ok': True, 'skipped': True }
+    try:
+        cutoff = timezone.now() - timezone.timedelta(days=days)
+        return { 'ok': True, **{kind: archive_telemetry(kind, cutoff) for kind in MODELS} }
+    except Exception as e:
+        logger.error(f"Telemetry archive failed: {e}")
+        return { 'ok': False, 'error': str(e) }
+
+
+@shared_task
+def compact_device_locations_task() -> dict:
+    """Thin device-location history past DEVICE_LOCATION_COMPACT_AFTER_DAYS (core.trajectory)."""
+    from django.conf import settings
+    from django.utils import timezone
+    from .trajectory import compact_locations
+    days = getattr(settings, 'DEVICE_LOCATION_COMPACT_AFTER_DAYS', 0)
+    if not days:
+        return { 'ok': True, 'skipped': True }
+    try:
+        result = compact_locations(
+            timezone.now() - timezone.timedelta(days=days),
+            tolerance_m=getattr(settings, 'DEVICE_LOCATION_COMPACT_TOLERANCE_M', 25),
+            max_gap=timezone.timedelta(minutes=getattr(settings, 'DEVICE_LOCATION_COMPACT_MAX_GAP_MINUTES', 360)),
+        )
+        return { 'ok': True, **result }
+    except Exception as e:
+        logger.error(f"Device location compaction failed: {e}")
+        return { 'ok': False, 'error': str(e) }
@@ -1,3 +1,360 @@
-from django.test import TestCase
+import datetime
+import json
+import math
+import os
+import random
+import shutil
+import tempfile
+from unittest import mock, skipUnless
 
-# Create your tests here.
+from django.contrib.auth.models import User
+from django.db import OperationalError, connection
+from django.test import TestCase, override_settings
+from django.urls import reverse
+
+from . import geohash
+from .archive import archive_day, archive_summary, archive_telemetry, iter_rows
+from .exports import csv_lines
+from .hll import HyperLogLog
+from .latency import bucket_index, record_latencies
+from .locations import haversine_m, ingest_fixes
+from .logsink import RequestLogSink
+from .places import KDTree
+from .models import DeviceLocation, LatencyHistogram, RequestLog, RequestRollup, RollupDirtyHour
+from .retention import (
+    LEGACY_TABLE, default_partition_months, ensure_partitions, list_partitions, move_legacy_rows, partition_name,
+)
+from .rollups import build_rollups, request_summary
+from .trajectory import compact_user, simplify
+
+UTC = datetime.timezone.utc
+
+
+def _log(created_at, path='/en/'):
+    return RequestLog.objects.create(method='GET', path=path, route=path, status=200, duration_ms=5,
+                                     created_at=created_at)
+
+
+class HyperLogLogTests(TestCase):
+    def test_merge_equals_sketch_of_union(self):
+        a = HyperLogLog().update(f'ip-{i}' for i in range(0, 30000))
+        b = HyperLogLog().update(f'ip-{i}' for i in range(20000, 50000))
+        union = HyperLogLog().update(f'ip-{i}' for i in range(0, 50000))
+        merged = HyperLogLog.from_bytes(a.to_bytes()).merge(b)
+        self.assertEqual(merged.registers, union.registers)
+        self.assertEqual(merged.registers, bytearray(map(max, a.registers, b.registers)))
+        self.assertLess(abs(merged.count() - 50000) / 50000, 4 * merged.relative_error)
+
+    def test_small_counts_are_near_exact(self):
+        self.assertEqual(HyperLogLog().update(['a', 'b', 'c', 'a']).count(), 3)
+
+    def test_merge_rejects_other_precision(self):
+        with self.assertRaises(ValueError):
+            HyperLogLog(p=10).merge(HyperLogLog(p=12))
+
+
+class ArchiveSegmentTests(TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root, ignore_errors=True)
+        self.user = User.objects.create_user('archived', password='x')
+        self.day = datetime.datetime(2026, 2, 3, tzinfo=UTC)
+
+    def test_request_rows_round_trip(self):
+        logs = [
+            RequestLog.objects.create(method='GET', path='/en/a', route='/a', status=200, duration_ms=12,
+                                      ip='10.0.0.1', country='Germany', user=self.user,
+                                      created_at=self.day + datetime.timedelta(hours=1, microseconds=7)),
+            RequestLog.objects.create(method='POST', path='/en/b', route='/b', status=500, duration_ms=340,
+                                      sql_ms=1.5, created_at=self.day + datetime.timedelta(hours=5)),
+        ]
+        self.assertEqual(archive_day('requests', self.day, root=self.root), 2)
+        # Re-running after a failure must not duplicate rows
+        self.assertEqual(archive_day('requests', self.day, root=self.root), 0)
+        rows = list(iter_rows('requests', root=self.root))
+        self.assertEqual([r['id'] for r in rows], [log.pk for log in logs])
+        self.assertEqual([r['created_at'] for r in rows], [log.created_at for log in logs])
+        self.assertEqual([(r['method'], r['path'], r['status']) for r in rows],
+                         [('GET', '/en/a', 200), ('POST', '/en/b', 500)])
+        self.assertEqual([(r['ip'], r['user_id'], r['sql_ms']) for r in rows],
+                         [('10.0.0.1', self.user.pk, 0.0), ('', -1, 1.5)])
+        summary = archive_summary(self.day, self.day + datetime.timedelta(days=1), root=self.root)
+        self.assertEqual((summary['total_requests'], summary['errors'], summary['unique_users']), (2, 1, 1))
+
+    def test_location_rows_round_trip(self):
+        DeviceLocation.objects.create(user=self.user, latitude='52.520008', longitude='13.404954',
+                                      geohash='u33dc0cpnn', country='Germany', region='Berlin', city='Berlin',
+                                      created_at=self.day + datetime.timedelta(hours=2))
+        archive_day('locations', self.day, root=self.root)
+        row = next(iter_rows('locations', root=self.root))
+        self.assertEqual((row['latitude'], row['longitude']), (52.520008, 13.404954))
+        self.assertTrue(math.isnan(row['accuracy_m']))
+        self.assertEqual((row['geohash'], row['country'], row['region'], row['city']),
+                         ('u33dc0cpnn', 'Germany', 'Berlin', 'Berlin'))
+
+
+class GeohashTests(TestCase):
+    def test_encode_known_cell(self):
+        self.assertEqual(geohash.encode(57.64911, 10.40744, 11), 'u4pruydqqvj')
+        self.assertEqual(geohash.encode(57.64911, 10.40744), 'u4pruydqq')
+
+    def test_bounds_contain_point_and_nest(self):
+        lat, lng = -33.8688, 151.2093
+        code = geohash.encode(lat, lng)
+        outer = None
+        for precision in range(1, len(code) + 1):
+            south, west, north, east = geohash.bounds(code[:precision])
+            self.assertTrue(south <= lat < north and west <= lng < east)
+            if outer is not None:
+                self.assertTrue(outer[0] <= south and outer[1] <= west and north <= outer[2] and east <= outer[3])
+            outer = (south, west, north, east)
+        # Nine characters are about 4.8 m across
+        self.assertLess(haversine_m(south, west, north, west), 5)
+        self.assertEqual(geohash.encode(*geohash.decode(code)), code)
+
+
+class TrajectoryTests(TestCase):
+    def test_constant_speed_line_keeps_endpoints(self):
+        points = [(52.0 + i * 0.001, 13.0, i * 10.0) for i in range(20)]
+        self.assertEqual(simplify(points, 5), [0, 19])
+
+    def test_timing_deviation_is_kept(self):
+        # Same straight path, but the device waits at the fourth fix
+        points = [(52.0 + i * 0.001, 13.0, i * 10.0) for i in range(4)]
+        points += [(52.0 + i * 0.001, 13.0, 300 + i * 10.0) for i in range(3, 8)]
+        kept = simplify(points, 5)
+        self.assertIn(3, kept)
+        self.assertIn(4, kept)
+
+    def test_detour_beyond_tolerance_is_kept(self):
+        points = [(52.0, 13.0, 0), (52.0005, 13.001, 10), (52.001, 13.0, 20)]
+        self.assertEqual(simplify(points, 5), [0, 1, 2])
+        self.assertEqual(simplify(points, 100), [0, 2])
+
+    def test_chunk_boundaries_anchor_the_next_chunk(self):
+        user = User.objects.create_user('traveller', password='x')
+        start = datetime.datetime(2025, 6, 1, tzinfo=UTC)
+        pks = [DeviceLocation.objects.create(user=user, latitude=52.0 + i * 0.001, longitude=13.0,
+                                             created_at=start + datetime.timedelta(seconds=10 * i)).pk
+               for i in range(10)]
+        examined, removed = compact_user(user.pk, None, start + datetime.timedelta(days=1), chunk_size=4)
+        self.assertEqual((examined, removed), (10, 6))
+        kept = list(DeviceLocation.objects.filter(user=user).order_by('created_at').values_list('pk', flat=True))
+        self.assertEqual(kept, [pks[0], pks[3], pks[6], pks[9]])
+
+
+class KDTreeTests(TestCase):
+    def test_nearest_matches_brute_force(self):
+        rng = random.Random(7)
+        points = [(rng.uniform(-1, 1), rng.uniform(-1, 1), rng.uniform(-1, 1)) for _ in range(500)]
+        tree = KDTree(*zip(*points))
+        for _ in range(200):
+            q = (rng.uniform(-1, 1), rng.uniform(-1, 1), rng.uniform(-1, 1))
+            d2 = [sum((a - b) ** 2 for a, b in zip(p, q)) for p in points]
+            index, dist = tree.nearest(*q)
+            self.assertEqual(index, d2.index(min(d2)))
+            self.assertAlmostEqual(dist, min(d2))
+
+
+class ArchiveWatermarkTests(TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root, ignore_errors=True)
+        self.start = datetime.datetime(2026, 1, 1, tzinfo=UTC)
+        for day in range(10):
+            for hour in (3, 15):
+                _log(self.start + datetime.timedelta(days=day, hours=hour))
+
+    def test_nothing_archived_before_first_rollup(self):
+        result = archive_telemetry('requests', self.start + datetime.timedelta(days=30), root=self.root)
+        self.assertEqual(result, {'days': 0, 'archived': 0, 'deleted': 0})
+        self.assertEqual(RequestLog.objects.count(), 20)
+
+    def test_only_rolled_up_rows_are_deleted(self):
+        # Watermark mid-way through day 4: days 0-3 are fully rolled up
+        build_rollups(until=self.start + datetime.timedelta(days=4, hours=10))
+        rolled = sum(RequestRollup.objects.values_list('count', flat=True))
+        result = archive_telemetry('requests', self.start + datetime.timedelta(days=30), root=self.root)
+        self.assertEqual(result['deleted'], 8)
+        self.assertLessEqual(result['deleted'], rolled)
+        remaining = RequestLog.objects.order_by('created_at').values_list('created_at', flat=True)
+        self.assertEqual(remaining.first(), self.start + datetime.timedelta(days=4, hours=3))
+        self.assertEqual(len(remaining), 12)
+
+
+@override_settings(PLACES_RESOLVE_ON_INGEST=False)
+class IngestFixesTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user('walker', password='x')
+        self.now = datetime.datetime(2026, 3, 1, 12, tzinfo=UTC)
+
+    def _fix(self, minutes, lat):
+        ts = (self.now - datetime.timedelta(minutes=minutes)).timestamp() * 1000
+        return {'latitude': lat, 'longitude': 13.4, 'accuracy': 5, 'ts': ts}
+
+    def test_resent_batch_is_not_stored_twice(self):
+        batch = [self._fix(30, 52.50), self._fix(20, 52.51), self._fix(10, 52.52)]
+        self.assertEqual(ingest_fixes(self.user, batch, now=self.now), (3, 0))
+        self.assertEqual(ingest_fixes(self.user, batch, now=self.now), (0, 3))
+        self.assertEqual(DeviceLocation.objects.filter(user=self.user).count(), 3)
+
+    def test_overlapping_batch_keeps_only_newer_fixes(self):
+        ingest_fixes(self.user, [self._fix(30, 52.50), self._fix(20, 52.51)], now=self.now)
+        stored, dropped = ingest_fixes(self.user, [self._fix(20, 52.51), self._fix(5, 52.53)], now=self.now)
+        self.assertEqual((stored, dropped), (1, 1))
+        latest = DeviceLocation.objects.filter(user=self.user).latest('created_at')
+        self.assertEqual(latest.created_at, self.now - datetime.timedelta(minutes=5))
+
+
+@skipUnless(connection.vendor == 'postgresql', 'RequestLog is only partitioned on PostgreSQL')
+class PartitionTests(TestCase):
+    def test_default_partition_rows_move_into_new_partition(self):
+        month = datetime.datetime(2031, 7, 1, tzinfo=UTC)
+        _log(month + datetime.timedelta(days=3))
+        _log(month + datetime.timedelta(days=40))
+        self.assertEqual(default_partition_months(), [month, datetime.datetime(2031, 8, 1, tzinfo=UTC)])
+        created = ensure_partitions(months_ahead=0)
+        self.assertIn(partition_name(month), created)
+        self.assertIn(partition_name(month), [name for name, _, _ in list_partitions()])
+        self.assertEqual(default_partition_months(), [])
+        self.assertEqual(RequestLog.objects.filter(created_at__gte=month).count(), 2)
+
+    def test_legacy_rows_move_in_batches(self):
+        # As left by migration 0007, before later migrations added columns
+        created_at = datetime.datetime(2026, 1, 5, 10, tzinfo=UTC)
+        with connection.cursor() as cursor:
+            cursor.execute(f"CREATE TABLE {LEGACY_TABLE} (LIKE core_requestlog)")
+            for column in ('sample_weight', 'sql_count', 'sql_ms', 'cache_hits', 'cache_misses', 'cache_ms',
+                           'template_ms', 'media_ms'):
+                cursor.execute(f"ALTER TABLE {LEGACY_TABLE} DROP COLUMN {column}")
+            for pk in range(1000001, 1000006):
+                cursor.execute(
+                    f"INSERT INTO {LEGACY_TABLE} (id, method, path, route, status, duration_ms, created_at, "
+                    f"user_id, user_agent, country, region, city) "
+                    f"VALUES (%s, 'GET', '/en/', '/', 200, 5, %s, 987654, '', '', '', '')",
+                    [pk, created_at],
+                )
+        self.assertEqual(move_legacy_rows(batch_size=2, max_batches=1), 2)
+        self.assertEqual(move_legacy_rows(batch_size=2), 3)
+        moved = RequestLog.objects.filter(pk__gt=1000000)
+        self.assertEqual(list(moved.values_list('sample_weight', 'user_id').distinct()), [(1, None)])
+        self.assertEqual(list(RollupDirtyHour.objects.values_list('bucket', flat=True)), [created_at])
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT 1 FROM pg_class WHERE relname = %s", [LEGACY_TABLE])
+            self.assertIsNone(cursor.fetchone())
+
+
+class RecordLatenciesTests(TestCase):
+    def test_batches_merge_into_one_row_per_route_and_hour(self):
+        hour = datetime.datetime(2026, 5, 1, 9, tzinfo=UTC)
+        record_latencies([{'created_at': hour, 'route': '/a', 'duration_ms': 12}])
+        record_latencies([
+            {'created_at': hour + datetime.timedelta(minutes=30), 'route': '/a', 'duration_ms': 12},
+            {'created_at': hour, 'route': '/a', 'duration_ms': 300, 'sample_weight': 10},
+        ])
+        row = LatencyHistogram.objects.get(bucket=hour, route='/a')
+        self.assertEqual((row.count, row.sum_ms, row.max_ms), (12, 3024, 300))
+        self.assertEqual(row.counts, {str(bucket_index(12)): 2, str(bucket_index(300)): 10})
+
+
+class LogSinkTests(TestCase):
+    def setUp(self):
+        root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, root, ignore_errors=True)
+        self.spool = os.path.join(root, 'spool.ndjson')
+        self.rejected = os.path.join(root, 'rejected.ndjson')
+        self.sink = RequestLogSink(spool_path=self.spool, dead_letter_path=self.rejected,
+                                   spool_max_bytes=4096, spool_max_age_seconds=3600)
+        self.now = datetime.datetime.now(UTC)
+
+    def _entry(self, minutes_ago=0, **extra):
+        return {'method': 'GET', 'path': '/en/', 'route': '/', 'status': 200, 'duration_ms': 5,
+                'created_at': self.now - datetime.timedelta(minutes=minutes_ago), **extra}
+
+    def _lines(self, path):
+        if not os.path.exists(path):
+            return []
+        with open(path, encoding='utf-8') as fh:
+            return [json.loads(line) for line in fh]
+
+    def test_bad_row_is_dead_lettered_and_spool_drains(self):
+        self.sink._spool([self._entry(), self._entry(bogus=1), self._entry(minutes_ago=120)])
+        self.sink._replay_spool()
+        self.assertEqual(RequestLog.objects.count(), 1)
+        self.assertEqual(self._lines(self.spool), [])
+        self.assertEqual([row['bogus'] for row in self._lines(self.rejected)], [1])
+        stats = self.sink.stats()
+        self.assertEqual((stats['replayed'], stats['rejected'], stats['expired']), (1, 1, 1))
+        # Nothing is left to fail on the next flush
+        self.sink._replay_spool()
+        self.assertEqual(RequestLog.objects.count(), 1)
+
+    def test_unavailable_database_spools_remaining_rows(self):
+        batch = [self._entry(), self._entry()]
+        with mock.patch.object(RequestLog.objects, 'bulk_create', side_effect=OperationalError('down')), \
+                mock.patch.object(RequestLog.objects, 'create', side_effect=OperationalError('down')):
+            self.sink._write(batch)
+        self.assertEqual(len(self._lines(self.spool)), 2)
+        self.assertEqual(self._lines(self.rejected), [])
+        self.sink._replay_spool()
+        self.assertEqual(RequestLog.objects.count(), 2)
+
+    def test_full_spool_drops_new_rows(self):
+        while not os.path.exists(self.spool) or os.path.getsize(self.spool) < 4096:
+            self.sink._spool([self._entry()])
+        spooled = self.sink.stats()['spooled']
+        self.sink._spool([self._entry()])
+        stats = self.sink.stats()
+        self.assertEqual((stats['spooled'], stats['dropped']), (spooled, 1))
+
+
+class LateRowRollupTests(TestCase):
+    def test_replayed_rows_for_rolled_up_hours_are_counted(self):
+        now = datetime.datetime.now(UTC)
+        hour = now.replace(minute=0, second=0, microsecond=0) - datetime.timedelta(hours=3)
+        _log(hour + datetime.timedelta(minutes=10))
+        build_rollups()
+        since = hour - datetime.timedelta(hours=1)
+        self.assertEqual(request_summary(since)['total_requests'], 1)
+        # A spooled row for that hour is replayed after the watermark passed it
+        root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, root, ignore_errors=True)
+        sink = RequestLogSink(spool_path=os.path.join(root, 'spool.ndjson'))
+        sink._spool([{'method': 'GET', 'path': '/en/', 'route': '/', 'status': 500, 'duration_ms': 5,
+                      'created_at': hour + datetime.timedelta(minutes=20)}])
+        sink._replay_spool()
+        self.assertEqual(list(RollupDirtyHour.objects.values_list('bucket', flat=True)), [hour])
+        build_rollups()
+        self.assertFalse(RollupDirtyHour.objects.exists())
+        summary = request_summary(since)
+        self.assertEqual((summary['total_requests'], summary['errors']), (2, 1))
+
+
+class CsvExportTests(TestCase):
+    def test_formula_cells_are_neutralised(self):
+        rows = [('=HYPERLINK("http://x")', '+1', '-cmd', '@SUM(A1)', '/en/', -3.5, None)]
+        lines = list(csv_lines(rows, ['a', 'b', 'c', 'd', 'e', 'f', 'g']))
+        self.assertEqual(lines[1], '"\'=HYPERLINK(""http://x"")",\'+1,\'-cmd,\'@SUM(A1),/en/,-3.5,\r\n')
+
+
+class AdminStorageTests(TestCase):
+    def setUp(self):
+        from accounts.models import UserStorageUsage
+        staff = User.objects.create_user('admin', password='x', is_staff=True, is_superuser=True)
+        self.client.force_login(staff)
+        for name, image, video in (('mostly_video', 100, 800), ('mostly_images', 500, 0)):
+            user = User.objects.create_user(name, password='x')
+            UserStorageUsage.objects.update_or_create(user=user, defaults={
+                'image_bytes': image, 'video_bytes': video, 'total_bytes': image + video,
+                'quota_bytes': 1000, 'percent_used': (image + video) // 10,
+            })
+
+    def _rows(self, **params):
+        response = self.client.get(reverse('core:admin_storage'), params)
+        return [(row['user'].username, row['percent']) for row in response.context['usage_data']]
+
+    def test_kind_filter_ranks_by_that_kind_share_of_quota(self):
+        self.assertEqual(self._rows(kind='image', sort='percent', dir='desc'),
+                         [('mostly_images', 50), ('mostly_video', 10)])
+        self.assertEqual(self._rows(kind='image', min_percent=20), [('mostly_images', 50)])
+        self.assertEqual(self._rows(min_percent=60), [('mostly_video', 90)])
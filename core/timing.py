@@ -0,0 +1,183 @@
+"""
+Per-request timing breakdown.
+
+``RequestTimingMiddleware`` opens a ``RequestTimer`` for each request and
+installs a database execute wrapper on every connection. The instrumented
+cache backends and template engine below, plus ``span('media')`` blocks
+around image work in ``projects.views``, add their time to the current timer
+(found through a context variable, so work on other threads is not counted).
+The totals are sent to staff as a ``Server-Timing`` header and saved on the
+request's ``RequestLog`` row by ``ActivityLoggingMiddleware``.
+"""
+import contextvars
+import time
+from contextlib import contextmanager
+from functools import wraps
+
+from django.core.cache.backends.locmem import LocMemCache
+from django.template.backends.django import DjangoTemplates, Template as DjangoTemplate
+
+_current = contextvars.ContextVar('request_timer', default=None)
+
+
+class RequestTimer:
+    # Persisted on RequestLog under the same names
+    FIELDS = ('sql_count', 'sql_ms', 'cache_hits', 'cache_misses', 'cache_ms', 'template_ms', 'media_ms')
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.sql_count = 0
+        self.sql_ms = 0.0
+        self.cache_hits = 0
+        self.cache_misses = 0
+        self.cache_ms = 0.0
+        self.template_ms = 0.0
+        self.media_ms = 0.0
+        self._depth = {}
+
+    def as_fields(self):
+        return {
+            name: round(value, 2) if isinstance(value, float) else value
+            for name, value in ((f, getattr(self, f)) for f in self.FIELDS)
+        }
+
+    def server_timing(self):
+        total = (time.perf_counter() - self.started) * 1000
+        parts = [
+            f'db;dur={self.sql_ms:.1f};desc="{self.sql_count} queries"',
+            f'cache;dur={self.cache_ms:.1f};desc="{self.cache_hits} hit, {self.cache_misses} miss"',
+            f'tpl;dur={self.template_ms:.1f}',
+        ]
+        if self.media_ms:
+            parts.append(f'media;dur={self.media_ms:.1f}')
+        parts.append(f'total;dur={total:.1f}')
+        return ', '.join(parts)
+
+
+def start():
+    timer = RequestTimer()
+    return timer, _current.set(timer)
+
+
+def stop(token):
+    _current.reset(token)
+
+
+def current():
+    return _current.get()
+
+
+@contextmanager
+def span(name):
+    """Add the time spent in the block to ``<name>_ms`` of the current request.
+    Nested spans of the same name are counted once."""
+    timer = _current.get()
+    if timer is None or timer._depth.get(name):
+        yield
+        return
+    timer._depth[name] = 1
+    t0 = time.perf_counter()
+    try:
+        yield
+    finally:
+        timer._depth[name] = 0
+        attr = f'{name}_ms'
+        setattr(timer, attr, getattr(timer, attr) + (time.perf_counter() - t0) * 1000)
+
+
+def timed(name):
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            with span(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def sql_wrapper(execute, sql, params, many, context):
+    """``connection.execute_wrapper`` hook counting queries and their time."""
+    timer = _current.get()
+    if timer is None:
+        return execute(sql, params, many, context)
+    t0 = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        timer.sql_count += 1
+        timer.sql_ms += (time.perf_counter() - t0) * 1000
+
+
+# Instrumented cache backends (CACHES BACKEND)
+
+_MISS = object()
+
+
+class TimedCacheMixin:
+    def get(self, key, default=None, *args, **kwargs):
+        with span('cache'):
+            value = super().get(key, _MISS, *args, **kwargs)
+        timer = _current.get()
+        if timer is not None and not timer._depth.get('cache'):
+            if value is _MISS:
+                timer.cache_misses += 1
+            else:
+                timer.cache_hits += 1
+        return default if value is _MISS else value
+
+    def get_many(self, keys, *args, **kwargs):
+        keys = list(keys)
+        with span('cache'):
+            found = super().get_many(keys, *args, **kwargs)
+        timer = _current.get()
+        if timer is not None and not timer._depth.get('cache'):
+            timer.cache_hits += len(found)
+            timer.cache_misses += len(keys) - len(found)
+        return found
+
+    def set(self, *args, **kwargs):
+        with span('cache'):
+            return super().set(*args, **kwargs)
+
+    def add(self, *args, **kwargs):
+        with span('cache'):
+            return super().add(*args, **kwargs)
+
+    def delete(self, *args, **kwargs):
+        with span('cache'):
+            return super().delete(*args, **kwargs)
+
+    def incr(self, *args, **kwargs):
+        with span('cache'):
+            return super().incr(*args, **kwargs)
+
+
+class TimedLocMemCache(TimedCacheMixin, LocMemCache):
+    pass
+
+
+try:
+    from django_redis.cache import RedisCache as _DjangoRedisCache
+except Exception:  # pragma: no cover
+    _DjangoRedisCache = None
+
+if _DjangoRedisCache is not None:
+    class TimedRedisCache(TimedCacheMixin, _DjangoRedisCache):
+        pass
+
+
+# Instrumented template engine (TEMPLATES BACKEND)
+
+class TimedTemplate(DjangoTemplate):
+    def render(self, context=None, request=None):
+        with span('template'):
+            return super().render(context, request)
+
+
+class TimedDjangoTemplates(DjangoTemplates):
+    def from_string(self, template_code):
+        return TimedTemplate(self.engine.from_string(template_code), self)
+
+    def get_template(self, template_name):
+        template = super().get_template(template_name)
+        return TimedTemplate(template.template, self)
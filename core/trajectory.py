@@ -0,0 +1,147 @@
+"""
+Compaction of old device-location history.
+
+Each user's fixes older than a cutoff are simplified with a time-aware
+Douglas-Peucker pass: a fix is dropped when it lies within ``tolerance_m``
+of where the device would have been by moving at constant speed between the
+fixes kept around it (the synchronized Euclidean distance), so both the
+path and its timing are preserved to within the tolerance. Runs separated
+by more than ``max_gap`` are simplified independently and their endpoints
+are always kept. Fixes are streamed per user in chunks, and the last kept
+fix of a chunk anchors the next one.
+
+Every fix before the ``RollupState`` watermark named ``COMPACTION_NAME`` has
+been compacted, so each run only reads history past it. ``manage.py
+compact_device_locations`` and ``core.tasks.compact_device_locations_task``
+run it.
+"""
+import datetime
+import logging
+import math
+
+from django.db import transaction
+
+from .models import DeviceLocation, RollupState
+
+logger = logging.getLogger('security')
+
+COMPACTION_NAME = 'device_locations_compaction'
+EARTH_RADIUS_M = 6371008.8
+
+
+def simplify(points, tolerance_m):
+    """
+    Indexes of ``points`` (``(latitude, longitude, seconds)``, time-ordered)
+    to keep. Endpoints are always kept.
+    """
+    n = len(points)
+    if n < 3:
+        return list(range(n))
+    lat0 = math.radians(sum(p[0] for p in points) / n)
+    k = math.pi / 180 * EARTH_RADIUS_M
+    xs = [p[1] * k * math.cos(lat0) for p in points]
+    ys = [p[0] * k for p in points]
+    ts = [p[2] for p in points]
+    keep = [False] * n
+    keep[0] = keep[-1] = True
+    stack = [(0, n - 1)]
+    while stack:
+        i, j = stack.pop()
+        if j <= i + 1:
+            continue
+        span = ts[j] - ts[i]
+        worst, worst_d = -1, tolerance_m
+        for m in range(i + 1, j):
+            f = (ts[m] - ts[i]) / span if span > 0 else 0.5
+            dx = xs[m] - (xs[i] + f * (xs[j] - xs[i]))
+            dy = ys[m] - (ys[i] + f * (ys[j] - ys[i]))
+            d = math.hypot(dx, dy)
+            if d > worst_d:
+                worst, worst_d = m, d
+        if worst >= 0:
+            keep[worst] = True
+            stack.append((i, worst))
+            stack.append((worst, j))
+    return [i for i, kept in enumerate(keep) if kept]
+
+
+def _simplify_runs(rows, tolerance_m, max_gap):
+    """Primary keys to delete from ``rows`` (``(pk, lat, lng, created_at)``)."""
+    drop = []
+    start = 0
+    for end in range(1, len(rows) + 1):
+        if end < len(rows) and rows[end][3] - rows[end - 1][3] <= max_gap:
+            continue
+        run = rows[start:end]
+        if len(run) > 2:
+            t0 = run[0][3]
+            kept = set(simplify([(float(r[1]), float(r[2]), (r[3] - t0).total_seconds()) for r in run], tolerance_m))
+            drop.extend(r[0] for i, r in enumerate(run) if i not in kept)
+        start = end
+    return drop
+
+
+def _delete(pks, chunk_size=1000):
+    deleted = 0
+    for i in range(0, len(pks), chunk_size):
+        n, _ = DeviceLocation.objects.filter(pk__in=pks[i:i + chunk_size]).delete()
+        deleted += n
+    return deleted
+
+
+def compact_user(user_id, since, until, tolerance_m=25.0, max_gap=datetime.timedelta(hours=6),
+                 chunk_size=5000, dry_run=False):
+    """Compact one user's fixes in ``[since, until)``; returns ``(examined, removed)``."""
+    qs = DeviceLocation.objects.filter(user_id=user_id, created_at__lt=until)
+    if since is not None:
+        qs = qs.filter(created_at__gte=since)
+    rows = qs.order_by('created_at', 'pk').values_list('pk', 'latitude', 'longitude', 'created_at')
+    examined = 0
+    drop = []
+    chunk = []
+    for row in rows.iterator(chunk_size=chunk_size):
+        chunk.append(row)
+        examined += 1
+        if len(chunk) >= chunk_size:
+            drop.extend(_simplify_runs(chunk, tolerance_m, max_gap))
+            # The chunk's last fix is always kept; it anchors the next chunk
+            chunk = [chunk[-1]]
+    drop.extend(_simplify_runs(chunk, tolerance_m, max_gap))
+    # Deleted once the cursor is exhausted, not while it is being read
+    if drop and not dry_run:
+        with transaction.atomic():
+            _delete(drop)
+    removed = len(drop)
+    return examined, removed
+
+
+def compact_locations(cutoff, tolerance_m=25.0, max_gap=datetime.timedelta(hours=6), chunk_size=5000,
+                      dry_run=False, user_ids=None, since=None):
+    """
+    Compact every user's fixes created between the watermark (or ``since``)
+    and the UTC day containing ``cutoff``, then advance the watermark.
+    Returns ``{'users': n, 'examined': n, 'removed': n}``.
+    """
+    until = cutoff.astimezone(datetime.timezone.utc).replace(hour=0, minute=0, second=0, microsecond=0)
+    state, _ = RollupState.objects.get_or_create(name=COMPACTION_NAME)
+    start = since if since is not None else state.watermark
+    if start is not None and start >= until:
+        return {'users': 0, 'examined': 0, 'removed': 0}
+    qs = DeviceLocation.objects.filter(created_at__lt=until)
+    if start is not None:
+        qs = qs.filter(created_at__gte=start)
+    if user_ids:
+        qs = qs.filter(user_id__in=user_ids)
+    users = list(qs.order_by().values_list('user_id', flat=True).distinct())
+    examined = removed = 0
+    for user_id in users:
+        e, r = compact_user(user_id, start, until, tolerance_m=tolerance_m, max_gap=max_gap,
+                            chunk_size=chunk_size, dry_run=dry_run)
+        examined += e
+        removed += r
+    if not dry_run and not user_ids and (state.watermark is None or state.watermark < until):
+        state.watermark = until
+        state.save(update_fields=['watermark', 'updated_at'])
+    if removed and not dry_run:
+        logger.info(f"Compacted device locations before {until:%Y-%m-%d}: removed {removed} of {examined}")
+    return {'users': len(users), 'examined': examined, 'removed': removed}
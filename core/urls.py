@@ -12,9 +12,13 @@ urlpatterns = [
     path('api/messages/<int:user_id>/', views.get_conversation, name='get_conversation'),
     path('api/messages/<int:user_id>/send/', views.send_message, name='send_message'),
     path('api/device/location/', views.api_device_location, name='api_device_location'),
+    path('api/device/locations/', views.api_device_locations, name='api_device_locations'),
     path('control/dashboard/', views.admin_dashboard, name='admin_dashboard'),
     path('control/storage/', views.admin_storage, name='admin_storage'),
     path('control/analytics/', views.admin_analytics, name='admin_analytics'),
+    path('control/analytics/export/<str:kind>/', views.admin_export, name='admin_export'),
+    path('control/analytics/heatmap/', views.admin_heatmap, name='admin_heatmap'),
+    path('control/analytics/heatmap/data/', views.admin_heatmap_data, name='admin_heatmap_data'),
     path('control/users/<int:user_id>/toggle-active/', views.admin_user_toggle_active, name='admin_user_toggle_active'),
     path('control/users/<int:user_id>/toggle-staff/', views.admin_user_toggle_staff, name='admin_user_toggle_staff'),
     path('control/users/', views.admin_users, name='admin_users'),
@@ -1,17 +1,25 @@
 from django.shortcuts import render, get_object_or_404, redirect
 from django.contrib.auth.models import User
-from django.db.models import Count, Q
-from django.db.models.functions import TruncMonth, TruncDay
+from django.db.models import Avg, Count, F, Q, Sum
+from django.db.models.functions import TruncMonth
 from django.utils import timezone
-from django.http import JsonResponse
+from django.http import Http404, JsonResponse, StreamingHttpResponse
 from django.contrib import messages
 from django.contrib.auth.decorators import login_required
 from django.views.decorators.http import require_POST
 from django.core.paginator import Paginator
 import json
-from projects.models import Project, ProjectLike, Category, ProjectImage, ProjectFile, PackageMockup
-from accounts.models import Follow, UserStorageSettings
+from urllib.parse import urlencode
+from projects.models import Project, ProjectLike, Category
+from accounts.models import Follow, UserStorageSettings, UserStorageUsage
+from projects.usage import KIND_COLUMNS, percent_expression
 from .models import Message, RequestLog, DeviceLocation
+from .archive import archive_summary
+from .exports import EXPORTS, FORMATS, export_filename, stream_export
+from .latency import latency_summary
+from .locations import heatmap_cells, ingest_fixes, precision_for_zoom
+from .retention import purge_request_logs, truncate_request_logs
+from .rollups import request_summary, reset_rollups
 
 def home(request):
     # Get featured projects (published projects with cover images)
@@ -62,69 +70,6 @@ def help_center(request):
 def contact(request):
     return render(request, 'core/contact.html')
 
-def _storage_usage_bytes(user):
-    total = 0
-    try:
-        # Projects media
-        for p in Project.objects.filter(owner=user):
-            for f in [p.cover_image, p.video_file, p.audio_file]:
-                try:
-                    if f and getattr(f, 'name', None):
-                        size = getattr(f, 'size', None)
-                        if size is None:
-                            from django.core.files.storage import default_storage
-                            if default_storage.exists(f.name):
-                                size = default_storage.size(f.name)
-                        if size:
-                            total += int(size)
-                except Exception:
-                    continue
-        # Project images
-        for pi in ProjectImage.objects.filter(project__owner=user):
-            try:
-                f = pi.image
-                if f and getattr(f, 'name', None):
-                    size = getattr(f, 'size', None)
-                    if size is None:
-                        from django.core.files.storage import default_storage
-                        if default_storage.exists(f.name):
-                            size = default_storage.size(f.name)
-                    if size:
-                        total += int(size)
-            except Exception:
-                continue
-        # Project files
-        for pf in ProjectFile.objects.filter(project__owner=user):
-            try:
-                f = pf.file
-                if f and getattr(f, 'name', None):
-                    size = getattr(f, 'size', None)
-                    if size is None:
-                        from django.core.files.storage import default_storage
-                        if default_storage.exists(f.name):
-                            size = default_storage.size(f.name)
-                    if size:
-                        total += int(size)
-            except Exception:
-                continue
-        # Mockups
-        for m in PackageMockup.objects.filter(owner=user):
-            for f in [m.container_image, m.design_image, m.generated_image, m.mask_image]:
-                try:
-                    if f and getattr(f, 'name', None):
-                        size = getattr(f, 'size', None)
-                        if size is None:
-                            from django.core.files.storage import default_storage
-                            if default_storage.exists(f.name):
-                                size = default_storage.size(f.name)
-                        if size:
-                            total += int(size)
-                except Exception:
-                    continue
-    except Exception:
-        return total
-    return total
-
 @login_required
 def admin_storage(request):
     if not request.user.is_staff:
@@ -191,50 +136,95 @@ def admin_storage(request):
             messages.error(request, "Bulk action failed.")
         return redirect('core:admin_storage')
 
-    # List users with usage and quota
+    # List users from the storage ledger: filtering, sorting and the summary
+    # all run against UserStorageUsage, so every user is covered without
+    # touching the filesystem.
     q = (request.GET.get('q') or '').strip()
-    users = User.objects.all()
+    kind = (request.GET.get('kind') or '').strip()
+    sort = (request.GET.get('sort') or 'used').strip()
+    direction = (request.GET.get('dir') or 'desc').strip()
+    try:
+        min_mb = float(request.GET.get('min_mb') or 0)
+    except Exception:
+        min_mb = 0
+    try:
+        min_percent = int(request.GET.get('min_percent') or 0)
+    except Exception:
+        min_percent = 0
+    if kind not in KIND_COLUMNS:
+        kind = ''
+    usage_qs = UserStorageUsage.objects.select_related('user')
     if q:
-        users = users.filter(Q(username__icontains=q) | Q(email__icontains=q))
-    # Compute usage for page users only to avoid heavy load
-    page_size = int(request.GET.get('page_size') or 10)
-    paginator = Paginator(users.order_by('username'), page_size)
+        usage_qs = usage_qs.filter(Q(user__username__icontains=q) | Q(user__email__icontains=q))
+    bytes_column = KIND_COLUMNS[kind] if kind else 'total_bytes'
+    # With a kind selected, percentages are that kind's share of the quota
+    percent_column = 'percent_used'
+    if kind:
+        usage_qs = usage_qs.filter(**{f'{bytes_column}__gt': 0})
+        usage_qs = usage_qs.annotate(kind_percent=percent_expression(F(bytes_column)))
+        percent_column = 'kind_percent'
+    if min_mb > 0:
+        usage_qs = usage_qs.filter(**{f'{bytes_column}__gte': int(min_mb * 1024 * 1024)})
+    if min_percent > 0:
+        usage_qs = usage_qs.filter(**{f'{percent_column}__gte': min_percent})
+    allowed = {
+        'used': bytes_column,
+        'percent': percent_column,
+        'username': 'user__username',
+    }
+    order_field = allowed.get(sort, bytes_column)
+    if direction == 'desc':
+        order_field = f'-{order_field}'
+    usage_qs = usage_qs.order_by(order_field, 'user__username')
+    try:
+        page_size = int(request.GET.get('page_size') or 10)
+    except Exception:
+        page_size = 10
+    paginator = Paginator(usage_qs, page_size)
     page_number = request.GET.get('page') or 1
     page_obj = paginator.get_page(page_number)
-    usage_data = []
     default_quota_mb = int(getattr(__import__('django.conf').conf.settings, 'USER_STORAGE_QUOTA_MB', 0) or 0)
-    for u in page_obj.object_list:
-        used = _storage_usage_bytes(u)
-        uss = UserStorageSettings.objects.filter(user=u).only('quota_mb').first()
-        quota_mb = int(uss.quota_mb) if (uss and uss.quota_mb) else default_quota_mb
-        quota_bytes = quota_mb * 1024 * 1024 if quota_mb else 0
-        pct = 0
-        if quota_bytes > 0:
-            pct = min(100, int((used / quota_bytes) * 100)) if used else 0
+    overrides = dict(
+        UserStorageSettings.objects.filter(user_id__in=[row.user_id for row in page_obj.object_list])
+        .values_list('user_id', 'quota_mb')
+    )
+    usage_data = []
+    for row in page_obj.object_list:
+        used = getattr(row, bytes_column)
         usage_data.append({
-            'user': u,
+            'user': row.user,
             'used_mb': round(used / (1024*1024), 2),
-            'quota_mb': quota_mb,
-            'percent': pct,
+            'total_mb': round(row.total_bytes / (1024*1024), 2),
+            'quota_mb': overrides.get(row.user_id) or None,
+            'percent': min(100, max(0, getattr(row, percent_column))),
         })
-    # Summary stats (based on entire user set, not just page)
-    # Note: for performance, compute approx using current page for now.
-    total_users = users.count()
-    avg_usage = 0.0
-    near_quota = 0
-    if usage_data:
-        avg_usage = round(sum(d['used_mb'] for d in usage_data) / len(usage_data), 2)
-        near_quota = sum(1 for d in usage_data if d['percent'] >= 80)
+    # Summary stats over every user in the ledger
+    summary = UserStorageUsage.objects.aggregate(
+        users=Count('id'),
+        avg_bytes=Avg('total_bytes'),
+        sum_bytes=Sum('total_bytes'),
+        near_quota=Count('id', filter=Q(percent_used__gte=80)),
+    )
+    total_users = User.objects.count()
+    avg_usage = round((summary['avg_bytes'] or 0) / (1024*1024), 2)
     context = {
         'page_obj': page_obj,
         'usage_data': usage_data,
         'q': q,
+        'kind': kind,
+        'kind_choices': list(KIND_COLUMNS.keys()),
+        'sort': sort,
+        'dir': direction,
+        'min_mb': request.GET.get('min_mb') or '',
+        'min_percent': request.GET.get('min_percent') or '',
         'page_size': page_size,
         'default_quota_mb': default_quota_mb,
         'page_sizes': [10, 20, 50, 100],
         'total_users': total_users,
+        'unsynced_users': max(0, total_users - (summary['users'] or 0)),
+        'total_used_mb': round((summary['sum_bytes'] or 0) / (1024*1024), 2),
         'avg_usage': avg_usage,
-        'near_quota': near_quota,
+        'near_quota': summary['near_quota'] or 0,
     }
     return render(request, 'core/admin_storage.html', context)
 
@@ -246,7 +236,8 @@ def admin_analytics(request):
         act = (request.POST.get('action') or '').strip()
         try:
             if act == 'purge_all_logs':
-                deleted, _ = RequestLog.objects.all().delete()
+                deleted = truncate_request_logs()
+                reset_rollups()
                 messages.success(request, f"Purged {deleted} request logs.")
             elif act == 'purge_all_locations':
                 deleted, _ = DeviceLocation.objects.all().delete()
@@ -254,7 +245,7 @@ def admin_analytics(request):
             elif act == 'purge_older':
                 days = int(request.POST.get('days') or '90')
                 cutoff = timezone.now() - timezone.timedelta(days=days)
-                d1, _ = RequestLog.objects.filter(created_at__lt=cutoff).delete()
+                d1 = purge_request_logs(cutoff)['deleted_rows']
                 d2, _ = DeviceLocation.objects.filter(created_at__lt=cutoff).delete()
                 messages.success(request, f"Purged {d1} logs and {d2} locations older than {days} days.")
         except Exception:
@@ -263,79 +254,21 @@ def admin_analytics(request):
     period_days = request.GET.get('period') or '30'
     exclude_staff = (request.GET.get('exclude_staff') == '1')
     hide_i18n = (request.GET.get('hide_i18n') == '1')
-    hide_query = (request.GET.get('hide_query') == '1')
+    exact = (request.GET.get('exact') == '1')
     try:
         days = int(period_days)
     except Exception:
         days = 30
     since = timezone.now() - timezone.timedelta(days=days)
 
-    qs = RequestLog.objects.filter(created_at__gte=since)
-    if exclude_staff:
-        qs = qs.exclude(user__is_staff=True)
-    if hide_i18n:
-        qs = qs.exclude(path__startswith='/i18n/').exclude(path__regex=r'^/([a-z]{2})(/|$)')
-
-    total_requests = qs.count()
-    unique_users = qs.exclude(user__isnull=True).values('user').distinct().count()
-    unique_countries = qs.exclude(country='').values('country').distinct().count()
-    errors = qs.filter(status__gte=400).count()
-    error_rate = round((errors / total_requests) * 100.0, 2) if total_requests else 0.0
-    # By country
-    by_country = (
-        qs.values('country')
-          .annotate(count=Count('id'))
-          .order_by('-count')[:20]
-    )
-    # By region
-    by_region = (
-        qs.values('country', 'region')
-          .annotate(count=Count('id'))
-          .order_by('-count')[:20]
-    )
-    # By user
-    by_user = (
-        qs.values('user__username')
-          .annotate(count=Count('id'))
-          .order_by('-count')[:20]
-    )
-    # Top paths (cleaned)
-    from django.db.models import F, Value, Func
-    class SplitPart(Func):
-        function = 'SUBSTR'
-    # Clean paths in Python for portability
-    all_paths = qs.values_list('path', flat=True)
-    cleaned = []
-    for p in all_paths:
-        if not p:
-            continue
-        base = p.split('?', 1)[0] if hide_query else p
-        # strip language prefix /en/ or /sw/
-        parts = base.split('/')
-        if len(parts) > 2 and len(parts[1]) == 2:
-            base = '/' + '/'.join(parts[2:])
-        cleaned.append(base)
-    from collections import Counter
-    counter = Counter(cleaned)
-    top_paths = [{'path': k, 'count': v} for k, v in counter.most_common(20)]
-    # Status codes
-    statuses = (
-        qs.values('status')
-          .annotate(count=Count('id'))
-          .order_by('-count')
-    )
-    # Buckets for donut chart
-    buckets = {'2xx': 0, '3xx': 0, '4xx': 0, '5xx': 0}
-    for row in statuses:
-        s = int(row['status'] or 0)
-        if 200 <= s < 300:
-            buckets['2xx'] += row['count']
-        elif 300 <= s < 400:
-            buckets['3xx'] += row['count']
-        elif 400 <= s < 500:
-            buckets['4xx'] += row['count']
-        elif 500 <= s < 600:
-            buckets['5xx'] += row['count']
+    # Served from the hourly rollups (core.rollups); only the still-open
+    # hour is read from raw logs.
+    summary = request_summary(since, exclude_staff=exclude_staff, hide_i18n=hide_i18n, exact=exact)
+    total_requests = summary['total_requests']
+    error_rate = round((summary['errors'] / total_requests) * 100.0, 2) if total_requests else 0.0
+    by_country = summary['by_country']
+    buckets = summary['status_buckets']
+    statuses = [{'status': k, 'count': v} for k, v in buckets.items()]
 
     # Chart data (countries)
     labels = []
@@ -345,30 +278,38 @@ def admin_analytics(request):
             labels.append(row['country'] or 'Unknown')
             counts.append(row['count'])
     # Time series per day
-    per_day = (
-        qs.annotate(d=TruncDay('created_at'))
-          .values('d')
-          .annotate(count=Count('id'))
-          .order_by('d')
-    )
+    per_day = summary['per_day']
     ts_labels = [r['d'].strftime('%Y-%m-%d') for r in per_day]
     ts_counts = [r['count'] for r in per_day]
     donut_labels = list(buckets.keys())
     donut_counts = list(buckets.values())
+    latency = latency_summary(since)
+    # Same window a year back, read from the cold archive (core.archive)
+    year = timezone.timedelta(days=365)
+    try:
+        last_year = archive_summary(since - year, timezone.now() - year, exclude_staff=exclude_staff, hide_i18n=hide_i18n, limit=5)
+    except Exception:
+        last_year = None
+    if last_year:
+        prev = last_year['total_requests']
+        last_year['change_pct'] = round((total_requests / prev - 1) * 100, 1) if prev else None
 
     context = {
         'period': str(days),
         'total_requests': total_requests,
-        'unique_users': unique_users,
-        'unique_countries': unique_countries,
+        'unique_users': summary['unique_users'],
+        'unique_ips': summary['unique_ips'],
+        'unique_countries': summary['unique_countries'],
+        'exact': exact,
+        'distinct_error_pct': summary['distinct_error_pct'],
         'error_rate': error_rate,
         'exclude_staff': exclude_staff,
         'hide_i18n': hide_i18n,
-        'hide_query': hide_query,
+        'export_query': urlencode({'period': days, 'exclude_staff': int(exclude_staff), 'hide_i18n': int(hide_i18n)}),
         'by_country': by_country,
-        'by_region': by_region,
-        'by_user': by_user,
-        'top_paths': top_paths,
+        'by_region': summary['by_region'],
+        'by_user': summary['by_user'],
+        'top_paths': summary['top_paths'],
         'statuses': statuses,
         'chart_labels_json': json.dumps(labels),
         'chart_counts_json': json.dumps(counts),
@@ -376,12 +317,90 @@ def admin_analytics(request):
         'ts_counts_json': json.dumps(ts_counts),
         'donut_labels_json': json.dumps(donut_labels),
         'donut_counts_json': json.dumps(donut_counts),
+        'rolled_up_to': summary['rolled_up_to'],
+        'latency': latency,
+        'latency_regressions': sum(1 for r in latency if r['regressed']),
+        'last_year': last_year,
     }
     return render(request, 'core/admin_analytics.html', context)
 
+@login_required
+def admin_export(request, kind):
+    """Stream raw request logs or device locations as CSV/NDJSON (core.exports)."""
+    if not request.user.is_staff:
+        return redirect('core:home')
+    if kind not in EXPORTS:
+        raise Http404
+    fmt = request.GET.get('format') or 'csv'
+    if fmt not in FORMATS:
+        fmt = 'csv'
+    compress = (request.GET.get('gzip') == '1')
+    try:
+        days = int(request.GET.get('period') or '30')
+    except Exception:
+        days = 30
+    since = timezone.now() - timezone.timedelta(days=days)
+    stream = stream_export(
+        kind, fmt=fmt, compress=compress, since=since,
+        exclude_staff=(request.GET.get('exclude_staff') == '1'),
+        hide_i18n=(request.GET.get('hide_i18n') == '1'),
+    )
+    if compress:
+        content_type = 'application/gzip'
+    else:
+        content_type = 'text/csv; charset=utf-8' if fmt == 'csv' else 'application/x-ndjson; charset=utf-8'
+    response = StreamingHttpResponse(stream, content_type=content_type)
+    response['Content-Disposition'] = f'attachment; filename="{export_filename(kind, fmt, compress)}"'
+    response['Cache-Control'] = 'no-store'
+    return response
+
+@login_required
+def admin_heatmap(request):
+    if not request.user.is_staff:
+        return redirect('core:home')
+    context = {
+        'period': request.GET.get('period') or '30',
+        'exclude_staff': (request.GET.get('exclude_staff') == '1'),
+    }
+    return render(request, 'core/admin_heatmap.html', context)
+
+@login_required
+def admin_heatmap_data(request):
+    """Fix counts per geohash cell (core.locations.heatmap_cells) as JSON."""
+    if not request.user.is_staff:
+        return JsonResponse({'ok': False}, status=403)
+    try:
+        days = int(request.GET.get('period') or '30')
+    except Exception:
+        days = 30
+    precision = request.GET.get('precision')
+    try:
+        precision = int(precision) if precision else precision_for_zoom(request.GET.get('zoom'))
+    except Exception:
+        precision = 5
+    bbox = None
+    if request.GET.get('bbox'):
+        try:
+            south, west, north, east = (float(v) for v in request.GET['bbox'].split(','))
+            bbox = (south, west, north, east)
+        except Exception:
+            return JsonResponse({'ok': False, 'error': 'invalid_bbox'}, status=400)
+    since = timezone.now() - timezone.timedelta(days=days)
+    result = heatmap_cells(since, precision=precision, bbox=bbox,
+                           exclude_staff=(request.GET.get('exclude_staff') == '1'))
+    return JsonResponse({
+        'ok': True,
+        'precision': precision,
+        'total': result['total'],
+        'truncated': result['truncated'],
+        'max': max((c[5] for c in result['cells']), default=0),
+        'cells': result['cells'],
+    })
+
 @login_required
 @require_POST
 def api_device_location(request):
+    """Single fix (older clients); filtered like the batch endpoint."""
     try:
         lat = request.POST.get('latitude') or request.POST.get('lat')
         lng = request.POST.get('longitude') or request.POST.get('lon') or request.POST.get('lng')
@@ -400,19 +419,27 @@ def api_device_location(request):
         accuracy_m = float(acc) if acc is not None and acc != '' else None
     except Exception:
         return JsonResponse({'ok': False, 'error': 'invalid_payload'}, status=400)
+    return _ingest_locations(request, [{'latitude': lat, 'longitude': lng, 'accuracy': accuracy_m}])
+
+@login_required
+@require_POST
+def api_device_locations(request):
+    """Batch of timestamped fixes: ``{"fixes": [{"latitude", "longitude", "accuracy", "ts"}, ...]}``."""
+    try:
+        data = json.loads(request.body.decode('utf-8'))
+        fixes = data.get('fixes') if isinstance(data, dict) else data
+        if not isinstance(fixes, list):
+            raise ValueError
+    except Exception:
+        return JsonResponse({'ok': False, 'error': 'invalid_payload'}, status=400)
+    return _ingest_locations(request, fixes)
 
+def _ingest_locations(request, fixes):
     ip = request.META.get('HTTP_X_FORWARDED_FOR', '').split(',')[0].strip() or request.META.get('REMOTE_ADDR') or None
     ua = (request.META.get('HTTP_USER_AGENT') or '')[:256]
     try:
-        DeviceLocation.objects.create(
-            user=request.user,
-            latitude=lat,
-            longitude=lng,
-            accuracy_m=accuracy_m,
-            ip=ip,
-            user_agent=ua,
-        )
-        return JsonResponse({'ok': True})
+        stored, dropped = ingest_fixes(request.user, fixes, ip=ip, user_agent=ua)
+        return JsonResponse({'ok': True, 'stored': stored, 'dropped': dropped})
     except Exception:
         return JsonResponse({'ok': False}, status=500)
 
@@ -14,3 +14,7 @@ from django.core.asgi import get_asgi_application
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'multimedia_portfolio.settings')
 
 application = get_asgi_application()
+
+# Build the reverse-geocoding index before the first request needs it
+from core.places import warm_geocoder  # noqa: E402
+warm_geocoder()
@@ -13,6 +13,8 @@ https://docs.djangoproject.com/en/5.2/ref/settings/
 from pathlib import Path
 from dotenv import load_dotenv
 import os
+import sys
+import tempfile
 
 BASE_DIR = Path(__file__).resolve().parent.parent
 load_dotenv(BASE_DIR / '.env')  # ✅ Make sure .env is loaded
@@ -27,6 +29,12 @@ import os
 os.makedirs(BASE_DIR / 'logs', exist_ok=True)
 os.makedirs(BASE_DIR / 'geoip', exist_ok=True)
 GEOIP_PATH = str(BASE_DIR / 'geoip')
+# Log files and the request-log spool. `manage.py test` writes them to a
+# scratch directory instead, so test runs leave nothing under logs/.
+TESTING = sys.argv[1:2] == ['test']
+LOG_DIR = Path(tempfile.mkdtemp(prefix='portfolio-test-logs-')) if TESTING else BASE_DIR / 'logs'
+# IPs kept in the per-process GeoIP lookup cache (core.geo)
+GEOIP_CACHE_SIZE = 50000
 
 
 # Quick-start development settings - unsuitable for production
@@ -69,6 +77,7 @@ MIDDLEWARE = [
     'django.middleware.common.CommonMiddleware',
     'core.middleware.AdminIPAllowlistMiddleware',
     'core.middleware.ActivityLoggingMiddleware',
+    'core.middleware.RequestTimingMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
     'django_otp.middleware.OTPMiddleware',
@@ -80,7 +89,8 @@ ROOT_URLCONF = 'multimedia_portfolio.urls'
 
 TEMPLATES = [
     {
-        'BACKEND': 'django.template.backends.django.DjangoTemplates',
+        # DjangoTemplates that also times rendering (core.timing)
+        'BACKEND': 'core.timing.TimedDjangoTemplates',
         'DIRS': [BASE_DIR / 'templates'],  # This line is important!
         'APP_DIRS': True,
         'OPTIONS': {
@@ -183,6 +193,14 @@ CLEANUP_IGNORE_FIELDS = {
 # Disable django-cleanup deletions globally; our code removes old files safely.
 CLEANUP_KEEP_MEDIA_FILES = True
 
+# Store projects media content-addressed (projects.storage), so identical
+# uploads share one file on disk and are charged once per user.
+MEDIA_DEDUP_ENABLED = True
+
+# Orphaned media (see `manage.py reconcile_media`) younger than this is kept,
+# so in-flight uploads and renders are never collected.
+MEDIA_GC_GRACE_HOURS = 24
+
 LOGIN_REDIRECT_URL = 'projects:dashboard'
 LOGIN_URL = 'accounts:login'
 LOGOUT_REDIRECT_URL = 'accounts:login'
@@ -197,7 +215,8 @@ REDIS_URL = os.environ.get('REDIS_URL', '').strip()
 if REDIS_URL:
     CACHES = {
         'default': {
-            'BACKEND': 'django_redis.cache.RedisCache',
+            # django_redis RedisCache with hit/miss timing (core.timing)
+            'BACKEND': 'core.timing.TimedRedisCache',
             'LOCATION': REDIS_URL,
             'OPTIONS': {
                 'CLIENT_CLASS': 'django_redis.client.DefaultClient',
@@ -210,13 +229,135 @@ else:
     # Default cache for throttling (LocMemCache is fine for single-instance)
     CACHES = {
         'default': {
-            'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+            'BACKEND': 'core.timing.TimedLocMemCache',
             'LOCATION': 'default-locmem-cache',
         }
     }
 
+# Periodic upkeep, run by `celery -A multimedia_portfolio beat` (times in UTC).
+# Without beat, schedule the equivalent management commands with cron. Tasks
+# whose *_DAYS setting is 0 return straight away. Orphaned media is only
+# reported; deleting it is left to `manage.py reconcile_media --delete`.
+from celery.schedules import crontab
+CELERY_BEAT_SCHEDULE = {
+    'build-request-rollups': {
+        'task': 'core.tasks.build_request_rollups_task',
+        'schedule': crontab(minute='*/5'),
+    },
+    # Archive first, so retention only drops rows the archive already holds
+    'archive-telemetry': {
+        'task': 'core.tasks.archive_telemetry_task',
+        'schedule': crontab(hour=2, minute=10),
+    },
+    'maintain-request-logs': {
+        'task': 'core.tasks.maintain_request_logs_task',
+        'schedule': crontab(hour=2, minute=40),
+    },
+    'compact-device-locations': {
+        'task': 'core.tasks.compact_device_locations_task',
+        'schedule': crontab(hour=3, minute=10),
+    },
+    'reconcile-media': {
+        'task': 'projects.tasks.reconcile_media_task',
+        'schedule': crontab(hour=4, minute=0),
+        'kwargs': {'dry_run': True},
+    },
+}
+
+# Render mockups in a Celery task (projects.rendering) instead of the request.
+# Needs a worker, so it defaults to on only when Redis is configured.
+MOCKUP_RENDER_ASYNC = os.environ.get('MOCKUP_RENDER_ASYNC', '1' if REDIS_URL else '0') == '1'
+# A queued render that has not started after this long is taken as lost and
+# queued again by the next update or status poll.
+MOCKUP_RENDER_QUEUE_TIMEOUT_SECONDS = 300
+# Editor previews are rendered from layer copies downscaled to this long edge
+# (cached in MOCKUP_PROXY_DIR, trimmed to MOCKUP_PROXY_CACHE_MB least recently
+# used first) and sent as WebP at MOCKUP_PREVIEW_QUALITY.
+MOCKUP_PREVIEW_LONG_EDGE = 1024
+MOCKUP_PREVIEW_QUALITY = 80
+MOCKUP_PROXY_DIR = os.environ.get('MOCKUP_PROXY_DIR', str(BASE_DIR / 'cache' / 'mockup_proxies'))
+MOCKUP_PROXY_CACHE_MB = 1024
+# Decoded and transformed mockup layers kept per process (projects.layers),
+# plus decoded layers shared between processes on disk when a directory is set.
+MOCKUP_LAYER_CACHE_MB = 512
+MOCKUP_LAYER_DISK_CACHE_DIR = os.environ.get('MOCKUP_LAYER_DISK_CACHE_DIR', '')
+MOCKUP_LAYER_DISK_CACHE_MB = 2048
+# Batch rendering (projects.batch): worker processes (0 = one per CPU) and
+# the most mockups one API request may create or re-render, or render inline
+# when MOCKUP_RENDER_ASYNC is off.
+MOCKUP_BATCH_WORKERS = 0
+MOCKUP_BATCH_MAX = 50
+MOCKUP_BATCH_INLINE_MAX = 5
+
 # Per-user storage quota (in MB)
 USER_STORAGE_QUOTA_MB = 1536  # 1.5 GB
+# How long an in-flight upload may hold quota before the hold lapses
+STORAGE_RESERVATION_TTL_SECONDS = 15 * 60
+
+# Request logging: RequestLog rows are queued in-process and written in
+# batches by a background thread (core.logsink). Rows the database rejects
+# go to REQUEST_LOG_DEAD_LETTER_PATH; rows that fail because the database is
+# unavailable are spooled to REQUEST_LOG_SPOOL_PATH and replayed later, up to
+# REQUEST_LOG_SPOOL_MAX_BYTES and REQUEST_LOG_SPOOL_MAX_AGE_SECONDS old. Tests
+# insert rows inline so nothing outlives the test transaction.
+REQUEST_LOG_ASYNC = not TESTING
+REQUEST_LOG_BATCH_SIZE = 200
+REQUEST_LOG_FLUSH_SECONDS = 2.0
+REQUEST_LOG_QUEUE_MAX = 10000
+REQUEST_LOG_SPOOL_PATH = str(LOG_DIR / 'requestlog.spool.ndjson')
+REQUEST_LOG_DEAD_LETTER_PATH = str(LOG_DIR / 'requestlog.rejected.ndjson')
+REQUEST_LOG_SPOOL_MAX_BYTES = 50 * 1024 * 1024
+REQUEST_LOG_SPOOL_MAX_AGE_SECONDS = 24 * 3600
+# Hourly analytics rollups (core.rollups). CELERY_BEAT_SCHEDULE runs
+# core.tasks.build_request_rollups_task (or `manage.py build_request_rollups`)
+# every five minutes; an hour is rolled up once this many seconds past its end.
+# Rows that reach the database later than that (spool replay) mark their hour
+# for another pass.
+REQUEST_ROLLUP_LAG_SECONDS = 300
+# Which requests are logged (core.logrules). Sampled rows carry a weight so
+# analytics totals stay accurate; errors and slow requests are always kept.
+REQUEST_LOG_RULES = {
+    'exclude_prefixes': ['/static/', '/media/', '/favicon.ico', '/robots.txt'],
+    'sample_rates': {
+        '/i18n/': 0.1,
+        '/api/device/location/': 0.1,
+        '/api/device/locations/': 0.1,
+    },
+    'default_rate': 1.0,
+    'always_log_status': 400,
+    'always_log_slow_ms': 1000,
+}
+# RequestLog retention (core.retention). On PostgreSQL the table is
+# partitioned by month; core.tasks.maintain_request_logs_task (or
+# `manage.py requestlog_partitions`) runs daily. 0 keeps logs forever.
+REQUEST_LOG_RETENTION_DAYS = 0
+REQUEST_LOG_PARTITIONS_AHEAD = 2
+# Device location ingest (core.locations): a fix is stored only when it is
+# more than max(MIN_DISTANCE_M, ACCURACY_FACTOR * combined accuracy) from the
+# previous stored point, or MIN_INTERVAL_SECONDS after it.
+DEVICE_LOCATION_MIN_DISTANCE_M = 50
+DEVICE_LOCATION_ACCURACY_FACTOR = 1.0
+DEVICE_LOCATION_MIN_INTERVAL_SECONDS = 1800
+DEVICE_LOCATION_BATCH_MAX = 100
+DEVICE_LOCATION_MAX_AGE_SECONDS = 86400
+# Offline reverse geocoding of fixes (core.places): a GeoNames cities*.txt
+# dump (admin1CodesASCII.txt / countryInfo.txt alongside for names) or a CSV
+# with latitude, longitude, city, region, country columns.
+PLACES_DATASET_PATH = os.environ.get('PLACES_DATASET_PATH', str(BASE_DIR / 'geoip' / 'cities15000.txt'))
+PLACES_MAX_DISTANCE_KM = 100
+PLACES_CACHE_SIZE = 100000
+PLACES_RESOLVE_ON_INGEST = True
+# History compaction (core.trajectory): fixes older than COMPACT_AFTER_DAYS
+# are thinned to within COMPACT_TOLERANCE_M of the original track by
+# core.tasks.compact_device_locations_task. 0 disables the task.
+DEVICE_LOCATION_COMPACT_AFTER_DAYS = 0
+DEVICE_LOCATION_COMPACT_TOLERANCE_M = 25
+DEVICE_LOCATION_COMPACT_MAX_GAP_MINUTES = 360
+# Cold archive (core.archive): rows older than TELEMETRY_ARCHIVE_AFTER_DAYS
+# are moved from RequestLog/DeviceLocation into compressed per-day column
+# files by core.tasks.archive_telemetry_task. 0 disables the task.
+TELEMETRY_ARCHIVE_DIR = os.environ.get('TELEMETRY_ARCHIVE_DIR', str(BASE_DIR / 'archive'))
+TELEMETRY_ARCHIVE_AFTER_DAYS = 0
 
 # Admin IP allowlist (empty means allow all)
 ADMIN_IP_ALLOWLIST = []  # e.g., ['127.0.0.1', '192.168.1.10']
@@ -242,14 +383,14 @@ LOGGING = {
         },
         'security_file': {
             'class': 'logging.handlers.RotatingFileHandler',
-            'filename': str(BASE_DIR / 'logs' / 'security.log'),
+            'filename': str(LOG_DIR / 'security.log'),
             'maxBytes': 1024*1024*5,
             'backupCount': 3,
             'formatter': 'verbose',
         },
         'activity_file': {
             'class': 'logging.handlers.RotatingFileHandler',
-            'filename': str(BASE_DIR / 'logs' / 'activity.log'),
+            'filename': str(LOG_DIR / 'activity.log'),
             'maxBytes': 1024*1024*10,
             'backupCount': 5,
             'formatter': 'verbose',
@@ -0,0 +1,187 @@
+"""
+Batch mockup rendering: one design on many containers.
+
+``create_batch`` makes a mockup for each container image, all pointing at
+one stored copy of the design (and mask); ``apply_design`` puts a design on
+existing mockups. The shared copy is always a content-addressed blob
+(``projects.storage``), even with ``MEDIA_DEDUP_ENABLED`` off, so the owner
+is charged for it once rather than once per mockup. ``render_batch`` then renders the mockups in a pool of
+processes. Each worker keeps the decoded design and its resized and masked
+layers in its layer cache (``projects.layers``), so after its first job only
+the container decode and the composite are new work. Results are stored by
+the parent through ``projects.rendering.store_render``, so mockups open in
+the editor pick them up like any other render.
+
+``manage.py render_mockups`` and ``projects.tasks.render_mockup_batch_task``
+drive it; the API is ``projects.views.mockup_batch``, which never starts a
+pool inside a web request.
+"""
+import logging
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from django.conf import settings
+from django.db import connections
+
+from .models import PackageMockup
+from .rendering import bump_render_version, compose_mockup_image, store_render
+from .storage import content_digest, find_processed_blob, get_blob_storage
+
+logger = logging.getLogger('security')
+
+PARAMS = [
+    'design_pos_x', 'design_pos_y', 'design_scale', 'design_rotation',
+    'mask_opacity', 'mask_feather', 'mask_invert',
+]
+
+
+def _save_layer(field, upload):
+    """Store a cleaned upload once, as a blob; returns its storage name."""
+    from .views import _process_image_strip_metadata
+    source_digest = content_digest(upload)
+    blob = find_processed_blob(source_digest)
+    if blob is not None:
+        return blob.name
+    processed = _process_image_strip_metadata(upload)
+    if not processed:
+        raise ValueError(f"{field} is not a readable image")
+    content, new_name = processed
+    content.source_sha256 = source_digest
+    return get_blob_storage().save(new_name, content)
+
+
+def create_batch(owner, design, containers, mask=None, params=None, title=''):
+    """
+    A new mockup per container upload (File objects), sharing ``design`` and
+    ``mask``. Containers that are not readable images are skipped.
+    """
+    from .views import _save_clean_image
+    design_name = _save_layer('design_image', design)
+    mask_name = _save_layer('mask_image', mask) if mask else None
+    mockups = []
+    for upload in containers:
+        mockup = PackageMockup(owner=owner, **(params or {}))
+        if not _save_clean_image(mockup.container_image, upload):
+            continue
+        label = os.path.splitext(os.path.basename(getattr(upload, 'name', '') or ''))[0]
+        mockup.title = (f"{title or 'Batch'}: {label}" if label else title or 'Batch')[:200]
+        mockup.design_image.name = design_name
+        mockup.mask_image.name = mask_name
+        mockup.save()
+        mockups.append(mockup)
+    return mockups
+
+
+def apply_design(mockups, design=None, mask=None, params=None):
+    """Point existing mockups at one new design and mask (either optional) and set ``params``."""
+    mockups = list(mockups)
+    if not mockups:
+        return mockups
+    updates = dict(params or {})
+    if design:
+        updates['design_image'] = _save_layer('design_image', design)
+    if mask:
+        updates['mask_image'] = _save_layer('mask_image', mask)
+    if not updates:
+        return mockups
+    for mockup in mockups:
+        for name, value in updates.items():
+            if name in ('design_image', 'mask_image'):
+                getattr(mockup, name).name = value
+            else:
+                setattr(mockup, name, value)
+        mockup.save(update_fields=list(updates))
+    return mockups
+
+
+def _job(mockup):
+    fields = {name: getattr(mockup, name) for name in PARAMS}
+    fields['container_image'] = mockup.container_image.name
+    fields['design_image'] = mockup.design_image.name
+    fields['mask_image'] = mockup.mask_image.name if mockup.mask_image else None
+    return mockup.pk, fields
+
+
+def _render_job(job):
+    # Runs in a worker: an unsaved mockup is enough to open the stored layers
+    pk, fields = job
+    return compose_mockup_image(PackageMockup(pk=pk, **fields))
+
+
+def _init_worker():
+    from django.apps import apps
+    if not apps.ready:
+        import django
+        django.setup()
+
+
+def _worker_count(workers, jobs):
+    if workers is None:
+        workers = getattr(settings, 'MOCKUP_BATCH_WORKERS', 0)
+    workers = workers or os.cpu_count() or 1
+    if multiprocessing.current_process().daemon:
+        # Celery's prefork children may not start processes of their own
+        return 1
+    return max(1, min(workers, jobs))
+
+
+def render_batch(mockups, workers=None, progress=None):
+    """
+    Render each mockup's current version in a process pool. ``progress``,
+    if given, is called as ``progress(done, total, mockup, ok)`` as renders
+    finish. Returns ``{'total': n, 'rendered': n, 'failed': n, 'skipped': n}``.
+    """
+    pending = [m for m in mockups if m.rendered_version < m.render_version]
+    report = {'total': len(pending), 'rendered': 0, 'failed': 0, 'skipped': 0}
+
+    def finish(mockup, data):
+        if not store_render(mockup, mockup.render_version, data):
+            report['skipped'] += 1
+        elif data is None:
+            report['failed'] += 1
+        else:
+            report['rendered'] += 1
+        done = report['rendered'] + report['failed'] + report['skipped']
+        if progress is not None:
+            progress(done, report['total'], mockup, data is not None)
+
+    count = _worker_count(workers, len(pending))
+    if count <= 1:
+        for mockup in pending:
+            finish(mockup, _render_job(_job(mockup)))
+        return report
+    # Forked workers must not share the parent's database sockets
+    connections.close_all()
+    with ProcessPoolExecutor(max_workers=count, initializer=_init_worker) as pool:
+        futures = {pool.submit(_render_job, _job(m)): m for m in pending}
+        for future in as_completed(futures):
+            mockup = futures[future]
+            try:
+                data = future.result()
+            except Exception as e:
+                logger.error(f"Batch render of mockup {mockup.pk} failed: {e}")
+                data = None
+            finish(mockup, data)
+    return report
+
+
+def start_batch(mockups, workers=None, progress=None, queue=None):
+    """
+    Mark ``mockups`` for rendering and render them, on a Celery worker when
+    ``queue`` (default ``MOCKUP_RENDER_ASYNC``) is set, falling back to
+    inline. Returns the render report, or None when queued.
+    """
+    mockups = list(mockups)
+    for mockup in mockups:
+        bump_render_version(mockup)
+    if queue is None:
+        queue = getattr(settings, 'MOCKUP_RENDER_ASYNC', False)
+    if queue:
+        from .tasks import render_mockup_batch_task
+        try:
+            render_mockup_batch_task.delay([m.pk for m in mockups])
+            return None
+        except Exception as e:
+            logger.warning(f"Mockup render queue unavailable, rendering batch inline: {e}")
+    return render_batch(mockups, workers=workers, progress=progress)
@@ -0,0 +1,105 @@
+"""
+Pixel operations for mockup rendering.
+
+Placing the design only changes the pixels under it, so ``composite()``
+copies the base once and blends just the design's bounding box (clipped to
+the base) into it, in bands of ``BAND_ROWS`` rows to bound peak memory on
+large container photos. With NumPy the blend is premultiplied-alpha math on
+float32 arrays; without it, Pillow's ``alpha_composite`` runs on the same
+region. ``multiply_alpha()`` applies a mask at an opacity to the design's
+alpha channel the same way. Both engines match the earlier full-canvas
+Pillow output to within one level per channel.
+"""
+try:
+    from PIL import Image, ImageChops
+except Exception:
+    Image = None
+
+try:
+    import numpy as np
+except Exception:  # pragma: no cover - optional
+    np = None
+
+BAND_ROWS = 512
+
+
+def multiply_alpha(design, mask, opacity):
+    """Copy of RGBA ``design`` with its alpha multiplied by ``mask`` (L, same size) at ``opacity`` (0-1)."""
+    masked = design.convert('RGBA') if design.mode != 'RGBA' else design.copy()
+    if np is not None:
+        alpha = np.asarray(masked.getchannel('A'), dtype=np.uint32)
+        # The same truncated opacity table as the Pillow path
+        scaled = (np.arange(256) * opacity).astype(np.uint32)[np.asarray(mask)]
+        # a * b / 255, truncated as ImageChops.multiply does
+        combined = (alpha * scaled // 255).astype(np.uint8)
+        masked.putalpha(Image.fromarray(combined, 'L'))
+        return masked
+    mask_scaled = mask.point(lambda p: int(p * opacity))
+    masked.putalpha(ImageChops.multiply(masked.getchannel('A'), mask_scaled))
+    return masked
+
+
+def _clip(base_size, design_size, pos):
+    """``(base_box, design_box)`` of the overlap, or None if they do not overlap."""
+    x, y = pos
+    left, top = max(0, x), max(0, y)
+    right = min(base_size[0], x + design_size[0])
+    bottom = min(base_size[1], y + design_size[1])
+    if left >= right or top >= bottom:
+        return None
+    return (left, top, right, bottom), (left - x, top - y, right - x, bottom - y)
+
+
+def _blend_numpy(dst, src):
+    """RGB uint8 of RGBA ``src`` over RGBA ``dst`` (arrays of equal shape)."""
+    if dst[..., 3].min() == 255:
+        # Opaque base (the usual photo): src * sa + dst * (255 - sa), / 255
+        # rounded as (x + 128 + ((x + 128) >> 8)) >> 8, one plane at a time
+        sa = src[..., 3].astype(np.uint16)
+        inv = 255 - sa
+        out = np.empty(src.shape[:2] + (3,), dtype=np.uint8)
+        for c in range(3):
+            t = src[..., c] * sa
+            t += dst[..., c] * inv
+            t += 128
+            t += t >> 8
+            t >>= 8
+            out[..., c] = t
+        return out
+    sa = src[..., 3:].astype(np.float32) / 255.0
+    da = dst[..., 3:].astype(np.float32) / 255.0
+    # Premultiplied: colour = S + D * (1 - sa), alpha = sa + da * (1 - sa)
+    keep = da * (1.0 - sa)
+    out_a = sa + keep
+    out = src[..., :3] * sa + dst[..., :3] * keep
+    np.divide(out, out_a, out=out, where=out_a > 0)
+    out += 0.5
+    np.clip(out, 0, 255, out=out)
+    out = out.astype(np.uint8)
+    # Pillow leaves the base colour where both are fully transparent
+    np.copyto(out, dst[..., :3], where=out_a <= 0)
+    return out
+
+
+def composite(base, design, pos):
+    """
+    RGB image of RGBA ``design`` alpha-composited onto RGBA ``base`` with
+    its top-left corner at ``pos`` (which may lie outside the base).
+    """
+    out = base.convert('RGB')
+    boxes = _clip(base.size, design.size, pos)
+    if boxes is None:
+        return out
+    (left, top, right, bottom), (dx, dy, _, _) = boxes
+    for band_top in range(top, bottom, BAND_ROWS):
+        band_bottom = min(bottom, band_top + BAND_ROWS)
+        region = (left, band_top, right, band_bottom)
+        src_region = (dx, dy + band_top - top, dx + right - left, dy + band_bottom - top)
+        if np is not None:
+            rgb = _blend_numpy(np.asarray(base.crop(region)), np.asarray(design.crop(src_region)))
+            out.paste(Image.fromarray(rgb, 'RGB'), region[:2])
+        else:
+            dst = base.crop(region)
+            dst.alpha_composite(design.crop(src_region))
+            out.paste(dst.convert('RGB'), region[:2])
+    return out
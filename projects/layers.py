@@ -0,0 +1,177 @@
+"""
+Memoised image layers for mockup rendering.
+
+``projects.rendering`` builds a mockup in stages (decode, resize, mask,
+alpha, rotate) and looks each stage up here under a key made of the source
+file name (stored media never changes under a name) and the parameters that
+stage depends on, so a re-render only recomputes the stages whose inputs
+changed; moving the design redoes nothing but the final composite.
+
+Layers live in a per-process LRU bounded by ``MOCKUP_LAYER_CACHE_MB``.
+Stages marked shared also go to ``MOCKUP_LAYER_DISK_CACHE_DIR`` when it is
+set, as raw pixels, so other web and worker processes skip the decode;
+the directory is trimmed to ``MOCKUP_LAYER_DISK_CACHE_MB``, least recently
+used first. Cached images are shared and must not be modified in place.
+"""
+import hashlib
+import json
+import logging
+import os
+import threading
+from collections import OrderedDict
+
+from django.conf import settings
+
+try:
+    from PIL import Image
+except Exception:
+    Image = None
+
+logger = logging.getLogger('security')
+
+MB = 1024 * 1024
+
+
+def _nbytes(value):
+    if isinstance(value, tuple):
+        return sum(_nbytes(v) for v in value)
+    if Image is not None and isinstance(value, Image.Image):
+        return value.width * value.height * len(value.getbands())
+    return 0
+
+
+class LayerCache:
+    """Size-bounded LRU of layers, with an optional shared disk tier."""
+
+    def __init__(self, max_bytes, disk_dir='', disk_max_bytes=0):
+        self.max_bytes = max(0, int(max_bytes))
+        self.disk_dir = str(disk_dir or '')
+        self.disk_max_bytes = max(0, int(disk_max_bytes))
+        self._items = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, build, shared=False):
+        """The cached value for ``key``, built with ``build()`` on a miss."""
+        with self._lock:
+            hit = self._items.get(key)
+            if hit is not None:
+                self._items.move_to_end(key)
+                self.hits += 1
+                return hit[0]
+            self.misses += 1
+        value = None
+        if shared and self.disk_dir:
+            value = self._disk_read(key)
+        if value is None:
+            value = build()
+            if shared and self.disk_dir:
+                self._disk_write(key, value)
+        self._put(key, value)
+        return value
+
+    def _put(self, key, value):
+        size = _nbytes(value)
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            old = self._items.pop(key, None)
+            if old is not None:
+                self._bytes -= old[1]
+            self._items[key] = (value, size)
+            self._bytes += size
+            while self._bytes > self.max_bytes:
+                _, (_, evicted) = self._items.popitem(last=False)
+                self._bytes -= evicted
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+            self._bytes = 0
+
+    def _disk_path(self, key):
+        digest = hashlib.sha1(repr(key).encode()).hexdigest()
+        return os.path.join(self.disk_dir, digest[:2], f'{digest}.layer')
+
+    def _disk_read(self, key):
+        path = self._disk_path(key)
+        try:
+            with open(path, 'rb') as f:
+                header = json.loads(f.readline())
+                image = Image.frombytes(header['mode'], tuple(header['size']), f.read())
+            os.utime(path)
+            return image
+        except FileNotFoundError:
+            return None
+        except Exception as e:
+            logger.warning(f"Ignoring unreadable mockup layer {path}: {e}")
+            return None
+
+    def _disk_write(self, key, image):
+        if Image is None or not isinstance(image, Image.Image):
+            return
+        size = _nbytes(image)
+        if size > self.disk_max_bytes:
+            return
+        path = self._disk_path(key)
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+            with open(tmp, 'wb') as f:
+                f.write(json.dumps({'mode': image.mode, 'size': list(image.size)}).encode() + b'\n')
+                f.write(image.tobytes())
+            os.replace(tmp, path)
+            self._trim_disk()
+        except Exception as e:
+            logger.warning(f"Could not cache mockup layer {path}: {e}")
+
+    def _trim_disk(self):
+        trim_dir(self.disk_dir, self.disk_max_bytes, '.layer')
+
+
+def trim_dir(directory, max_bytes, suffix):
+    """Remove the least recently used ``suffix`` files until ``directory`` fits in ``max_bytes``."""
+    entries = []
+    total = 0
+    for root, _, files in os.walk(directory):
+        for name in files:
+            if not name.endswith(suffix):
+                continue
+            path = os.path.join(root, name)
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            entries.append((st.st_mtime, st.st_size, path))
+            total += st.st_size
+    if total <= max_bytes:
+        return
+    entries.sort()
+    for _, size, path in entries:
+        try:
+            os.remove(path)
+        except OSError:
+            continue
+        total -= size
+        if total <= max_bytes * 0.9:
+            break
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_layer_cache():
+    """The process-wide LayerCache (built on first use)."""
+    global _cache
+    if _cache is None:
+        with _cache_lock:
+            if _cache is None:
+                _cache = LayerCache(
+                    getattr(settings, 'MOCKUP_LAYER_CACHE_MB', 512) * MB,
+                    disk_dir=getattr(settings, 'MOCKUP_LAYER_DISK_CACHE_DIR', ''),
+                    disk_max_bytes=getattr(settings, 'MOCKUP_LAYER_DISK_CACHE_MB', 2048) * MB,
+                )
+    return _cache
@@ -0,0 +1,37 @@
+from django.core.management.base import BaseCommand
+from projects.reconcile import reconcile_media
+
+
+class Command(BaseCommand):
+    help = 'Find (and optionally delete) media files no longer referenced by any project or mockup'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--delete', action='store_true',
+                            help='Delete orphans (default is a dry run that only reports them)')
+        parser.add_argument('--grace-hours', type=float, default=None,
+                            help='Ignore files modified more recently than this (default: MEDIA_GC_GRACE_HOURS)')
+        parser.add_argument('--workers', type=int, default=None,
+                            help='Directory-scan threads')
+        parser.add_argument('--no-resync', action='store_true',
+                            help='Skip re-syncing per-user storage totals')
+
+    def handle(self, *args, **options):
+        report = reconcile_media(
+            dry_run=not options['delete'],
+            grace_hours=options['grace_hours'],
+            workers=options['workers'],
+            resync=not options['no_resync'],
+        )
+        if options['verbosity'] > 1:
+            for name in report['orphan_names']:
+                self.stdout.write(f"orphan: {name}")
+        verb = 'Deleted' if options['delete'] else 'Would delete'
+        self.stdout.write(
+            f"Scanned {report['scanned']} files in {report['seconds']}s; "
+            f"{report['referenced']} referenced, {report['kept_recent']} within grace period."
+        )
+        self.stdout.write(self.style.SUCCESS(
+            f"{verb} {report['orphans'] if not options['delete'] else report['deleted']} orphans "
+            f"({round(report['orphan_bytes'] / (1024 * 1024), 2)} MB); "
+            f"re-synced {report['users_resynced']} users."
+        ))
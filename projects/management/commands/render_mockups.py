@@ -0,0 +1,83 @@
+import os
+from contextlib import ExitStack
+
+from django.contrib.auth.models import User
+from django.core.files import File
+from django.core.management.base import BaseCommand, CommandError
+
+from projects import batch
+from projects.models import PackageMockup
+
+
+class Command(BaseCommand):
+    help = 'Render one design onto many container images (new mockups) or existing mockups, in parallel'
+
+    def add_arguments(self, parser):
+        parser.add_argument('containers', nargs='*', help='Container image files; one new mockup each')
+        parser.add_argument('--owner', help='Username owning new mockups (and the only owner of --mockup ids)')
+        parser.add_argument('--design', help='Design image file (required for new mockups)')
+        parser.add_argument('--mask', help='Optional mask image file')
+        parser.add_argument('--mockup', type=int, action='append', dest='mockups', default=[],
+                            help='Existing mockup id to re-render (repeatable); gets --design/--mask if given')
+        parser.add_argument('--title', default='', help='Title prefix for new mockups')
+        parser.add_argument('--x', type=float, dest='design_pos_x')
+        parser.add_argument('--y', type=float, dest='design_pos_y')
+        parser.add_argument('--scale', type=float, dest='design_scale')
+        parser.add_argument('--rotation', type=float, dest='design_rotation')
+        parser.add_argument('--mask-opacity', type=float, dest='mask_opacity')
+        parser.add_argument('--mask-feather', type=float, dest='mask_feather')
+        parser.add_argument('--mask-invert', action='store_true', default=None, dest='mask_invert')
+        parser.add_argument('--workers', type=int, default=None,
+                            help='Render processes (default: MOCKUP_BATCH_WORKERS, or one per CPU)')
+
+    def handle(self, *args, **options):
+        containers = options['containers']
+        if not containers and not options['mockups']:
+            raise CommandError('Give container image files and/or --mockup ids')
+        owner = None
+        if options['owner']:
+            owner = User.objects.filter(username=options['owner']).first()
+            if owner is None:
+                raise CommandError(f"No user named {options['owner']}")
+        if containers and (owner is None or not options['design']):
+            raise CommandError('New mockups need --owner and --design')
+        for path in containers + [p for p in (options['design'], options['mask']) if p]:
+            if not os.path.isfile(path):
+                raise CommandError(f'Not a file: {path}')
+        params = {name: options[name] for name in batch.PARAMS if options.get(name) is not None}
+
+        existing = PackageMockup.objects.filter(pk__in=options['mockups']).select_related('owner')
+        if owner is not None:
+            existing = existing.filter(owner=owner)
+        existing = list(existing)
+        if len(existing) != len(set(options['mockups'])):
+            raise CommandError('Some --mockup ids do not exist (or belong to another owner)')
+
+        def as_file(stack, path):
+            return File(stack.enter_context(open(path, 'rb')), name=os.path.basename(path)) if path else None
+
+        mockups = []
+        try:
+            with ExitStack() as stack:
+                design = as_file(stack, options['design'])
+                mask = as_file(stack, options['mask'])
+                if containers:
+                    uploads = [as_file(stack, path) for path in containers]
+                    mockups += batch.create_batch(owner, design, uploads, mask=mask, params=params,
+                                                  title=options['title'])
+                    if len(mockups) < len(containers):
+                        self.stderr.write(f'Skipped {len(containers) - len(mockups)} unreadable container images')
+                if existing:
+                    mockups += batch.apply_design(existing, design, mask=mask, params=params)
+        except ValueError as e:
+            raise CommandError(str(e))
+
+        def progress(done, total, mockup, ok):
+            status = 'ok' if ok else 'FAILED'
+            self.stdout.write(f'[{done}/{total}] mockup {mockup.pk} {status}')
+
+        report = batch.start_batch(mockups, workers=options['workers'], progress=progress, queue=False)
+        self.stdout.write(self.style.SUCCESS(
+            f"Rendered {report['rendered']} of {report['total']} mockups "
+            f"({report['failed']} failed, {report['skipped']} superseded)"
+        ))
@@ -0,0 +1,29 @@
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+from projects.usage import rebuild_usage, refresh_default_quotas
+
+
+class Command(BaseCommand):
+    help = 'Rebuild the per-user storage ledger by walking each user\'s media'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--user', dest='usernames', action='append', default=[],
+                            help='Only re-sync this username (repeatable)')
+        parser.add_argument('--quotas-only', action='store_true',
+                            help='Only re-apply USER_STORAGE_QUOTA_MB to users without an override')
+
+    def handle(self, *args, **options):
+        if options['quotas_only']:
+            updated = refresh_default_quotas()
+            self.stdout.write(self.style.SUCCESS(f'Updated default quota for {updated} users'))
+            return
+        users = User.objects.all().order_by('pk')
+        if options['usernames']:
+            users = users.filter(username__in=options['usernames'])
+        count = 0
+        for user in users.iterator(chunk_size=500):
+            usage = rebuild_usage(user)
+            count += 1
+            if options['verbosity'] > 1:
+                self.stdout.write(f"@{user.username}: {usage.total_bytes} bytes")
+        self.stdout.write(self.style.SUCCESS(f'Re-synced storage usage for {count} users'))
@@ -0,0 +1,88 @@
+# Generated by Django 5.2.7 on 2026-10-18 02:09
+
+import django.db.models.deletion
+import projects.models
+import projects.storage
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('projects', '0008_alter_packagemockup_container_image_and_more'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MediaBlob',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('sha256', models.CharField(max_length=64, unique=True)),
+                ('source_sha256', models.CharField(blank=True, db_index=True, max_length=64)),
+                ('name', models.CharField(max_length=255, unique=True)),
+                ('size', models.BigIntegerField(default=0)),
+                ('ref_count', models.IntegerField(default=0)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+            ],
+        ),
+        migrations.AlterField(
+            model_name='packagemockup',
+            name='container_image',
+            field=models.ImageField(storage=projects.storage.get_media_storage, upload_to='mockups/containers/', validators=[projects.models.MaxSizeValidator(15), projects.models.ExtensionValidator({'jpeg', 'jpg', 'png', 'webp'})]),
+        ),
+        migrations.AlterField(
+            model_name='packagemockup',
+            name='design_image',
+            field=models.ImageField(storage=projects.storage.get_media_storage, upload_to='mockups/designs/', validators=[projects.models.MaxSizeValidator(15), projects.models.ExtensionValidator({'jpeg', 'jpg', 'png', 'webp'})]),
+        ),
+        migrations.AlterField(
+            model_name='packagemockup',
+            name='generated_image',
+            field=models.ImageField(blank=True, null=True, storage=projects.storage.get_media_storage, upload_to='mockups/generated/', validators=[projects.models.MaxSizeValidator(20), projects.models.ExtensionValidator({'jpeg', 'jpg', 'png', 'webp'})]),
+        ),
+        migrations.AlterField(
+            model_name='packagemockup',
+            name='mask_image',
+            field=models.ImageField(blank=True, null=True, storage=projects.storage.get_media_storage, upload_to='mockups/masks/', validators=[projects.models.MaxSizeValidator(10), projects.models.ExtensionValidator({'png', 'webp'})]),
+        ),
+        migrations.AlterField(
+            model_name='project',
+            name='audio_file',
+            field=models.FileField(blank=True, null=True, storage=projects.storage.get_media_storage, upload_to='project_audio/', validators=[projects.models.MaxSizeValidator(100), projects.models.ExtensionValidator({'aac', 'flac', 'mp3', 'ogg', 'wav'})]),
+        ),
+        migrations.AlterField(
+            model_name='project',
+            name='cover_image',
+            field=models.ImageField(blank=True, null=True, storage=projects.storage.get_media_storage, upload_to='project_covers/', validators=[projects.models.MaxSizeValidator(10), projects.models.ExtensionValidator({'jpeg', 'jpg', 'png', 'webp'})]),
+        ),
+        migrations.AlterField(
+            model_name='project',
+            name='video_file',
+            field=models.FileField(blank=True, null=True, storage=projects.storage.get_media_storage, upload_to='project_video/', validators=[projects.models.MaxSizeValidator(300), projects.models.ExtensionValidator({'mkv', 'mov', 'mp4', 'webm'})]),
+        ),
+        migrations.AlterField(
+            model_name='projectfile',
+            name='file',
+            field=models.FileField(storage=projects.storage.get_media_storage, upload_to='project_files/', validators=[projects.models.MaxSizeValidator(100), projects.models.ExtensionValidator({'ai', 'doc', 'docx', 'pdf', 'ppt', 'pptx', 'psd', 'rar', 'txt', 'xls', 'xlsx', 'zip'})]),
+        ),
+        migrations.AlterField(
+            model_name='projectimage',
+            name='image',
+            field=models.ImageField(storage=projects.storage.get_media_storage, upload_to='project_images/', validators=[projects.models.MaxSizeValidator(10), projects.models.ExtensionValidator({'jpeg', 'jpg', 'png', 'webp'})]),
+        ),
+        migrations.CreateModel(
+            name='MediaBlobOwner',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('kind', models.CharField(max_length=16)),
+                ('ref_count', models.IntegerField(default=0)),
+                ('blob', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='owners', to='projects.mediablob')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='media_blobs', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'unique_together': {('blob', 'user')},
+            },
+        ),
+    ]
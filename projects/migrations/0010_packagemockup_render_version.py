@@ -0,0 +1,28 @@
+# Generated by Django 5.2.7 on 2026-10-18 02:36
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('projects', '0009_mediablob_alter_packagemockup_container_image_and_more'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='packagemockup',
+            name='render_queued',
+            field=models.BooleanField(default=False),
+        ),
+        migrations.AddField(
+            model_name='packagemockup',
+            name='render_version',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='packagemockup',
+            name='rendered_version',
+            field=models.PositiveIntegerField(default=0),
+        ),
+    ]
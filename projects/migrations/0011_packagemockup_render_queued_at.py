@@ -0,0 +1,22 @@
+# Generated by Django 5.2.7 on 2026-10-18 03:02
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('projects', '0010_packagemockup_render_version'),
+    ]
+
+    operations = [
+        migrations.RemoveField(
+            model_name='packagemockup',
+            name='render_queued',
+        ),
+        migrations.AddField(
+            model_name='packagemockup',
+            name='render_queued_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+    ]
@@ -7,6 +7,7 @@ from django.urls import reverse
 from embed_video.fields import EmbedVideoField
 import os
 from django.utils.deconstruct import deconstructible
+from .storage import get_media_storage
 
 @deconstructible
 class MaxSizeValidator:
@@ -68,16 +69,16 @@ class Project(models.Model):
     
     # Media fields
     cover_image = models.ImageField(
-        upload_to='project_covers/', blank=True, null=True,
+        upload_to='project_covers/', storage=get_media_storage, blank=True, null=True,
         validators=[MaxSizeValidator(10), ExtensionValidator({'jpg','jpeg','png','webp'})]
     )
     video_file = models.FileField(
-        upload_to='project_video/', blank=True, null=True,
+        upload_to='project_video/', storage=get_media_storage, blank=True, null=True,
         validators=[MaxSizeValidator(300), ExtensionValidator({'mp4','mov','mkv','webm'})]
     )
     video_url = EmbedVideoField(blank=True, null=True)
     audio_file = models.FileField(
-        upload_to='project_audio/', blank=True, null=True,
+        upload_to='project_audio/', storage=get_media_storage, blank=True, null=True,
         validators=[MaxSizeValidator(100), ExtensionValidator({'mp3','wav','aac','flac','ogg'})]
     )
     
@@ -102,7 +103,7 @@ class Project(models.Model):
 class ProjectImage(models.Model):
     project = models.ForeignKey(Project, related_name='images', on_delete=models.CASCADE)
     image = models.ImageField(
-        upload_to='project_images/',
+        upload_to='project_images/', storage=get_media_storage,
         validators=[MaxSizeValidator(10), ExtensionValidator({'jpg','jpeg','png','webp'})]
     )
     caption = models.CharField(max_length=200, blank=True)
@@ -121,7 +122,7 @@ class ProjectFile(models.Model):
     
     project = models.ForeignKey(Project, related_name='files', on_delete=models.CASCADE)
     file = models.FileField(
-        upload_to='project_files/',
+        upload_to='project_files/', storage=get_media_storage,
         validators=[MaxSizeValidator(100), ExtensionValidator({'pdf','zip','rar','txt','doc','docx','ppt','pptx','xls','xlsx','psd','ai'})]
     )
     file_type = models.CharField(max_length=20, choices=FILE_TYPES)
@@ -151,15 +152,15 @@ class PackageMockup(models.Model):
     title = models.CharField(max_length=200)
     template = models.CharField(max_length=32, choices=TEMPLATE_CHOICES, default='freeform')
     container_image = models.ImageField(
-        upload_to='mockups/containers/',
+        upload_to='mockups/containers/', storage=get_media_storage,
         validators=[MaxSizeValidator(15), ExtensionValidator({'jpg','jpeg','png','webp'})]
     )
     design_image = models.ImageField(
-        upload_to='mockups/designs/',
+        upload_to='mockups/designs/', storage=get_media_storage,
         validators=[MaxSizeValidator(15), ExtensionValidator({'jpg','jpeg','png','webp'})]
     )
     generated_image = models.ImageField(
-        upload_to='mockups/generated/', blank=True, null=True,
+        upload_to='mockups/generated/', storage=get_media_storage, blank=True, null=True,
         validators=[MaxSizeValidator(20), ExtensionValidator({'jpg','jpeg','png','webp'})]
     )
     design_pos_x = models.FloatField(default=50.0, blank=True)
@@ -167,13 +168,50 @@ class PackageMockup(models.Model):
     design_scale = models.FloatField(default=60.0, blank=True)
     design_rotation = models.FloatField(default=0.0, blank=True)
     mask_image = models.ImageField(
-        upload_to='mockups/masks/', blank=True, null=True,
+        upload_to='mockups/masks/', storage=get_media_storage, blank=True, null=True,
         validators=[MaxSizeValidator(10), ExtensionValidator({'png','webp'})]
     )
     mask_opacity = models.FloatField(default=100.0, blank=True)
     mask_feather = models.FloatField(default=0.0, blank=True)
     mask_invert = models.BooleanField(default=False)
+    # Bumped on every parameter change; generated_image is current once
+    # rendered_version catches up (projects.rendering)
+    render_version = models.PositiveIntegerField(default=0)
+    rendered_version = models.PositiveIntegerField(default=0)
+    # When the pending render task was queued; cleared as the task starts
+    render_queued_at = models.DateTimeField(null=True, blank=True)
     created_at = models.DateTimeField(auto_now_add=True)
 
     def __str__(self):
-        return f"Mockup: {self.title} by {self.owner.username}"
\ No newline at end of file
+        return f"Mockup: {self.title} by {self.owner.username}"
+
+class MediaBlob(models.Model):
+    """
+    A content-addressed media file, stored once under ``blobs/`` and keyed by
+    the SHA-256 of its (cleaned) bytes. ``source_sha256`` is the digest of
+    the upload it was produced from, so identical re-uploads can skip
+    re-processing entirely.
+    """
+    sha256 = models.CharField(max_length=64, unique=True)
+    source_sha256 = models.CharField(max_length=64, blank=True, db_index=True)
+    name = models.CharField(max_length=255, unique=True)
+    size = models.BigIntegerField(default=0)
+    ref_count = models.IntegerField(default=0)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return f"Blob {self.sha256[:12]} ({self.size} bytes, {self.ref_count} refs)"
+
+
+class MediaBlobOwner(models.Model):
+    """How many of a user's file fields point at a blob; quota is charged once per blob."""
+    blob = models.ForeignKey(MediaBlob, related_name='owners', on_delete=models.CASCADE)
+    user = models.ForeignKey(User, related_name='media_blobs', on_delete=models.CASCADE)
+    kind = models.CharField(max_length=16)
+    ref_count = models.IntegerField(default=0)
+
+    class Meta:
+        unique_together = ('blob', 'user')
+
+    def __str__(self):
+        return f"{self.user.username} -> {self.blob.sha256[:12]} x{self.ref_count}"
@@ -0,0 +1,282 @@
+"""
+MEDIA_ROOT reconciliation.
+
+Walks the upload directories of every FileField in ``projects.models`` (plus
+the content-addressed ``blobs/`` store) in parallel, compares what is on disk
+with what the database references, and reports (or deletes) orphaned files
+older than a grace period. Blob reference counts are recounted, and the sizes
+seen during the walk are used to re-sync the per-user storage ledger without
+stat-ing anything a second time. The ledger is corrected by the difference
+between the walk and the row as it was when the walk started, so uploads and
+deletes recorded by the model hooks meanwhile are kept.
+"""
+import logging
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from django.apps import apps
+from django.conf import settings
+from django.core.files.storage import default_storage
+from django.db import models, transaction
+
+from accounts.models import UserStorageUsage
+from .storage import BLOB_DIR, is_blob_name
+from .usage import KIND_COLUMNS, MEDIA_FIELDS, apply_deltas, percent_of, quota_bytes_for, refresh_quota
+
+logger = logging.getLogger('security')
+
+
+def media_file_fields():
+    """All ``(model, field)`` pairs for FileFields declared in ``projects.models``."""
+    pairs = []
+    for model in apps.get_app_config('projects').get_models():
+        for field in model._meta.get_fields():
+            if isinstance(field, models.FileField):
+                pairs.append((model, field))
+    return pairs
+
+
+def _upload_dirs(pairs):
+    dirs = sorted({
+        field.upload_to.strip('/') for _, field in pairs
+        if isinstance(field.upload_to, str) and field.upload_to.strip('/')
+    })
+    # Drop directories nested in one we already walk
+    top = []
+    for d in dirs:
+        if not any(d.startswith(t + '/') for t in top):
+            top.append(d)
+    return top
+
+
+def _walk(root, rel_dir):
+    """Iteratively scandir one directory tree; return ``[(name, size, mtime)]``."""
+    found = []
+    stack = [rel_dir]
+    while stack:
+        current = stack.pop()
+        try:
+            with os.scandir(os.path.join(root, current)) as it:
+                for entry in it:
+                    rel = f'{current}/{entry.name}' if current else entry.name
+                    try:
+                        if entry.is_dir(follow_symlinks=False):
+                            stack.append(rel)
+                        elif entry.is_file(follow_symlinks=False):
+                            st = entry.stat(follow_symlinks=False)
+                            found.append((rel, st.st_size, st.st_mtime))
+                    except OSError:
+                        continue
+        except FileNotFoundError:
+            continue
+    return found
+
+
+def _walk_shallow(root, rel_dir):
+    """Files directly inside ``rel_dir`` (subdirectories are walked separately)."""
+    found = []
+    try:
+        with os.scandir(os.path.join(root, rel_dir)) as it:
+            for entry in it:
+                try:
+                    if entry.is_file(follow_symlinks=False):
+                        st = entry.stat(follow_symlinks=False)
+                        found.append((f'{rel_dir}/{entry.name}', st.st_size, st.st_mtime))
+                except OSError:
+                    continue
+    except FileNotFoundError:
+        pass
+    return found
+
+
+def scan_media(root=None, dirs=None, workers=None):
+    """Walk ``dirs`` under ``root`` concurrently; return ``{name: (size, mtime)}``."""
+    root = str(root or settings.MEDIA_ROOT)
+    if dirs is None:
+        dirs = _upload_dirs(media_file_fields())
+    # Fan out one level below each upload dir so large trees split across workers
+    units = []
+    for d in dirs:
+        try:
+            with os.scandir(os.path.join(root, d)) as it:
+                subdirs = [f'{d}/{e.name}' for e in it if e.is_dir(follow_symlinks=False)]
+        except FileNotFoundError:
+            continue
+        units.append((d, subdirs))
+    files = {}
+    workers = workers or min(32, (os.cpu_count() or 1) * 4)
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = []
+        for d, subdirs in units:
+            futures.append(pool.submit(_walk_shallow, root, d))
+            futures.extend(pool.submit(_walk, root, sub) for sub in subdirs)
+        for fut in futures:
+            for name, size, mtime in fut.result():
+                files[name] = (size, mtime)
+    return files
+
+
+def referenced_names(pairs=None):
+    """Every file name currently stored in a projects FileField."""
+    names = set()
+    for model, field in pairs or media_file_fields():
+        qs = model._default_manager.exclude(**{field.attname: ''}).exclude(**{f'{field.attname}__isnull': True})
+        names.update(n.replace('\\', '/') for n in qs.values_list(field.attname, flat=True).iterator())
+    return names
+
+
+def media_references():
+    """Yield ``(owner_id, kind, name)`` for every stored file reference."""
+    from .models import Project, ProjectImage, ProjectFile, PackageMockup
+    owner_paths = {
+        Project: 'owner_id',
+        ProjectImage: 'project__owner_id',
+        ProjectFile: 'project__owner_id',
+        PackageMockup: 'owner_id',
+    }
+    for model, fields in MEDIA_FIELDS.items():
+        names = list(fields)
+        for row in model._default_manager.values_list(owner_paths[model], *names).iterator():
+            for field_name, value in zip(names, row[1:]):
+                if value:
+                    yield row[0], fields[field_name], value.replace('\\', '/')
+
+
+def ledger_snapshot():
+    """``{user_id: {column: bytes}}`` of every ledger row, plus its ``quota_bytes``."""
+    columns = list(KIND_COLUMNS.values()) + ['quota_bytes']
+    return {
+        row[0]: dict(zip(columns, row[1:]))
+        for row in UserStorageUsage.objects.values_list('user_id', *columns).iterator()
+    }
+
+
+def resync_usage(sizes, baseline):
+    """
+    Correct every user's ledger row to the totals of DB references and
+    ``{name: size}``, both observed after ``baseline`` (``ledger_snapshot()``)
+    was taken. Each row moves by the difference from its baseline, not to
+    an absolute value, so changes the hooks applied since are not lost.
+    """
+    per_user = {}
+    seen = set()
+    for owner_id, kind, name in media_references():
+        if not owner_id or (owner_id, name) in seen:
+            # Shared content-addressed blobs count once per user
+            continue
+        seen.add((owner_id, name))
+        totals = per_user.setdefault(owner_id, {k: 0 for k in KIND_COLUMNS})
+        totals[kind] += sizes.get(name, 0)
+
+    from django.contrib.auth.models import User
+    synced = 0
+    for user_id in User.objects.values_list('pk', flat=True).iterator():
+        totals = per_user.get(user_id, {k: 0 for k in KIND_COLUMNS})
+        before = baseline.get(user_id)
+        if before is None:
+            # No row when the walk started: create it from the walk, unless the hooks just did
+            values = {KIND_COLUMNS[k]: v for k, v in totals.items()}
+            values['total_bytes'] = sum(totals.values())
+            values['quota_bytes'] = quota_bytes_for(user_id)
+            values['percent_used'] = percent_of(values['total_bytes'], values['quota_bytes'])
+            UserStorageUsage.objects.get_or_create(user_id=user_id, defaults=values)
+        else:
+            apply_deltas(user_id, {k: v - before[KIND_COLUMNS[k]] for k, v in totals.items()})
+            if before['quota_bytes'] != quota_bytes_for(user_id):
+                refresh_quota(user_id)
+        synced += 1
+    return synced
+
+
+def resync_blob_refs():
+    """Recount blob references from the database and rewrite ``MediaBlob``/``MediaBlobOwner``."""
+    from .models import MediaBlob, MediaBlobOwner
+    refs = {}
+    for owner_id, kind, name in media_references():
+        if is_blob_name(name):
+            holders = refs.setdefault(name, {})
+            entry = holders.setdefault(owner_id, [kind, 0])
+            entry[1] += 1
+    with transaction.atomic():
+        MediaBlobOwner.objects.all().delete()
+        MediaBlob.objects.update(ref_count=0)
+        blobs = dict(MediaBlob.objects.values_list('name', 'pk'))
+        owners = []
+        for name, holders in refs.items():
+            blob_id = blobs.get(name)
+            if blob_id is None:
+                continue
+            MediaBlob.objects.filter(pk=blob_id).update(ref_count=sum(c for _, c in holders.values()))
+            owners.extend(
+                MediaBlobOwner(blob_id=blob_id, user_id=uid, kind=kind, ref_count=count)
+                for uid, (kind, count) in holders.items() if uid
+            )
+        MediaBlobOwner.objects.bulk_create(owners, batch_size=1000)
+    return len(refs)
+
+
+def reconcile_media(dry_run=True, grace_hours=None, workers=None, resync=True):
+    """
+    Find files under the projects upload dirs that no FileField references.
+    Orphans younger than ``grace_hours`` (in-flight uploads, renders) are left
+    alone. Returns a report dict; deletes only when ``dry_run`` is False.
+    """
+    if grace_hours is None:
+        grace_hours = getattr(settings, 'MEDIA_GC_GRACE_HOURS', 24)
+    pairs = media_file_fields()
+    started = time.time()
+    baseline = ledger_snapshot() if resync else None
+    on_disk = scan_media(dirs=_upload_dirs(pairs) + [BLOB_DIR], workers=workers)
+    referenced = referenced_names(pairs)
+    cutoff = time.time() - float(grace_hours) * 3600
+
+    orphans, kept_recent = [], 0
+    for name, (size, mtime) in on_disk.items():
+        if name in referenced:
+            continue
+        if mtime > cutoff:
+            kept_recent += 1
+        else:
+            orphans.append((name, size))
+
+    deleted = 0
+    freed = 0
+    if not dry_run:
+        from .models import MediaBlob
+        for name, size in orphans:
+            try:
+                default_storage.delete(name)
+                deleted += 1
+                freed += size
+            except Exception as e:
+                logger.error(f"Media GC could not delete {name}: {e}")
+                continue
+            if is_blob_name(name):
+                MediaBlob.objects.filter(name=name).delete()
+
+    synced = 0
+    if resync:
+        resync_blob_refs()
+        # Files written since the snapshot are already charged by the hooks
+        sizes = {name: size for name, (size, mtime) in on_disk.items() if mtime < started}
+        synced = resync_usage(sizes, baseline)
+
+    report = {
+        'scanned': len(on_disk),
+        'referenced': len(referenced),
+        'orphans': len(orphans),
+        'orphan_bytes': sum(size for _, size in orphans),
+        'kept_recent': kept_recent,
+        'deleted': deleted,
+        'freed_bytes': freed,
+        'users_resynced': synced,
+        'dry_run': dry_run,
+        'seconds': round(time.time() - started, 2),
+        'orphan_names': [name for name, _ in orphans],
+    }
+    logger.info(
+        f"Media GC: scanned={report['scanned']} orphans={report['orphans']} "
+        f"deleted={deleted} freed={freed} dry_run={dry_run}"
+    )
+    return report
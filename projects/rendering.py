@@ -0,0 +1,328 @@
+"""
+Mockup rendering.
+
+Every change to a mockup's parameters bumps ``PackageMockup.render_version``;
+``rendered_version`` is the version ``generated_image`` was rendered from,
+so the editor knows its preview is current once ``rendered_version`` reaches
+the version its update returned. With ``MOCKUP_RENDER_ASYNC`` the render
+runs in ``projects.tasks.render_mockup_task`` instead of the request. At
+most one task is queued per mockup (``render_queued_at``); it renders
+whatever the latest version is when it starts, so updates arriving faster
+than renders finish collapse into one render of the newest parameters. A
+task that has not started within ``MOCKUP_RENDER_QUEUE_TIMEOUT_SECONDS`` is
+taken as lost, and the next update or status poll queues another. A render
+only replaces ``generated_image`` if nothing newer has been stored since.
+
+While parameters are being adjusted the editor asks for previews instead:
+``compose_mockup_preview`` renders unsaved parameters from downscaled
+proxies of each layer (``MOCKUP_PREVIEW_LONG_EDGE``, cached under
+``MOCKUP_PROXY_DIR`` and trimmed to ``MOCKUP_PROXY_CACHE_MB``, least
+recently used first) to a small WebP, and full-resolution output is only
+produced when the changes are applied.
+
+Both render in stages memoised by ``projects.layers``, so a change only
+recomputes the stages that depend on it: moving the design redoes just the
+final composite, and a new feather radius redoes the mask but not the
+decode or resize.
+"""
+import datetime
+import hashlib
+import logging
+import os
+from io import BytesIO
+
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.db import transaction
+from django.db.models import F, Q
+from django.utils import timezone
+
+from core.timing import timed
+from .compositing import composite, multiply_alpha
+from .layers import MB, get_layer_cache, trim_dir
+from .models import PackageMockup
+
+try:
+    from PIL import Image, ImageOps, ImageFilter, PngImagePlugin
+except Exception:
+    Image = None
+
+logger = logging.getLogger('security')
+
+
+def _design_layer(base_width, design_source, mask_source, mockup, pixel_scale=1.0, fast=False):
+    """
+    The design resized against a base ``base_width`` wide, masked and
+    rotated with the mockup's parameters. Each stage is memoised in the
+    layer cache under the inputs it depends on. ``pixel_scale`` scales
+    parameters given in pixels (the feather radius) when working on
+    downscaled proxies, and ``fast`` trades resampling quality for speed.
+    """
+    cache = get_layer_cache()
+    resize_filter = Image.BILINEAR if fast else Image.LANCZOS
+    rotate_filter = Image.BILINEAR if fast else Image.BICUBIC
+    design_key, load_design = design_source
+    scale = float(mockup.design_scale)
+
+    def resize():
+        design = load_design()
+        target_w = max(1, int(base_width * (scale / 100.0)))
+        ratio = target_w / float(design.width)
+        target_h = max(1, int(design.height * ratio))
+        return design.resize((target_w, target_h), resize_filter)
+
+    key = ('resize', design_key, base_width, scale, resize_filter)
+    design = cache.get(key, resize)
+    if mask_source is not None:
+        mask_key, load_mask = mask_source
+        invert = bool(getattr(mockup, 'mask_invert', False))
+        feather = max(0.0, float(getattr(mockup, 'mask_feather', 0.0))) * pixel_scale
+        opacity = max(0.0, min(100.0, float(getattr(mockup, 'mask_opacity', 100.0)))) / 100.0
+
+        def shape_mask():
+            mask = load_mask().resize(design.size, resize_filter)
+            if invert:
+                mask = ImageOps.invert(mask)
+            if feather > 0:
+                mask = mask.filter(ImageFilter.GaussianBlur(radius=feather))
+            return mask
+
+        mask_key = ('mask', mask_key, design.size, resize_filter, invert, feather)
+        mask = cache.get(mask_key, shape_mask)
+
+        def apply_mask():
+            # multiply_alpha() copies: the resized design is shared through the cache
+            return multiply_alpha(design, mask, opacity)
+
+        key = ('alpha', key, mask_key, opacity)
+        design = cache.get(key, apply_mask)
+    if mockup.design_rotation:
+        rotation = float(mockup.design_rotation)
+        unrotated = design
+        key = ('rotate', key, rotation, rotate_filter)
+        design = cache.get(key, lambda: unrotated.rotate(-rotation, resample=rotate_filter, expand=True))
+    return design
+
+
+def _compose(base, design, mockup):
+    """``design`` (from ``_design_layer``) placed on ``base``; RGB result."""
+    pos_x = int((mockup.design_pos_x / 100.0) * base.width - design.width / 2)
+    pos_y = int((mockup.design_pos_y / 100.0) * base.height - design.height / 2)
+    return composite(base, design, (pos_x, pos_y))
+
+
+def _open_layer(field_file, mode):
+    with Image.open(field_file) as im:
+        return im.convert(mode).copy()
+
+
+def _source(field_file, mode, long_edge=None):
+    """
+    ``(key, load)`` for a stored layer, where ``load()`` returns it decoded
+    (or as a proxy of ``long_edge``) through the layer cache.
+    """
+    cache = get_layer_cache()
+    if long_edge:
+        key = ('proxy', field_file.name, mode, long_edge)
+        return key, lambda: cache.get(key, lambda: proxy_layer(field_file, mode, long_edge))[0]
+    key = ('decode', field_file.name, mode)
+    # Full decodes are the expensive stage other processes can reuse
+    return key, lambda: cache.get(key, lambda: _open_layer(field_file, mode), shared=True)
+
+
+@timed('media')
+def compose_mockup_image(mockup):
+    """JPEG bytes of the full-resolution mockup, or None if it cannot be rendered."""
+    if Image is None or not mockup.container_image or not mockup.design_image:
+        return None
+    try:
+        base = _source(mockup.container_image, 'RGBA')[1]()
+        design = _design_layer(
+            base.width,
+            _source(mockup.design_image, 'RGBA'),
+            _source(mockup.mask_image, 'L') if mockup.mask_image else None,
+            mockup,
+        )
+        composed = _compose(base, design, mockup)
+        out_io = BytesIO()
+        composed.save(out_io, format='JPEG', quality=90)
+        return out_io.getvalue()
+    except Exception:
+        return None
+
+
+def _proxy_path(name, long_edge):
+    digest = hashlib.sha1(f'{name}:{long_edge}'.encode()).hexdigest()
+    return os.path.join(str(settings.MOCKUP_PROXY_DIR), digest[:2], f'{digest}.png')
+
+
+def proxy_layer(field_file, mode, long_edge):
+    """
+    ``(image, scale)``: the layer downscaled to at most ``long_edge`` pixels
+    on its long side, and the proxy's size relative to the original. Proxies
+    are cached on disk by file name, which never changes for stored media;
+    proxies of deleted media age out of the cache.
+    """
+    path = _proxy_path(field_file.name, long_edge)
+    try:
+        with Image.open(path) as im:
+            im.load()
+            cached = im.convert(mode), float(im.info.get('scale', 1.0))
+        os.utime(path)
+        return cached
+    except Exception:
+        pass
+    with Image.open(field_file) as im:
+        full_width = im.width
+        # thumbnail() lets the JPEG decoder skip detail it would throw away
+        im.thumbnail((long_edge, long_edge), Image.LANCZOS)
+        proxy = im.convert(mode)
+    scale = proxy.width / float(full_width)
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        info = PngImagePlugin.PngInfo()
+        info.add_text('scale', repr(scale))
+        tmp = f'{path}.{os.getpid()}.tmp'
+        proxy.save(tmp, format='PNG', pnginfo=info, compress_level=1)
+        os.replace(tmp, path)
+        trim_dir(str(settings.MOCKUP_PROXY_DIR), getattr(settings, 'MOCKUP_PROXY_CACHE_MB', 1024) * MB, '.png')
+    except Exception as e:
+        logger.warning(f"Could not cache mockup proxy for {field_file.name}: {e}")
+    return proxy, scale
+
+
+@timed('media')
+def compose_mockup_preview(mockup, long_edge=None, quality=None):
+    """
+    WebP bytes of a quick preview rendered from downscaled proxies, or None.
+    ``mockup`` may carry unsaved parameter changes.
+    """
+    if Image is None or not mockup.container_image or not mockup.design_image:
+        return None
+    long_edge = int(long_edge or getattr(settings, 'MOCKUP_PREVIEW_LONG_EDGE', 1024))
+    quality = int(quality or getattr(settings, 'MOCKUP_PREVIEW_QUALITY', 80))
+    try:
+        base_key = ('proxy', mockup.container_image.name, 'RGBA', long_edge)
+        base, scale = get_layer_cache().get(
+            base_key, lambda: proxy_layer(mockup.container_image, 'RGBA', long_edge)
+        )
+        design = _design_layer(
+            base.width,
+            _source(mockup.design_image, 'RGBA', long_edge),
+            _source(mockup.mask_image, 'L', long_edge) if mockup.mask_image else None,
+            mockup,
+            pixel_scale=scale,
+            fast=True,
+        )
+        composed = _compose(base, design, mockup)
+        out_io = BytesIO()
+        composed.save(out_io, format='WEBP', quality=quality, method=0)
+        return out_io.getvalue()
+    except Exception:
+        return None
+
+
+def render_mockup(mockup_id):
+    """
+    Render the mockup's current version unless it is already rendered.
+    Returns ``{'ok': bool, 'version': n, 'skipped': bool}``.
+    """
+    mockup = PackageMockup.objects.filter(pk=mockup_id).first()
+    if mockup is None:
+        return {'ok': False, 'version': 0, 'skipped': True}
+    target = mockup.render_version
+    if mockup.rendered_version >= target:
+        return {'ok': True, 'version': target, 'skipped': True}
+    data = compose_mockup_image(mockup)
+    stored = store_render(mockup, target, data)
+    return {'ok': data is not None, 'version': target, 'skipped': not stored}
+
+
+def store_render(mockup, target, data):
+    """
+    Save rendered JPEG ``data`` (None if the render failed) as the mockup's
+    image for version ``target``, unless a newer version is already stored.
+    Returns whether it was stored.
+    """
+    name = None
+    if data is not None:
+        field = mockup.generated_image.field
+        name = field.storage.save(
+            field.generate_filename(mockup, f"mockup_{mockup.id}_v{target}.jpg"), ContentFile(data)
+        )
+    with transaction.atomic():
+        current = PackageMockup.objects.select_for_update().filter(pk=mockup.pk).first()
+        if current is None or current.rendered_version >= target:
+            # A newer render landed first; the unreferenced file is left to reconcile_media
+            return False
+        update_fields = ['rendered_version']
+        current.rendered_version = target
+        if name is not None:
+            current.generated_image.name = name
+            update_fields.append('generated_image')
+        # A model save, so the storage ledger signals see the new file
+        current.save(update_fields=update_fields)
+    return True
+
+
+def bump_render_version(mockup):
+    """Mark the mockup's parameters as changed; returns the new version."""
+    PackageMockup.objects.filter(pk=mockup.pk).update(render_version=F('render_version') + 1)
+    version = PackageMockup.objects.values_list('render_version', flat=True).get(pk=mockup.pk)
+    mockup.render_version = version
+    return version
+
+
+def _render_async():
+    return bool(getattr(settings, 'MOCKUP_RENDER_ASYNC', False))
+
+
+def _enqueue_render(mockup):
+    """
+    Queue a render task unless one was queued recently. Returns False if
+    the queue is unavailable and the caller should render inline.
+    """
+    now = timezone.now()
+    timeout = datetime.timedelta(seconds=getattr(settings, 'MOCKUP_RENDER_QUEUE_TIMEOUT_SECONDS', 300))
+    # Only the request that claims the slot enqueues; later ones ride along
+    claimed = (PackageMockup.objects.filter(pk=mockup.pk)
+               .filter(Q(render_queued_at__isnull=True) | Q(render_queued_at__lt=now - timeout))
+               .update(render_queued_at=now))
+    if not claimed:
+        return True
+    from .tasks import render_mockup_task
+    try:
+        render_mockup_task.delay(mockup.pk)
+        return True
+    except Exception as e:
+        logger.warning(f"Mockup render queue unavailable, rendering inline: {e}")
+        PackageMockup.objects.filter(pk=mockup.pk).update(render_queued_at=None)
+        return False
+
+
+def request_render(mockup):
+    """
+    Bump the mockup's render version and schedule a render of it (inline
+    when rendering is synchronous or the queue is unavailable). Returns the
+    new version.
+    """
+    version = bump_render_version(mockup)
+    if not _render_async() or not _enqueue_render(mockup):
+        render_mockup(mockup.pk)
+    return version
+
+
+def render_status(mockup):
+    """
+    What the editor polls: versions and the current image URL. A render
+    whose task has sat in the queue past the timeout is queued again.
+    """
+    mockup.refresh_from_db(fields=['render_version', 'rendered_version', 'render_queued_at', 'generated_image'])
+    if mockup.rendered_version < mockup.render_version and mockup.render_queued_at and _render_async():
+        _enqueue_render(mockup)
+    return {
+        'render_version': mockup.render_version,
+        'rendered_version': mockup.rendered_version,
+        'ready': mockup.rendered_version >= mockup.render_version,
+        'generated_image': mockup.generated_image.url if mockup.generated_image else '',
+    }
@@ -0,0 +1,123 @@
+"""
+Model hooks that keep the per-user storage ledger (``projects.usage``) current.
+
+On load we remember which file each media field points at (names only, so
+loading rows never touches storage); on save we charge the size of any newly
+attached file and credit the one it replaced: the size charged for it if this
+instance attached it, else its size on disk. On delete we credit every file
+the row referenced. Content-addressed blobs (``projects.storage``) are
+reference-counted per user on the way, so a blob shared by several fields is
+charged once. New users get an empty ledger row and quota changes are
+copied onto it for the storage console.
+"""
+from django.contrib.auth.models import User
+from django.db.models.signals import post_init, post_save, pre_delete, post_delete
+
+from accounts.models import UserStorageSettings
+from .storage import acquire_blob, release_blob, is_blob_name
+from .usage import (
+    MEDIA_FIELDS, file_size, stored_size, owner_id_for, apply_deltas,
+    ensure_usage_row, refresh_quota,
+)
+
+
+def _snapshot(instance, sizes=None):
+    # {field: (file name, size charged or None if unknown)}
+    deferred = instance.get_deferred_fields()
+    sizes = sizes or {}
+    snapshot = {}
+    for name in MEDIA_FIELDS[type(instance)]:
+        if name in deferred:
+            continue
+        file_name = getattr(instance, name).name or ''
+        snapshot[name] = (file_name, sizes.get(name))
+    return snapshot
+
+
+def remember_media(sender, instance, **kwargs):
+    instance._media_snapshot = _snapshot(instance)
+
+
+def charge_media(sender, instance, created, **kwargs):
+    previous = {} if created else getattr(instance, '_media_snapshot', {})
+    owner_id = owner_id_for(instance)
+    deltas = {}
+    charged_sizes = {}
+
+    def add(kind, delta):
+        deltas[kind] = deltas.get(kind, 0) + delta
+
+    for name, kind in MEDIA_FIELDS[sender].items():
+        if not created and name not in previous:
+            # Field was deferred when loaded; we cannot tell what changed.
+            continue
+        field_file = getattr(instance, name)
+        old_name, old_size = previous.get(name, ('', None))
+        new_name = field_file.name or ''
+        if old_name == new_name:
+            charged_sizes[name] = old_size
+            continue
+        if new_name:
+            # Shared blobs are charged once per user, on first reference
+            charged = acquire_blob(new_name, owner_id, kind)
+            if charged is None:
+                charged_sizes[name] = file_size(field_file)
+                add(kind, charged_sizes[name])
+            else:
+                add(kind, charged)
+        if old_name:
+            released = release_blob(old_name, owner_id)
+            if released is None:
+                if old_size is None:
+                    old_size = stored_size(field_file.storage, old_name)
+                add(kind, -old_size)
+            else:
+                add(released[0] or kind, -released[1])
+    apply_deltas(owner_id, deltas)
+    instance._media_snapshot = _snapshot(instance, charged_sizes)
+
+
+def collect_media_release(sender, instance, **kwargs):
+    # Resolve the owner and sizes before the row (and possibly its parent
+    # project, on cascades) is gone.
+    held = []
+    for name, kind in MEDIA_FIELDS[sender].items():
+        if name in instance.get_deferred_fields():
+            continue
+        field_file = getattr(instance, name)
+        if field_file and field_file.name:
+            size = 0 if is_blob_name(field_file.name) else file_size(field_file)
+            held.append((kind, field_file.name, size))
+    instance._media_release = (owner_id_for(instance), held)
+
+
+def release_media(sender, instance, **kwargs):
+    owner_id, held = getattr(instance, '_media_release', (None, []))
+    deltas = {}
+    for kind, name, size in held:
+        released = release_blob(name, owner_id)
+        if released is not None:
+            kind, size = released[0] or kind, released[1]
+        deltas[kind] = deltas.get(kind, 0) - size
+    apply_deltas(owner_id, deltas)
+
+
+def open_ledger(sender, instance, created, **kwargs):
+    if created:
+        ensure_usage_row(instance.pk)
+
+
+def sync_quota(sender, instance, **kwargs):
+    refresh_quota(instance.user_id)
+
+
+def connect():
+    for model in MEDIA_FIELDS:
+        uid = f'storage_ledger_{model._meta.label_lower}'
+        post_init.connect(remember_media, sender=model, dispatch_uid=uid)
+        post_save.connect(charge_media, sender=model, dispatch_uid=uid)
+        pre_delete.connect(collect_media_release, sender=model, dispatch_uid=uid)
+        post_delete.connect(release_media, sender=model, dispatch_uid=uid)
+    post_save.connect(open_ledger, sender=User, dispatch_uid='storage_ledger_open')
+    post_save.connect(sync_quota, sender=UserStorageSettings, dispatch_uid='storage_ledger_quota')
+    post_delete.connect(sync_quota, sender=UserStorageSettings, dispatch_uid='storage_ledger_quota')
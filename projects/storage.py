@@ -0,0 +1,156 @@
+"""
+Content-addressed, deduplicated media storage.
+
+Every file saved through ``ContentAddressedStorage`` is named after the
+SHA-256 of its bytes (``blobs/ab/<sha256>.<ext>``). Saving content that is
+already stored writes nothing and returns the existing name, so the same cover
+or design uploaded to ten projects and mockups occupies disk once.
+
+Blobs are reference-counted per user (``MediaBlobOwner``) by the model hooks
+in ``projects.signals``; a user is charged quota once per distinct blob no
+matter how many fields point at it. Unreferenced blobs are removed by
+``manage.py reconcile_media`` after its grace period, never inline, so a blob
+that an in-flight upload just matched cannot disappear under it.
+"""
+import hashlib
+import os
+
+from django.conf import settings
+from django.core.files.storage import FileSystemStorage, default_storage
+from django.db import transaction
+from django.db.models import F
+from django.utils.deconstruct import deconstructible
+
+BLOB_DIR = 'blobs'
+
+
+def blob_name(digest, ext):
+    return f'{BLOB_DIR}/{digest[:2]}/{digest}{ext}'
+
+
+def is_blob_name(name):
+    return bool(name) and name.replace('\\', '/').startswith(BLOB_DIR + '/')
+
+
+def content_digest(content):
+    """SHA-256 of a File-like object, streamed in chunks; rewinds afterwards."""
+    digest = getattr(content, 'sha256', None)
+    if digest:
+        return digest
+    h = hashlib.sha256()
+    if hasattr(content, 'seek'):
+        content.seek(0)
+    for chunk in content.chunks():
+        h.update(chunk)
+    if hasattr(content, 'seek'):
+        content.seek(0)
+    return h.hexdigest()
+
+
+@deconstructible
+class ContentAddressedStorage(FileSystemStorage):
+    """FileSystemStorage that stores each distinct content once, under its digest."""
+
+    def _save(self, name, content):
+        from .models import MediaBlob
+        digest = content_digest(content)
+        ext = os.path.splitext(name)[1].lower()
+        target = blob_name(digest, ext)
+        if not self.exists(target):
+            saved = super()._save(target, content)
+            if saved != target:
+                # Lost a race with an identical upload; keep the canonical copy.
+                self.delete(saved)
+        MediaBlob.objects.get_or_create(
+            sha256=digest,
+            defaults={
+                'name': target,
+                'size': self.size(target),
+                'source_sha256': getattr(content, 'source_sha256', '') or '',
+            },
+        )
+        return target
+
+    def get_available_name(self, name, max_length=None):
+        # The final name is derived from the content in _save(), so the
+        # caller's proposed name never needs a suffix. Only a blob created
+        # concurrently by an identical upload gets one (and is then dropped).
+        if is_blob_name(name) and self.exists(name):
+            return super().get_available_name(name, max_length)
+        return name
+
+
+def get_media_storage():
+    """Storage used by projects media fields (see MEDIA_DEDUP_ENABLED)."""
+    if getattr(settings, 'MEDIA_DEDUP_ENABLED', True):
+        return _cas_storage
+    return default_storage
+
+
+_cas_storage = ContentAddressedStorage()
+
+
+def get_blob_storage():
+    """The content-addressed storage, used for layers shared by batches even when dedup is off."""
+    return _cas_storage
+
+
+def find_processed_blob(source_digest):
+    """A blob previously produced from an upload with this digest, if still on disk."""
+    from .models import MediaBlob
+    if not source_digest:
+        return None
+    blob = MediaBlob.objects.filter(source_sha256=source_digest).first()
+    if blob is not None and _cas_storage.exists(blob.name):
+        return blob
+    return None
+
+
+def acquire_blob(name, user_id, kind):
+    """
+    Record one more reference from ``user_id`` to the blob at ``name``.
+    Returns the bytes to charge the user (the blob size on their first
+    reference, else 0), or None if ``name`` is not a blob.
+    """
+    from .models import MediaBlob, MediaBlobOwner
+    if not is_blob_name(name):
+        return None
+    with transaction.atomic():
+        blob = MediaBlob.objects.select_for_update().filter(name=name).first()
+        if blob is None:
+            return None
+        MediaBlob.objects.filter(pk=blob.pk).update(ref_count=F('ref_count') + 1)
+        if not user_id:
+            return 0
+        holder, _ = MediaBlobOwner.objects.get_or_create(
+            blob=blob, user_id=user_id, defaults={'kind': kind, 'ref_count': 0},
+        )
+        holder.ref_count += 1
+        if holder.ref_count == 1:
+            holder.kind = kind
+        holder.save(update_fields=['ref_count', 'kind'])
+        return blob.size if holder.ref_count == 1 else 0
+
+
+def release_blob(name, user_id):
+    """
+    Drop one reference from ``user_id`` to the blob at ``name``. Returns
+    ``(kind, bytes_to_credit)``, or None if ``name`` is not a blob.
+    """
+    from .models import MediaBlob, MediaBlobOwner
+    if not is_blob_name(name):
+        return None
+    with transaction.atomic():
+        blob = MediaBlob.objects.select_for_update().filter(name=name).first()
+        if blob is None:
+            return None
+        MediaBlob.objects.filter(pk=blob.pk, ref_count__gt=0).update(ref_count=F('ref_count') - 1)
+        holder = MediaBlobOwner.objects.select_for_update().filter(blob=blob, user_id=user_id).first()
+        if holder is None:
+            return (None, 0)
+        holder.ref_count -= 1
+        if holder.ref_count <= 0:
+            holder.delete()
+            return (holder.kind, blob.size)
+        holder.save(update_fields=['ref_count'])
+        return (holder.kind, 0)
@@ -62,3 +62,52 @@ def transcode_audio_ffmpeg(input_path: str, output_path: str) -> dict:
     except Exception as e:
         logger.error(f"ffmpeg error: {e}")
         return { 'ok': False, 'error': str(e) }
+
+
+@shared_task
+def reconcile_media_task(dry_run: bool = True, grace_hours: float = None) -> dict:
+    """
+    Periodic MEDIA_ROOT reconciliation: report or delete orphaned media and
+    re-sync per-user storage totals. See ``projects.reconcile``.
+    """
+    from .reconcile import reconcile_media
+    try:
+        report = reconcile_media(dry_run=dry_run, grace_hours=grace_hours)
+        report.pop('orphan_names', None)
+        return { 'ok': True, **report }
+    except Exception as e:
+        logger.error(f"Media reconciliation failed: {e}")
+        return { 'ok': False, 'error': str(e) }
+
+
+@shared_task
+def render_mockup_task(mockup_id: int) -> dict:
+    """
+    Render the latest parameters of a mockup. Queued by
+    ``projects.rendering.request_render``, at most once per mockup at a time.
+    """
+    from .models import PackageMockup
+    from .rendering import render_mockup
+    # Updates from here on queue a fresh task, which renders whatever is newer
+    PackageMockup.objects.filter(pk=mockup_id).update(render_queued_at=None)
+    try:
+        return render_mockup(mockup_id)
+    except Exception as e:
+        logger.error(f"Mockup render failed for {mockup_id}: {e}")
+        return { 'ok': False, 'error': str(e) }
+
+
+@shared_task
+def render_mockup_batch_task(mockup_ids: list) -> dict:
+    """
+    Render a batch of mockups queued by ``projects.batch.start_batch``.
+    Runs serially inside a prefork worker, which cannot start a process pool.
+    """
+    from .batch import render_batch
+    from .models import PackageMockup
+    try:
+        report = render_batch(PackageMockup.objects.filter(pk__in=mockup_ids).order_by('pk'))
+        return { 'ok': True, **report }
+    except Exception as e:
+        logger.error(f"Mockup batch render failed: {e}")
+        return { 'ok': False, 'error': str(e) }
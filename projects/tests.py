@@ -1,3 +1,232 @@
-from django.test import TestCase
+import datetime
+import io
+import os
+import shutil
+import tempfile
+from unittest import mock, skipUnless
 
-# Create your tests here.
+from accounts.models import UserStorageUsage
+from django.contrib.auth.models import User
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.test import TestCase, override_settings
+from django.urls import reverse
+from django.utils import timezone
+from PIL import Image
+
+try:
+    import numpy as np
+except Exception:  # pragma: no cover - optional
+    np = None
+
+from . import batch, compositing, rendering, signals, tasks
+from .models import PackageMockup, Project
+from .reconcile import ledger_snapshot, resync_usage
+from .usage import apply_deltas
+
+
+class MediaTestCase(TestCase):
+    def setUp(self):
+        media = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, media, ignore_errors=True)
+        media_root = override_settings(MEDIA_ROOT=media)
+        media_root.enable()
+        self.addCleanup(media_root.disable)
+        self.owner = User.objects.create_user('uploader', password='x')
+
+    def usage(self):
+        return UserStorageUsage.objects.get(user=self.owner)
+
+
+class LedgerSignalTests(MediaTestCase):
+    def test_upload_is_charged_and_delete_credited(self):
+        mockup = PackageMockup.objects.create(owner=self.owner, title='Box')
+        mockup.container_image.save('box.png', ContentFile(b'x' * 700))
+        mockup.design_image.save('logo.png', ContentFile(b'y' * 200))
+        usage = self.usage()
+        self.assertEqual((usage.mockup_bytes, usage.total_bytes), (900, 900))
+        mockup.delete()
+        self.assertEqual(self.usage().total_bytes, 0)
+
+    def test_shared_blob_is_charged_once(self):
+        first = PackageMockup.objects.create(owner=self.owner, title='A')
+        first.container_image.save('a.png', ContentFile(b'z' * 500))
+        second = PackageMockup.objects.create(owner=self.owner, title='B')
+        second.container_image.save('b.png', ContentFile(b'z' * 500))
+        self.assertEqual(first.container_image.name, second.container_image.name)
+        self.assertEqual(self.usage().mockup_bytes, 500)
+        first.delete()
+        self.assertEqual(self.usage().mockup_bytes, 500)
+        second.delete()
+        self.assertEqual(self.usage().mockup_bytes, 0)
+
+    def _legacy_project(self):
+        name = default_storage.save('project_covers/legacy.png', ContentFile(b'x' * 1000))
+        project = Project.objects.create(owner=self.owner, title='P', description='', project_type='image')
+        project.cover_image.name = name
+        project.save()
+        self.assertEqual(self.usage().image_bytes, 1000)
+        return project
+
+    def test_loading_rows_does_not_touch_storage(self):
+        project = self._legacy_project()
+        with mock.patch.object(signals, 'stored_size') as stat:
+            list(Project.objects.all())
+            project = Project.objects.get(pk=project.pk)
+            project.title = 'Renamed'
+            project.save()
+        stat.assert_not_called()
+        project.cover_image.save('new.png', ContentFile(b'y' * 400))
+        self.assertEqual(self.usage().image_bytes, 400)
+
+    def test_replacing_a_missing_file_credits_the_size_charged(self):
+        project = self._legacy_project()
+        # The old file disappears before the replacement is saved
+        default_storage.delete(project.cover_image.name)
+        project.cover_image.save('new.png', ContentFile(b'y' * 400))
+        self.assertEqual(self.usage().image_bytes, 400)
+
+
+class BatchLedgerTests(MediaTestCase):
+    def _png(self, name, size):
+        out = io.BytesIO()
+        Image.frombytes('RGB', size, os.urandom(size[0] * size[1] * 3)).save(out, format='PNG')
+        upload = ContentFile(out.getvalue())
+        upload.name = name
+        return upload
+
+    def test_shared_design_is_charged_once_without_dedup(self):
+        # MEDIA_DEDUP_ENABLED = False: the fields store through the plain storage
+        fields = [PackageMockup._meta.get_field(name) for name in ('container_image', 'design_image')]
+        with mock.patch.object(fields[0], 'storage', default_storage), \
+                mock.patch.object(fields[1], 'storage', default_storage):
+            mockups = batch.create_batch(self.owner, self._png('logo.png', (40, 40)),
+                                         [self._png(f'box{i}.png', (60, 60)) for i in range(3)])
+            self.assertEqual(len({m.design_image.name for m in mockups}), 1)
+            design = default_storage.size(mockups[0].design_image.name)
+            containers = sum(default_storage.size(m.container_image.name) for m in mockups)
+            self.assertEqual(self.usage().mockup_bytes, containers + design)
+            batch.apply_design(mockups, self._png('logo2.png', (30, 30)))
+            design = default_storage.size(mockups[0].design_image.name)
+            self.assertEqual(self.usage().mockup_bytes, containers + design)
+
+
+class ProxyCacheTests(MediaTestCase):
+    def _stored_image(self, name):
+        out = io.BytesIO()
+        # Noise, so proxies stay near their raw size once compressed
+        Image.frombytes('RGB', (400, 300), os.urandom(400 * 300 * 3)).save(out, format='PNG')
+        return default_storage.open(default_storage.save(name, ContentFile(out.getvalue())))
+
+    def _cached(self, proxies):
+        return [os.path.join(root, name) for root, _, files in os.walk(proxies) for name in files]
+
+    def test_proxy_cache_is_trimmed_to_its_budget(self):
+        proxies = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, proxies, ignore_errors=True)
+        # Room for about one 128px RGB proxy
+        with override_settings(MOCKUP_PROXY_DIR=proxies, MOCKUP_PROXY_CACHE_MB=60000 / (1024 * 1024)):
+            for i in range(4):
+                image, scale = rendering.proxy_layer(self._stored_image(f'p{i}.png'), 'RGB', 128)
+                self.assertEqual((image.size, scale), ((128, 96), 0.32))
+            cached = self._cached(proxies)
+        self.assertLessEqual(sum(os.path.getsize(path) for path in cached), 60000)
+        self.assertLess(len(cached), 4)
+
+
+class CompositingTests(TestCase):
+    def _image(self, rng, size, opaque=False):
+        pixels = rng.integers(0, 256, size=(size[1], size[0], 4), dtype=np.uint8)
+        if opaque:
+            pixels[..., 3] = 255
+        return Image.fromarray(pixels, 'RGBA')
+
+    def _reference(self, base, design, pos):
+        # The full-canvas Pillow composite the ROI engines replaced
+        layer = Image.new('RGBA', base.size, (0, 0, 0, 0))
+        layer.paste(design, pos)
+        return Image.alpha_composite(base, layer).convert('RGB')
+
+    def _max_diff(self, a, b):
+        return int(np.abs(np.asarray(a, dtype=np.int16) - np.asarray(b, dtype=np.int16)).max())
+
+    @skipUnless(np is not None, 'NumPy is not installed')
+    def test_engines_match_full_canvas_within_one_level(self):
+        rng = np.random.default_rng(24)
+        for opaque in (True, False):
+            base = self._image(rng, (300, 200), opaque=opaque)
+            design = self._image(rng, (120, 90))
+            for pos in ((40, 30), (-50, 150), (250, -20)):
+                reference = self._reference(base, design, pos)
+                with mock.patch.object(compositing, 'BAND_ROWS', 64):
+                    fast = compositing.composite(base, design, pos)
+                with mock.patch.object(compositing, 'np', None):
+                    plain = compositing.composite(base, design, pos)
+                self.assertLessEqual(self._max_diff(fast, reference), 1)
+                self.assertLessEqual(self._max_diff(plain, reference), 1)
+
+    @skipUnless(np is not None, 'NumPy is not installed')
+    def test_multiply_alpha_matches_pillow(self):
+        rng = np.random.default_rng(11)
+        design = self._image(rng, (64, 48))
+        mask = Image.fromarray(rng.integers(0, 256, size=(48, 64), dtype=np.uint8), 'L')
+        fast = compositing.multiply_alpha(design, mask, 0.7)
+        with mock.patch.object(compositing, 'np', None):
+            plain = compositing.multiply_alpha(design, mask, 0.7)
+        self.assertEqual(fast.tobytes(), plain.tobytes())
+
+
+@override_settings(MOCKUP_RENDER_ASYNC=True, MOCKUP_RENDER_QUEUE_TIMEOUT_SECONDS=60)
+class RenderQueueTests(TestCase):
+    def setUp(self):
+        owner = User.objects.create_user('renderer', password='x')
+        self.mockup = PackageMockup.objects.create(owner=owner, title='Box')
+
+    def test_updates_share_one_queued_task(self):
+        with mock.patch.object(tasks.render_mockup_task, 'delay') as delay:
+            rendering.request_render(self.mockup)
+            rendering.request_render(self.mockup)
+            rendering.render_status(self.mockup)
+        self.assertEqual(delay.call_count, 1)
+
+    def test_lost_task_is_queued_again(self):
+        with mock.patch.object(tasks.render_mockup_task, 'delay') as delay:
+            rendering.request_render(self.mockup)
+            PackageMockup.objects.filter(pk=self.mockup.pk).update(
+                render_queued_at=timezone.now() - datetime.timedelta(minutes=5)
+            )
+            self.assertFalse(rendering.render_status(self.mockup)['ready'])
+        self.assertEqual(delay.call_count, 2)
+        delay.assert_called_with(self.mockup.pk)
+
+
+@override_settings(MOCKUP_RENDER_ASYNC=False, MOCKUP_BATCH_INLINE_MAX=2)
+class BatchViewTests(TestCase):
+    def setUp(self):
+        self.owner = User.objects.create_user('batcher', password='x')
+        self.client.force_login(self.owner)
+        self.ids = [PackageMockup.objects.create(owner=self.owner, title=f'M{i}').pk for i in range(3)]
+
+    def test_large_batch_without_queue_is_refused(self):
+        response = self.client.post(reverse('projects:mockup_batch'), {'mockup_ids': ','.join(map(str, self.ids))})
+        self.assertEqual(response.status_code, 503)
+
+    def test_small_batch_without_queue_renders_serially(self):
+        with mock.patch.object(batch, 'ProcessPoolExecutor') as pool:
+            response = self.client.post(reverse('projects:mockup_batch'), {'mockup_ids': f'{self.ids[0]},{self.ids[1]}'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['report']['total'], 2)
+        pool.assert_not_called()
+
+
+class ResyncUsageTests(MediaTestCase):
+    def test_correction_keeps_changes_made_during_the_walk(self):
+        mockup = PackageMockup.objects.create(owner=self.owner, title='Box')
+        mockup.container_image.save('box.png', ContentFile(b'x' * 1000))
+        # Drift the ledger, then record an upload that lands while reconcile walks
+        UserStorageUsage.objects.filter(user=self.owner).update(mockup_bytes=50, total_bytes=50)
+        baseline = ledger_snapshot()
+        apply_deltas(self.owner.pk, {'image': 300})
+        resync_usage({mockup.container_image.name: 1000}, baseline)
+        usage = self.usage()
+        self.assertEqual((usage.mockup_bytes, usage.image_bytes, usage.total_bytes), (1000, 300, 1300))
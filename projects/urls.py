@@ -17,7 +17,11 @@ urlpatterns = [
     # Mockups
     path('mockups/', views.mockup_list, name='mockup_list'),
     path('mockups/create/', views.mockup_create, name='mockup_create'),
+    path('mockups/batch/', views.mockup_batch, name='mockup_batch'),
+    path('mockups/batch/status/', views.mockup_batch_status, name='mockup_batch_status'),
     path('mockups/<int:pk>/', views.mockup_detail, name='mockup_detail'),
     path('mockups/<int:pk>/update/', views.mockup_update, name='mockup_update'),
+    path('mockups/<int:pk>/preview/', views.mockup_preview, name='mockup_preview'),
+    path('mockups/<int:pk>/render-status/', views.mockup_render_status, name='mockup_render_status'),
     path('mockups/<int:pk>/delete/', views.mockup_delete, name='mockup_delete'),
 ]
\ No newline at end of file
@@ -0,0 +1,266 @@
+"""
+Per-user storage ledger.
+
+Each user has one ``UserStorageUsage`` row holding byte totals per media kind.
+The row is adjusted incrementally by the model hooks in ``projects.signals``;
+a full walk of the user's media only happens when the row does not exist yet
+(or when explicitly re-synced via ``manage.py sync_storage_usage``).
+
+Uploads reserve their incoming bytes with ``reserve_quota`` before writing, so
+concurrent uploads from one user cannot all pass the quota check and overshoot.
+"""
+import logging
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import F, Case, When, Value, IntegerField, Sum
+from django.utils import timezone
+
+from accounts.models import StorageReservation, UserStorageSettings, UserStorageUsage
+from .models import Project, ProjectImage, ProjectFile, PackageMockup
+
+logger = logging.getLogger('security')
+
+# Ledger column for each media kind
+KIND_COLUMNS = {
+    'image': 'image_bytes',
+    'video': 'video_bytes',
+    'audio': 'audio_bytes',
+    'file': 'file_bytes',
+    'mockup': 'mockup_bytes',
+}
+
+# Media kind of every tracked file field, per model
+MEDIA_FIELDS = {
+    Project: {'cover_image': 'image', 'video_file': 'video', 'audio_file': 'audio'},
+    ProjectImage: {'image': 'image'},
+    ProjectFile: {'file': 'file'},
+    PackageMockup: {
+        'container_image': 'mockup',
+        'design_image': 'mockup',
+        'generated_image': 'mockup',
+        'mask_image': 'mockup',
+    },
+}
+
+
+def file_size(field_file):
+    """Size in bytes of a FieldFile, or 0 if it is empty or missing on disk."""
+    try:
+        if not field_file or not getattr(field_file, 'name', None):
+            return 0
+        if not getattr(field_file, '_committed', True):
+            return int(field_file.size or 0)
+        storage = field_file.storage
+        if storage.exists(field_file.name):
+            return int(storage.size(field_file.name) or 0)
+    except Exception:
+        pass
+    return 0
+
+
+def stored_size(storage, name):
+    """Size in bytes of ``name`` in ``storage``, or 0 if it is missing."""
+    if not name:
+        return 0
+    try:
+        if storage.exists(name):
+            return int(storage.size(name) or 0)
+    except Exception:
+        pass
+    return 0
+
+
+def owner_id_for(instance):
+    """Id of the user whose quota the instance's files count against."""
+    if isinstance(instance, (Project, PackageMockup)):
+        return instance.owner_id
+    if isinstance(instance, (ProjectImage, ProjectFile)):
+        cached = instance._state.fields_cache.get('project')
+        if cached is not None:
+            return cached.owner_id
+        return Project.objects.filter(pk=instance.project_id).values_list('owner_id', flat=True).first()
+    return None
+
+
+def scan_usage(user):
+    """Walk all of a user's media and return ``{kind: bytes}``. Slow; stats every file."""
+    totals = {kind: 0 for kind in KIND_COLUMNS}
+    querysets = [
+        (Project, Project.objects.filter(owner=user)),
+        (ProjectImage, ProjectImage.objects.filter(project__owner=user)),
+        (ProjectFile, ProjectFile.objects.filter(project__owner=user)),
+        (PackageMockup, PackageMockup.objects.filter(owner=user)),
+    ]
+    seen = set()
+    for model, qs in querysets:
+        fields = MEDIA_FIELDS[model]
+        for obj in qs.only('pk', *fields):
+            for field_name, kind in fields.items():
+                field_file = getattr(obj, field_name)
+                if not field_file or field_file.name in seen:
+                    # Shared content-addressed blobs count once per user
+                    continue
+                seen.add(field_file.name)
+                totals[kind] += file_size(field_file)
+    return totals
+
+
+def quota_bytes_for(user_id):
+    """Effective quota in bytes: the user's override, else ``USER_STORAGE_QUOTA_MB``."""
+    quota_mb = UserStorageSettings.objects.filter(user_id=user_id).values_list('quota_mb', flat=True).first()
+    if not quota_mb:
+        quota_mb = getattr(settings, 'USER_STORAGE_QUOTA_MB', 0) or 0
+    return max(0, int(quota_mb)) * 1024 * 1024
+
+
+def percent_of(used_bytes, quota_bytes):
+    if quota_bytes <= 0:
+        return 0
+    return int(max(0, used_bytes) * 100 // quota_bytes)
+
+
+def percent_expression(total_expr):
+    """Database expression for ``total_expr`` as a whole percent of the row's ``quota_bytes``."""
+    return Case(
+        When(quota_bytes__gt=0, then=total_expr * 100 / F('quota_bytes')),
+        default=Value(0),
+        output_field=IntegerField(),
+    )
+
+
+def rebuild_usage(user):
+    """Recompute a user's ledger row from their media and store it."""
+    totals = scan_usage(user)
+    values = {KIND_COLUMNS[kind]: size for kind, size in totals.items()}
+    values['total_bytes'] = sum(totals.values())
+    values['quota_bytes'] = quota_bytes_for(user.pk)
+    values['percent_used'] = percent_of(values['total_bytes'], values['quota_bytes'])
+    usage, _ = UserStorageUsage.objects.update_or_create(user=user, defaults=values)
+    return usage
+
+
+def refresh_quota(user_id):
+    """Re-read a user's effective quota into their ledger row."""
+    quota = quota_bytes_for(user_id)
+    UserStorageUsage.objects.filter(user_id=user_id).update(
+        quota_bytes=quota,
+        percent_used=(F('total_bytes') * 100 / quota) if quota else Value(0),
+    )
+
+
+def refresh_default_quotas():
+    """Apply the current ``USER_STORAGE_QUOTA_MB`` to users without an override."""
+    default_bytes = max(0, int(getattr(settings, 'USER_STORAGE_QUOTA_MB', 0) or 0)) * 1024 * 1024
+    overridden = UserStorageSettings.objects.filter(quota_mb__gt=0).values('user_id')
+    return (
+        UserStorageUsage.objects.exclude(user_id__in=overridden)
+        .exclude(quota_bytes=default_bytes)
+        .update(
+            quota_bytes=default_bytes,
+            percent_used=(F('total_bytes') * 100 / default_bytes) if default_bytes else Value(0),
+        )
+    )
+
+
+def ensure_usage_row(user_id):
+    """Create an empty ledger row for a brand-new user."""
+    UserStorageUsage.objects.get_or_create(
+        user_id=user_id, defaults={'quota_bytes': quota_bytes_for(user_id)},
+    )
+
+
+def get_usage_bytes(user):
+    """Total bytes stored by ``user``. O(1) once the ledger row exists."""
+    total = UserStorageUsage.objects.filter(user=user).values_list('total_bytes', flat=True).first()
+    if total is None:
+        total = rebuild_usage(user).total_bytes
+    return max(0, int(total))
+
+
+def apply_deltas(user_id, deltas):
+    """Add ``{kind: bytes}`` (may be negative) to a user's ledger row."""
+    deltas = {kind: int(d) for kind, d in deltas.items() if d}
+    if not user_id or not deltas:
+        return
+    values = {KIND_COLUMNS[kind]: F(KIND_COLUMNS[kind]) + d for kind, d in deltas.items()}
+    values['total_bytes'] = F('total_bytes') + sum(deltas.values())
+    values['percent_used'] = percent_expression(F('total_bytes') + sum(deltas.values()))
+    values['updated_at'] = timezone.now()
+    try:
+        updated = UserStorageUsage.objects.filter(user_id=user_id).update(**values)
+        if not updated:
+            # No ledger yet: build it from the current state, which already
+            # includes (or excludes) the change being recorded.
+            from django.contrib.auth.models import User
+            user = User.objects.filter(pk=user_id).first()
+            if user is not None:
+                rebuild_usage(user)
+    except Exception as e:
+        logger.error(f"Storage ledger update failed for user {user_id}: {e}")
+
+
+class QuotaReservation:
+    """
+    Bytes held against a quota while an upload is processed. Use as a context
+    manager; the hold is dropped on exit, by which point a successful upload
+    has been charged to the ledger by the model hooks.
+    """
+
+    def __init__(self, pk=None, user_id=None, nbytes=0):
+        self.pk = pk
+        self.user_id = user_id
+        self.bytes = nbytes
+
+    def release(self):
+        if self.pk is not None:
+            StorageReservation.objects.filter(pk=self.pk).delete()
+            self.pk = None
+
+    # Once the upload is saved its bytes live in the ledger; dropping the
+    # hold is all that is left to do.
+    commit = release
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.release()
+        return False
+
+
+def reserve_quota(user, nbytes, ttl=None):
+    """
+    Hold ``nbytes`` of ``user``'s quota. Returns a ``QuotaReservation``, or
+    ``None`` if the ledger total plus other live holds would exceed the quota.
+    Holds expire after ``ttl`` seconds (``STORAGE_RESERVATION_TTL_SECONDS``)
+    so a crashed request cannot pin quota forever.
+    """
+    nbytes = max(0, int(nbytes or 0))
+    if nbytes == 0:
+        return QuotaReservation(user_id=user.pk)
+    quota = quota_bytes_for(user.pk)
+    if quota <= 0:
+        return QuotaReservation(user_id=user.pk)
+    if ttl is None:
+        ttl = getattr(settings, 'STORAGE_RESERVATION_TTL_SECONDS', 900)
+    now = timezone.now()
+    if not UserStorageUsage.objects.filter(user=user).exists():
+        rebuild_usage(user)
+    with transaction.atomic():
+        # Lock the ledger row: concurrent reservations for the same user queue
+        # here for the duration of this check, not for the whole upload.
+        used = (
+            UserStorageUsage.objects.select_for_update()
+            .filter(user=user).values_list('total_bytes', flat=True).first()
+        ) or 0
+        holds = StorageReservation.objects.filter(user=user)
+        holds.filter(expires_at__lte=now).delete()
+        held = holds.aggregate(total=Sum('bytes'))['total'] or 0
+        if used + held + nbytes > quota:
+            return None
+        hold = StorageReservation.objects.create(
+            user=user, bytes=nbytes, expires_at=now + timezone.timedelta(seconds=ttl),
+        )
+    return QuotaReservation(pk=hold.pk, user_id=user.pk, nbytes=nbytes)
+
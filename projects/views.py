@@ -1,76 +1,6 @@
 def _get_user_storage_usage_bytes(user):
-    total = 0
-    try:
-        from django.core.files.storage import default_storage
-        # Projects
-        for p in Project.objects.filter(owner=user):
-            for f in [p.cover_image, p.video_file, p.audio_file]:
-                try:
-                    if f and getattr(f, 'name', None):
-                        size = getattr(f, 'size', None)
-                        if size is None and default_storage.exists(f.name):
-                            size = default_storage.size(f.name)
-                        if size:
-                            total += int(size)
-                except Exception:
-                    continue
-        # Project images
-        for pi in ProjectImage.objects.filter(project__owner=user):
-            try:
-                f = pi.image
-                if f and getattr(f, 'name', None):
-                    size = getattr(f, 'size', None)
-                    if size is None and default_storage.exists(f.name):
-                        size = default_storage.size(f.name)
-                    if size:
-                        total += int(size)
-            except Exception:
-                continue
-        # Project files
-        for pf in ProjectFile.objects.filter(project__owner=user):
-            try:
-                f = pf.file
-                if f and getattr(f, 'name', None):
-                    size = getattr(f, 'size', None)
-                    if size is None and default_storage.exists(f.name):
-                        size = default_storage.size(f.name)
-                    if size:
-                        total += int(size)
-            except Exception:
-                continue
-        # Mockups
-        for m in PackageMockup.objects.filter(owner=user):
-            for f in [m.container_image, m.design_image, m.generated_image, m.mask_image]:
-                try:
-                    if f and getattr(f, 'name', None):
-                        size = getattr(f, 'size', None)
-                        if size is None and default_storage.exists(f.name):
-                            size = default_storage.size(f.name)
-                        if size:
-                            total += int(size)
-                except Exception:
-                    continue
-    except Exception:
-        return total
-    return total
-
-def _would_exceed_quota(user, additional_bytes):
-    try:
-        # Prefer per-user quota if configured
-        user_quota = None
-        try:
-            uss = UserStorageSettings.objects.filter(user=user).only('quota_mb').first()
-            if uss and uss.quota_mb:
-                user_quota = int(uss.quota_mb)
-        except Exception:
-            user_quota = None
-        quota_mb = int(user_quota if user_quota is not None else (getattr(settings, 'USER_STORAGE_QUOTA_MB', 0) or 0))
-    except Exception:
-        quota_mb = 0
-    if quota_mb <= 0:
-        return False
-    used = _get_user_storage_usage_bytes(user)
-    return (used + max(0, int(additional_bytes))) > (quota_mb * 1024 * 1024)
+    # Read from the incremental ledger instead of walking every file
+    return get_usage_bytes(user)
 
 def _incoming_files_size(request_files, keys):
     total = 0
@@ -83,36 +13,62 @@ def _incoming_files_size(request_files, keys):
                 pass
     return total
 
+def _save_clean_image(field_file, uploaded_file):
+    """Store a metadata-stripped copy of an uploaded image in ``field_file``.
+
+    An upload whose exact bytes were cleaned before is pointed at the
+    existing content-addressed blob instead of being decoded and re-encoded.
+    """
+    source_digest = content_digest(uploaded_file)
+    if isinstance(field_file.storage, ContentAddressedStorage):
+        blob = find_processed_blob(source_digest)
+        if blob is not None:
+            setattr(field_file.instance, field_file.field.attname, blob.name)
+            return True
+    processed = _process_image_strip_metadata(uploaded_file)
+    if not processed:
+        return False
+    content, new_name = processed
+    content.source_sha256 = source_digest
+    field_file.save(new_name, content, save=False)
+    return True
+
 def _process_image_strip_metadata(uploaded_file):
     if Image is None or not uploaded_file:
         return None
-    try:
-        with Image.open(uploaded_file) as im:
-            im.load()
-            has_alpha = ('A' in im.getbands()) or (im.mode in ('RGBA', 'LA'))
-            rgb = im.convert('RGBA') if has_alpha else im.convert('RGB')
-            out = BytesIO()
-            if has_alpha:
-                # Preserve alpha in PNG and strip metadata
-                rgb.save(out, format='PNG', optimize=True)
-                new_ext = 'png'
-            else:
-                rgb.save(out, format='JPEG', quality=90, optimize=True)
-                new_ext = 'jpg'
-            content = ContentFile(out.getvalue())
-            base = os.path.splitext(getattr(uploaded_file, 'name', 'upload'))[0]
-            new_name = f"{os.path.basename(base)}_clean.{new_ext}"
-            return content, new_name
-    except Exception:
-        return None
+    with span('media'):
+        try:
+            with Image.open(uploaded_file) as im:
+                im.load()
+                has_alpha = ('A' in im.getbands()) or (im.mode in ('RGBA', 'LA'))
+                rgb = im.convert('RGBA') if has_alpha else im.convert('RGB')
+                out = BytesIO()
+                if has_alpha:
+                    # Preserve alpha in PNG and strip metadata
+                    rgb.save(out, format='PNG', optimize=True)
+                    new_ext = 'png'
+                else:
+                    rgb.save(out, format='JPEG', quality=90, optimize=True)
+                    new_ext = 'jpg'
+                content = ContentFile(out.getvalue())
+                base = os.path.splitext(getattr(uploaded_file, 'name', 'upload'))[0]
+                new_name = f"{os.path.basename(base)}_clean.{new_ext}"
+                return content, new_name
+        except Exception:
+            return None
 from django.shortcuts import render, get_object_or_404, redirect
 from django.urls import reverse
 from django.contrib.auth.decorators import login_required
 from django.contrib import messages
-from django.http import HttpResponseForbidden, JsonResponse
-from .models import Project, ProjectImage, ProjectFile, ProjectLike, PackageMockup, Category
+from django.http import HttpResponse, HttpResponseForbidden, JsonResponse
+from .models import Project, ProjectLike, PackageMockup, Category
 from accounts.models import Follow, UserStorageSettings
 from .forms import ProjectForm, ProjectImageForm, ProjectFileForm, PackageMockupForm
+from .storage import ContentAddressedStorage, content_digest, find_processed_blob
+from .usage import get_usage_bytes, reserve_quota
+from .rendering import compose_mockup_preview, request_render, render_status
+from . import batch
+from core.timing import span
 from django.core.files.base import ContentFile
 from django.conf import settings
 from django.utils import timezone
@@ -122,52 +78,10 @@ import os
 import time
 from io import BytesIO
 try:
-    from PIL import Image, ImageOps, ImageFilter, ImageChops
+    from PIL import Image
 except Exception:
     Image = None
 
-def compose_mockup_image(mockup):
-    if Image is None or not mockup.container_image or not mockup.design_image:
-        return
-    try:
-        with Image.open(mockup.container_image) as _base_im:
-            base = _base_im.convert('RGBA').copy()
-        with Image.open(mockup.design_image) as _design_im:
-            design = _design_im.convert('RGBA').copy()
-        target_w = max(1, int(base.width * (mockup.design_scale / 100.0)))
-        ratio = target_w / float(design.width)
-        target_h = max(1, int(design.height * ratio))
-        design = design.resize((target_w, target_h), Image.LANCZOS)
-        if mockup.mask_image:
-            with Image.open(mockup.mask_image) as _mask_im:
-                mask = _mask_im.convert('L').resize((design.width, design.height), Image.LANCZOS).copy()
-            if getattr(mockup, 'mask_invert', False):
-                mask = ImageOps.invert(mask)
-            feather = max(0.0, float(getattr(mockup, 'mask_feather', 0.0)))
-            if feather > 0:
-                mask = mask.filter(ImageFilter.GaussianBlur(radius=feather))
-            opacity = max(0.0, min(100.0, float(getattr(mockup, 'mask_opacity', 100.0)))) / 100.0
-            if design.mode != 'RGBA':
-                design = design.convert('RGBA')
-            existing_alpha = design.split()[-1]
-            mask_scaled = mask.point(lambda p: int(p * opacity))
-            combined_alpha = ImageChops.multiply(existing_alpha, mask_scaled)
-            design.putalpha(combined_alpha)
-        if mockup.design_rotation:
-            design = design.rotate(-mockup.design_rotation, resample=Image.BICUBIC, expand=True)
-        pos_x = int((mockup.design_pos_x / 100.0) * base.width - design.width / 2)
-        pos_y = int((mockup.design_pos_y / 100.0) * base.height - design.height / 2)
-        composed = Image.new('RGBA', base.size)
-        composed.paste(base, (0, 0))
-        composed.alpha_composite(design, (pos_x, pos_y))
-        out_io = BytesIO()
-        composed.convert('RGB').save(out_io, format='JPEG', quality=90)
-        out_content = ContentFile(out_io.getvalue())
-        filename = f"mockup_{mockup.id}_{int(timezone.now().timestamp())}.jpg"
-        mockup.generated_image.save(filename, out_content, save=True)
-    except Exception:
-        pass
-
 def _safe_delete_file(path, attempts=5, delay=0.2):
     if not path:
         return
@@ -313,20 +227,19 @@ def project_create(request):
         if form.is_valid():
             # Quota check for incoming files
             add_bytes = _incoming_files_size(request.FILES, ['cover_image', 'video_file', 'audio_file'])
-            if _would_exceed_quota(request.user, add_bytes):
+            reservation = reserve_quota(request.user, add_bytes)
+            if reservation is None:
                 messages.error(request, 'Upload would exceed your storage quota. Please remove some files or upload smaller files.')
                 return render(request, 'projects/project_form.html', {'form': form, 'form_type': 'create'})
 
-            project = form.save(commit=False)
-            project.owner = request.user
-            # Strip metadata on images if provided
-            if request.FILES.get('cover_image'):
-                processed = _process_image_strip_metadata(request.FILES['cover_image'])
-                if processed:
-                    content, new_name = processed
-                    project.cover_image.save(new_name, content, save=False)
-            project.save()
-            form.save_m2m()  # Save many-to-many data for categories
+            with reservation:
+                project = form.save(commit=False)
+                project.owner = request.user
+                # Strip metadata on images if provided
+                if request.FILES.get('cover_image'):
+                    _save_clean_image(project.cover_image, request.FILES['cover_image'])
+                project.save()
+                form.save_m2m()  # Save many-to-many data for categories
             messages.success(request, 'Project created successfully!')
             return redirect('projects:project_detail', pk=project.pk)
     else:
@@ -380,16 +293,15 @@ def project_update(request, pk):
         form = ProjectForm(request.POST, request.FILES, instance=project)
         if form.is_valid():
             add_bytes = _incoming_files_size(request.FILES, ['cover_image', 'video_file', 'audio_file'])
-            if _would_exceed_quota(request.user, add_bytes):
+            reservation = reserve_quota(request.user, add_bytes)
+            if reservation is None:
                 messages.error(request, 'Upload would exceed your storage quota. Please remove some files or upload smaller files.')
                 return render(request, 'projects/project_form.html', {'form': form, 'project': project, 'form_type': 'update'})
-            proj = form.save(commit=False)
-            if request.FILES.get('cover_image'):
-                processed = _process_image_strip_metadata(request.FILES['cover_image'])
-                if processed:
-                    content, new_name = processed
-                    proj.cover_image.save(new_name, content, save=False)
-            proj.save()
+            with reservation:
+                proj = form.save(commit=False)
+                if request.FILES.get('cover_image'):
+                    _save_clean_image(proj.cover_image, request.FILES['cover_image'])
+                proj.save()
             messages.success(request, 'Project updated successfully!')
             return redirect('projects:project_detail', pk=project.pk)
     else:
@@ -426,17 +338,16 @@ def add_project_image(request, project_pk):
         form = ProjectImageForm(request.POST, request.FILES)
         if form.is_valid():
             add_bytes = _incoming_files_size(request.FILES, ['image'])
-            if _would_exceed_quota(request.user, add_bytes):
+            reservation = reserve_quota(request.user, add_bytes)
+            if reservation is None:
                 messages.error(request, 'Upload would exceed your storage quota. Please remove some files or upload smaller files.')
             else:
-                image = form.save(commit=False)
-                image.project = project
-                if request.FILES.get('image'):
-                    processed = _process_image_strip_metadata(request.FILES['image'])
-                    if processed:
-                        content, new_name = processed
-                        image.image.save(new_name, content, save=False)
-                image.save()
+                with reservation:
+                    image = form.save(commit=False)
+                    image.project = project
+                    if request.FILES.get('image'):
+                        _save_clean_image(image.image, request.FILES['image'])
+                    image.save()
                 messages.success(request, 'Image added successfully!')
     
     return redirect('projects:project_detail', pk=project.pk)
@@ -452,12 +363,14 @@ def add_project_file(request, project_pk):
         form = ProjectFileForm(request.POST, request.FILES)
         if form.is_valid():
             add_bytes = _incoming_files_size(request.FILES, ['file'])
-            if _would_exceed_quota(request.user, add_bytes):
+            reservation = reserve_quota(request.user, add_bytes)
+            if reservation is None:
                 messages.error(request, 'Upload would exceed your storage quota. Please remove some files or upload smaller files.')
             else:
-                project_file = form.save(commit=False)
-                project_file.project = project
-                project_file.save()
+                with reservation:
+                    project_file = form.save(commit=False)
+                    project_file.project = project
+                    project_file.save()
                 messages.success(request, 'File added successfully!')
     
     return redirect('projects:project_detail', pk=project.pk)
@@ -488,21 +401,20 @@ def mockup_create(request):
         form = PackageMockupForm(request.POST, request.FILES)
         if form.is_valid():
             add_bytes = _incoming_files_size(request.FILES, ['container_image', 'design_image', 'mask_image'])
-            if _would_exceed_quota(request.user, add_bytes):
+            reservation = reserve_quota(request.user, add_bytes)
+            if reservation is None:
                 messages.error(request, 'Upload would exceed your storage quota. Please remove some files or upload smaller files.')
             else:
-                mockup = form.save(commit=False)
-                mockup.owner = request.user
-                mockup.title = mockup.title or f"Mockup {timezone.now():%Y-%m-%d %H:%M}"
-                # Process images
-                for field in ['container_image', 'design_image', 'mask_image']:
-                    if request.FILES.get(field):
-                        processed = _process_image_strip_metadata(request.FILES[field])
-                        if processed:
-                            content, new_name = processed
-                            getattr(mockup, field).save(new_name, content, save=False)
-                mockup.save()
-                compose_mockup_image(mockup)
+                with reservation:
+                    mockup = form.save(commit=False)
+                    mockup.owner = request.user
+                    mockup.title = mockup.title or f"Mockup {timezone.now():%Y-%m-%d %H:%M}"
+                    # Process images
+                    for field in ['container_image', 'design_image', 'mask_image']:
+                        if request.FILES.get(field):
+                            _save_clean_image(getattr(mockup, field), request.FILES[field])
+                    mockup.save()
+                    request_render(mockup)
                 messages.success(request, 'Mockup created successfully!')
                 return redirect('projects:mockup_detail', pk=mockup.pk)
     else:
@@ -523,58 +435,132 @@ def mockup_delete(request, pk):
         return redirect('projects:mockup_list')
     return render(request, 'projects/mockups/confirm_delete.html', {'mockup': mockup})
 
+MOCKUP_EDIT_FIELDS = [
+    'design_pos_x', 'design_pos_y', 'design_scale', 'design_rotation',
+    'container_image', 'design_image', 'mask_image', 'mask_opacity', 'mask_feather', 'mask_invert',
+]
+
+def _apply_mockup_params(mockup, data):
+    # Numeric and toggle parameters from an editor form; missing or bad values keep the current ones
+    for name in ['design_pos_x', 'design_pos_y', 'design_scale', 'design_rotation', 'mask_opacity', 'mask_feather']:
+        try:
+            setattr(mockup, name, float(data.get(name, getattr(mockup, name))))
+        except Exception:
+            pass
+    miv = data.get('mask_invert')
+    if miv is not None:
+        mockup.mask_invert = miv in ['1', 'true', 'True', 'on']
+
 @login_required
 def mockup_update(request, pk):
     if request.method != 'POST':
         return JsonResponse({'error': 'Invalid method'}, status=405)
     mockup = get_object_or_404(PackageMockup, pk=pk, owner=request.user)
-    def get_float(name, default):
-        try:
-            return float(request.POST.get(name, default))
-        except Exception:
-            return default
-    mockup.design_pos_x = get_float('design_pos_x', mockup.design_pos_x)
-    mockup.design_pos_y = get_float('design_pos_y', mockup.design_pos_y)
-    mockup.design_scale = get_float('design_scale', mockup.design_scale)
-    mockup.design_rotation = get_float('design_rotation', mockup.design_rotation)
+    _apply_mockup_params(mockup, request.POST)
     old_mask_path = mockup.mask_image.path if getattr(mockup, 'mask_image') and mockup.mask_image else None
     old_design_path = mockup.design_image.path if getattr(mockup, 'design_image') and mockup.design_image else None
     if request.POST.get('clear_mask') == '1':
         mockup.mask_image = None
     add_bytes = _incoming_files_size(request.FILES, ['mask_image', 'design_image', 'container_image'])
-    if _would_exceed_quota(request.user, add_bytes):
+    reservation = reserve_quota(request.user, add_bytes)
+    if reservation is None:
         return JsonResponse({'error': 'Quota exceeded'}, status=400)
-    if 'mask_image' in request.FILES and request.FILES['mask_image']:
-        processed = _process_image_strip_metadata(request.FILES['mask_image'])
-        if processed:
-            content, new_name = processed
-            mockup.mask_image.save(new_name, content, save=False)
-    mop = request.POST.get('mask_opacity')
-    mfe = request.POST.get('mask_feather')
-    miv = request.POST.get('mask_invert')
-    if mop is not None:
-        try:
-            mockup.mask_opacity = float(mop)
-        except Exception:
-            pass
-    if mfe is not None:
-        try:
-            mockup.mask_feather = float(mfe)
-        except Exception:
-            pass
-    if miv is not None:
-        mockup.mask_invert = miv in ['1', 'true', 'True', 'on']
-    if 'design_image' in request.FILES and request.FILES['design_image']:
-        processed = _process_image_strip_metadata(request.FILES['design_image'])
-        if processed:
-            content, new_name = processed
-            mockup.design_image.save(new_name, content, save=False)
-    if 'container_image' in request.FILES and request.FILES['container_image']:
-        processed = _process_image_strip_metadata(request.FILES['container_image'])
-        if processed:
-            content, new_name = processed
-            mockup.container_image.save(new_name, content, save=False)
-    mockup.save()
-    compose_mockup_image(mockup)
-    url = mockup.generated_image.url if mockup.generated_image else ''
-    return JsonResponse({'ok': True, 'generated_image': url})
\ No newline at end of file
+    with reservation:
+        if 'mask_image' in request.FILES and request.FILES['mask_image']:
+            _save_clean_image(mockup.mask_image, request.FILES['mask_image'])
+        if 'design_image' in request.FILES and request.FILES['design_image']:
+            _save_clean_image(mockup.design_image, request.FILES['design_image'])
+        if 'container_image' in request.FILES and request.FILES['container_image']:
+            _save_clean_image(mockup.container_image, request.FILES['container_image'])
+        # Leave the render fields to projects.rendering; a render may land meanwhile
+        mockup.save(update_fields=MOCKUP_EDIT_FIELDS)
+        version = request_render(mockup)
+    status = render_status(mockup)
+    status['status_url'] = reverse('projects:mockup_render_status', args=[mockup.pk])
+    return JsonResponse({'ok': True, 'version': version, **status})
+
+@login_required
+def mockup_preview(request, pk):
+    # Unsaved parameters rendered from downscaled layers; nothing is stored
+    mockup = get_object_or_404(PackageMockup, pk=pk, owner=request.user)
+    data = request.POST if request.method == 'POST' else request.GET
+    _apply_mockup_params(mockup, data)
+    if data.get('clear_mask') == '1':
+        mockup.mask_image = None
+    image = compose_mockup_preview(mockup)
+    if image is None:
+        return JsonResponse({'error': 'Preview unavailable'}, status=400)
+    response = HttpResponse(image, content_type='image/webp')
+    response['Cache-Control'] = 'no-store'
+    return response
+
+@login_required
+def mockup_batch(request):
+    # One design on many containers (uploads) or existing mockups, rendered on a
+    # Celery worker. Without the queue only small batches are rendered, serially
+    # in the request; the process pool is left to `manage.py render_mockups`.
+    if request.method != 'POST':
+        return JsonResponse({'error': 'Invalid method'}, status=405)
+    design = request.FILES.get('design_image')
+    mask = request.FILES.get('mask_image')
+    containers = request.FILES.getlist('container_images')
+    ids = [int(i) for i in ','.join(request.POST.getlist('mockup_ids')).split(',') if i.strip().isdigit()]
+    existing = list(PackageMockup.objects.filter(owner=request.user, pk__in=ids)) if ids else []
+    limit = getattr(settings, 'MOCKUP_BATCH_MAX', 50)
+    if not containers and not existing:
+        return JsonResponse({'error': 'No containers or mockups given'}, status=400)
+    if containers and not design:
+        return JsonResponse({'error': 'A design image is required'}, status=400)
+    if len(containers) + len(existing) > limit:
+        return JsonResponse({'error': f'At most {limit} mockups per batch'}, status=400)
+    inline_limit = getattr(settings, 'MOCKUP_BATCH_INLINE_MAX', 5)
+    if not getattr(settings, 'MOCKUP_RENDER_ASYNC', False) and len(containers) + len(existing) > inline_limit:
+        return JsonResponse(
+            {'error': f'Batch rendering is unavailable; at most {inline_limit} mockups at a time'}, status=503
+        )
+    params = {}
+    if any(name in request.POST for name in batch.PARAMS):
+        probe = PackageMockup()
+        _apply_mockup_params(probe, request.POST)
+        params = {name: getattr(probe, name) for name in batch.PARAMS if name in request.POST}
+    add_bytes = _incoming_files_size(request.FILES, ['design_image', 'mask_image'])
+    add_bytes += sum(int(getattr(f, 'size', 0) or 0) for f in containers)
+    reservation = reserve_quota(request.user, add_bytes)
+    if reservation is None:
+        return JsonResponse({'error': 'Quota exceeded'}, status=400)
+    try:
+        with reservation:
+            mockups = []
+            if containers:
+                mockups += batch.create_batch(request.user, design, containers, mask=mask, params=params,
+                                              title=request.POST.get('title', ''))
+            if existing:
+                mockups += batch.apply_design(existing, design, mask=mask, params=params)
+    except ValueError as e:
+        return JsonResponse({'error': str(e)}, status=400)
+    report = batch.start_batch(mockups, workers=1)
+    ids = ','.join(str(m.pk) for m in mockups)
+    return JsonResponse({
+        'ok': True,
+        'mockups': [m.pk for m in mockups],
+        'queued': report is None,
+        'report': report,
+        'status_url': f"{reverse('projects:mockup_batch_status')}?ids={ids}",
+    })
+
+@login_required
+def mockup_batch_status(request):
+    ids = [int(i) for i in request.GET.get('ids', '').split(',') if i.strip().isdigit()]
+    mockups = PackageMockup.objects.filter(owner=request.user, pk__in=ids).order_by('pk')
+    items = [{
+        'id': m.pk,
+        'ready': m.rendered_version >= m.render_version,
+        'generated_image': m.generated_image.url if m.generated_image else '',
+    } for m in mockups]
+    done = sum(1 for item in items if item['ready'])
+    return JsonResponse({'ok': True, 'total': len(items), 'done': done, 'mockups': items})
+
+@login_required
+def mockup_render_status(request, pk):
+    mockup = get_object_or_404(PackageMockup, pk=pk, owner=request.user)
+    return JsonResponse({'ok': True, **render_status(mockup)})
\ No newline at end of file